@@ -1,9 +1,20 @@
 from .domain import *
+from .track import *
+from .geo import *
+from .series import *
+from .query import *
 from .fetcher import *
+from .codec import *
+from .export import *
 from .persist import Persister
+from .dup import *
 from .sheets import SheetUpdater
+from .localsheets import *
 from .backup import *
 from .reporter import *
 from .mng import *
+from .multi import *
+from .watch import *
+from .prof import *
 from .cli import *
 from .app import *
@@ -7,7 +7,10 @@ from dataclasses import dataclass, field
 from enum import Enum, auto
 import logging
 from datetime import datetime
-from . import Manager, Backuper, Reporter, SheetUpdater
+from . import (
+    GarmdownError, Manager, Backuper, Reporter, SheetUpdater, SheetBenchmark,
+    MultiAccountSyncer, Watcher, GeoGrid
+)
 
 logger = logging.getLogger(__name__)
 
@@ -58,10 +61,27 @@ class DateBasedApplication(object):
 
 @dataclass
 class ReporterApplication(DateBasedApplication):
-    """Report activities of a day.
+    """Report activities of a day or those that match a query.
 
     """
-    CLI_META = {'option_excludes': set('reporter'.split())}
+    CLI_META = {'option_excludes': set('reporter'.split()),
+                # keep the short options as actions are added
+                'option_overrides': {'filter': {'short_name': 'e'},
+                                     'order': {'short_name': 'o'}},
+                'mnemonic_overrides':
+                {'query_laps': {'name': 'laps',
+                                'option_includes': set(
+                                    'filter limit order'.split())},
+                 'query_near': {'name': 'near',
+                                'option_includes': set(
+                                    'point radius filter format limit order'
+                                    .split())},
+                 'query_box': {'name': 'box',
+                               'option_includes': set(
+                                   'corners filter format limit order'
+                                   .split())},
+                 'preview': {'option_includes': set(
+                     'activity date days points format'.split())}}}
 
     reporter: Reporter = field()
     """Report activities of a day."""
@@ -78,6 +98,96 @@ class ReporterApplication(DateBasedApplication):
         fmt = self.format.name
         getattr(self.reporter, f'write_{fmt}')(date)
 
+    def query(self, filter: str = '', limit: int = None,
+              order: str = '-date'):
+        """Report activities that match a filter query.
+
+        :param filter: <field><op><value> terms such as
+                       'type=c year=2025 duration>=19m duration<=21m'
+
+        :param limit: the activity limit, which defaults config
+
+        :param order: the field to sort on, descending when prefixed with -
+
+        """
+        self.reporter.write_query(filter, self.format.name, limit, order)
+
+    def query_laps(self, filter: str = '', limit: int = None,
+                   order: str = '-date'):
+        """Report laps that match a filter query.
+
+        :param filter: <field><op><value> terms such as
+                       'type=c year=2025 duration>=19m duration<=21m'
+
+        :param limit: the activity limit, which defaults config
+
+        :param order: the field to sort on, descending when prefixed with -
+
+        """
+        self.reporter.write_laps(filter, limit, order)
+
+    def query_near(self, point: str = None, radius: float = 200,
+                   filter: str = '', limit: int = None, order: str = '-date'):
+        """Report activities that went near a position.
+
+        :param point: the latitude and longitude such as 45.52,-122.68
+
+        :param radius: the distance from the point in meters
+
+        :param filter: <field><op><value> terms such as
+                       'type=c year=2025 duration>=19m duration<=21m'
+
+        :param limit: the activity limit, which defaults config
+
+        :param order: the field to sort on, descending when prefixed with -
+
+        """
+        if point is None:
+            raise GarmdownError('missing point (lat,lon)')
+        pos = GeoGrid.parse_position(point)
+        if len(pos) != 2:
+            raise GarmdownError(f'bad position (need lat,lon): {point}')
+        self.reporter.write_near(*pos, radius, filter, self.format.name,
+                                 limit, order)
+
+    def query_box(self, corners: str = None, filter: str = '',
+                  limit: int = None, order: str = '-date'):
+        """Report activities that went through a bounding box.
+
+        :param corners: the south west and north east corners of the box such
+                        as 45.50,-122.70,45.53,-122.65
+
+        :param filter: <field><op><value> terms such as
+                       'type=c year=2025 duration>=19m duration<=21m'
+
+        :param limit: the activity limit, which defaults config
+
+        :param order: the field to sort on, descending when prefixed with -
+
+        """
+        if corners is None:
+            raise GarmdownError('missing corners (lat,lon,lat,lon)')
+        box = GeoGrid.parse_position(corners)
+        if len(box) != 4:
+            raise GarmdownError(
+                f'bad bounding box (need lat,lon,lat,lon): {corners}')
+        self.reporter.write_box(box, filter, self.format.name, limit, order)
+
+    def preview(self, activity: str = None, days: int = 1,
+                points: int = 128):
+        """Write the downsampled series of activities as CSV (or JSON).
+
+        :param activity: the activity ID, which defaults to those of the date
+
+        :param days: the number of days of activities starting with the date
+
+        :param points: the fewest points of each series
+
+        """
+        fmt = 'json' if self.format == ReportType.json else 'csv'
+        start = None if activity is not None else self._get_date()
+        self.reporter.write_preview(activity, start, days, points, fmt)
+
 
 @dataclass
 class DownloadApplication(DateBasedApplication):
@@ -112,7 +222,7 @@ class DownloadApplication(DateBasedApplication):
         self.manager.sync_tcx(self.limit)
 
     def import_tcx(self):
-        """Import TCX file."""
+        """Write downloaded files to the import directory."""
         self.manager.import_tcx()
 
     def clean_imported(self):
@@ -144,25 +254,39 @@ class BackupApplication(object):
     def backup(self):
         self.backuper.backup(True)
 
+    def compact(self):
+        """Re-encode activities per the storage settings and vacuum."""
+        persister = self.backuper.persister
+        persister.recode_activities()
+        persister.compact()
+
 
 @dataclass
 class SheetApplication(object):
     """Updates a Google Sheets activity data.
 
     """
-    CLI_META = {'option_excludes': set('sheet_updater'.split()),
-                'mnemonic_overrides': {'sync': 'sheet'}}
+    CLI_META = {'option_excludes': set(
+                    'sheet_updater sheet_benchmark'.split()),
+                'mnemonic_overrides': {'sync': 'sheet',
+                                       'benchmark': 'sheetbench'}}
 
     sheet_updater: SheetUpdater = field()
     """Updates a Google Sheets spreadsheet with activity data from the activity
     database.
 
     """
+    sheet_benchmark: SheetBenchmark = field()
+    """Measures the cost of a spreadsheet sync with a local stand-in."""
 
     def sync(self):
         """Update Google Docs training spreadsheet."""
         self.sheet_updater.sync()
 
+    def benchmark(self):
+        """Measure the requests of a spreadsheet sync with a local stand-in."""
+        self.sheet_benchmark.write()
+
 
 @dataclass
 class SyncApplication(object):
@@ -186,3 +310,108 @@ class SyncApplication(object):
         self.manager.sync()
         self.backuper.backup()
         self.sheet_updater.sync()
+
+
+@dataclass
+class AccountsApplication(object):
+    """Sync several Garmin accounts concurrently.
+
+    """
+    CLI_META = {'option_excludes': set('syncer'.split()),
+                'mnemonic_overrides': {'sync_accounts': 'accounts'}}
+
+    syncer: MultiAccountSyncer = field()
+    """Syncs several Garmin Connect accounts concurrently."""
+
+    limit: int = field(default=None)
+    """The activity limit, which defaults config.
+
+    """
+    def sync_accounts(self):
+        """Download activities and TCX files of all configured accounts."""
+        if len(self.syncer.logins) == 0:
+            raise GarmdownError('no accounts configured in [accounts] logins')
+        results = self.syncer.sync(self.limit)
+        self.syncer.write_results(results)
+
+
+@dataclass
+class ArchiveApplication(object):
+    """Maintain the downloaded activity files.
+
+    """
+    CLI_META = {'option_excludes': set('manager'.split()),
+                'mnemonic_overrides': {'index_tracks': 'geoindex',
+                                       'build_series': 'series',
+                                       'find_duplicates': 'dups'}}
+
+    manager: Manager = field()
+    """Manages downloading and database work."""
+
+    def fsck(self, fix: bool = False):
+        """Reconcile TCX files with the database and move them to the layout.
+
+        :param fix: move files, (un)mark downloads rather than only report
+
+        """
+        report = self.manager.fsck(fix)
+        report.write(detail=not fix)
+
+    def archive(self):
+        """Move old activities to the archive database."""
+        self.manager.archive()
+
+    def extract_laps(self, limit: int = None):
+        """Add laps of downloaded activity files not yet read to the database.
+
+        :param limit: the activity limit, which defaults config
+
+        """
+        self.manager.extract_laps(limit)
+
+    def index_tracks(self, limit: int = None):
+        """Add positions of downloaded activity files not yet read to the geo
+        index.
+
+        :param limit: the activity limit, which defaults config
+
+        """
+        self.manager.index_tracks(limit)
+
+    def build_series(self, limit: int = None):
+        """Add downsampled series of downloaded activity files not yet read
+        to the database.
+
+        :param limit: the activity limit, which defaults config
+
+        """
+        self.manager.build_series(limit)
+
+    def find_duplicates(self, full: bool = False):
+        """Find activities recorded by more than one device.
+
+        :param full: check all activities, not only those added since last run
+
+        """
+        self.manager.find_duplicates(full)
+        self.manager.write_duplicates()
+
+
+@dataclass
+class WatchApplication(object):
+    """Poll for and sync new activities in a long running process.
+
+    """
+    CLI_META = {'option_excludes': set('watcher'.split()),
+                'mnemonic_overrides': {'write_status': 'watchstatus'}}
+
+    watcher: Watcher = field()
+    """Polls Garmin Connect for new activities and syncs them."""
+
+    def watch(self):
+        """Sync new activities as they appear until interrupted."""
+        self.watcher.watch()
+
+    def write_status(self):
+        """Print the stats of the last poll of the watch action."""
+        self.watcher.read_status().write()
@@ -27,18 +27,38 @@ class Backuper(object):
     days: int = field()
     """Number of days between backups of the activities SQLite database."""
 
-    def _execute(self):
-        """Execute the backup of the SQLite database."""
-        persister = self.persister
+    vacuum: bool = field(default=False)
+    """Whether to analyze and vacuum the database before each backup, which
+    also makes the backup smaller.
+
+    """
+
+    def _copy(self, src: Path) -> Path:
+        """Copy a database file to a time stamped file in the backup directory.
+
+        """
         self.backup_dir.mkdir(parents=True, exist_ok=True)
-        src = persister.db_file
         dst = self.backup_dir / f'{src.name}-{Backup.timestr_from_datetime()}'
-        backup = Backup(dst)
         if logger.isEnabledFor(logging.INFO):
             logger.info(f'backing up database {src} -> {dst}')
         su.copy(src, dst)
+        return dst
+
+    def _execute(self):
+        """Execute the backup of the SQLite database."""
+        persister = self.persister
+        backup = Backup(self._copy(persister.db_file))
         persister.insert_backup(backup)
 
+    def backup_archive(self):
+        """Backup the archive database (see :obj:`.Persister.archive_file`),
+        which only changes when activities are archived.
+
+        """
+        archive_file = self.persister.archive_file
+        if archive_file is not None and archive_file.is_file():
+            self._copy(archive_file)
+
     def backup(self, force=False):
         """Backup the SQLite if the last backup time is older than what's specified in
         the configuration.
@@ -46,7 +66,8 @@ class Backuper(object):
         :param force: if True, execute the backup regardless
 
         """
-        backup = self.persister.get_last_backup()
+        persister = self.persister
+        backup = persister.get_last_backup()
         if force:
             do_backup = True
         else:
@@ -62,4 +83,6 @@ class Backuper(object):
                 do_backup = diff_days >= self.days
         logger.debug(f'backing up: {do_backup}')
         if do_backup:
+            if self.vacuum:
+                persister.compact()
             self._execute()
@@ -0,0 +1,123 @@
+"""Encodes the raw Garmin activity JSON stored in the database.
+
+"""
+__author__ = 'Paul Landes'
+
+from typing import Dict, Any, Union
+from dataclasses import dataclass, field
+import logging
+import json
+import zlib
+import hashlib
+
+logger = logging.getLogger(__name__)
+
+
+class NullDefaultDict(dict):
+    """A dictionary that gives ``None`` for missing keys, which is used for
+    activity data with its null values removed so that it reads the same as
+    the original.
+
+    """
+    def __missing__(self, key):
+        return None
+
+
+@dataclass
+class RawCodec(object):
+    """Encodes and decodes the raw JSON of an activity for the ``raw`` column
+    of the database.  Encoded data is a blob that starts with :obj:`MARKER`
+    followed by a byte of flags for how it was encoded.  Text rows, which are
+    the JSON written before this codec existed (or with :obj:`compress` and
+    :obj:`strip_nulls` disabled), are decoded as plain JSON.  Therefore,
+    decoding does not depend on the current settings and a database can have
+    a mix of encodings.
+
+    """
+    MARKER = b'GDR'
+    """The prefix of encoded blobs."""
+
+    ZLIB = 1
+    """The flag of zlib compressed data."""
+
+    STRIPPED = 2
+    """The flag of data with the null values removed."""
+
+    compress: bool = field(default=False)
+    """Whether to zlib compress the JSON."""
+
+    strip_nulls: bool = field(default=False)
+    """Whether to remove keys with null values.  Decoded data gives ``None``
+    for missing keys.
+
+    """
+    level: int = field(default=6)
+    """The zlib compression level (1 - 9)."""
+
+    @property
+    def flags(self) -> int:
+        """The flags of data encoded with the current settings."""
+        return (self.ZLIB if self.compress else 0) | \
+            (self.STRIPPED if self.strip_nulls else 0)
+
+    @classmethod
+    def _strip(cls, obj: Any) -> Any:
+        if isinstance(obj, dict):
+            return {k: cls._strip(v) for k, v in obj.items() if v is not None}
+        if isinstance(obj, list):
+            return list(map(cls._strip, obj))
+        return obj
+
+    def encode(self, raw: Dict[str, Any]) -> Union[str, bytes]:
+        """Encode activity JSON for the database.  Data that was decoded with
+        its nulls removed stays flagged as such since the nulls can not be
+        restored.
+
+        """
+        flags = self.flags
+        if isinstance(raw, NullDefaultDict):
+            flags |= self.STRIPPED
+        if flags == 0:
+            return json.dumps(raw)
+        if flags & self.STRIPPED:
+            raw = self._strip(raw)
+        data = json.dumps(raw, separators=(',', ':')).encode()
+        if flags & self.ZLIB:
+            data = zlib.compress(data, self.level)
+        return self.MARKER + bytes((flags,)) + data
+
+    def decode(self, data: Union[str, bytes]) -> Dict[str, Any]:
+        """Decode activity JSON read from the database."""
+        if isinstance(data, str):
+            return json.loads(data)
+        mlen = len(self.MARKER)
+        if data[:mlen] != self.MARKER:
+            return json.loads(data)
+        flags = data[mlen]
+        data = data[mlen + 1:]
+        if flags & self.ZLIB:
+            data = zlib.decompress(data)
+        if flags & self.STRIPPED:
+            return json.loads(data, object_hook=NullDefaultDict)
+        return json.loads(data)
+
+    @classmethod
+    def fingerprint(cls, raw: Dict[str, Any]) -> str:
+        """Return a hash of activity JSON that does not depend on key order or
+        null values, which is used to detect activities edited in Garmin
+        Connect.
+
+        """
+        data = json.dumps(cls._strip(raw), sort_keys=True,
+                          separators=(',', ':'))
+        return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+    def is_current(self, data: Union[str, bytes]) -> bool:
+        """Whether ``data`` is encoded with the current settings."""
+        mlen = len(self.MARKER)
+        if isinstance(data, str) or data[:mlen] != self.MARKER:
+            return self.flags == 0
+        flags = data[mlen]
+        if not self.strip_nulls:
+            flags &= ~self.STRIPPED
+        return flags == self.flags
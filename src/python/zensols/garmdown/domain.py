@@ -3,7 +3,7 @@
 """
 __author__ = 'Paul Landes'
 
-from typing import Dict
+from typing import Dict, Tuple, List, Any
 from dataclasses import dataclass, field
 import sys
 import itertools as it
@@ -18,6 +18,16 @@ class GarmdownError(APIError):
 
 
 class Activity(object):
+    INDEXED_KEYS = {'heart_rate_average': 'averageHR',
+                    'power_average': 'avgPower',
+                    'power_norm': 'normPower',
+                    'stress_score': 'trainingStressScore',
+                    'calories': 'calories',
+                    'distance': 'distance'}
+    """Database column names to the Garmin JSON keys of values extracted from
+    the raw data so they can be indexed and queried.
+
+    """
     def __init__(self, raw, type_char):
         self.id = str(raw['activityId'])
         self.raw = raw
@@ -34,6 +44,22 @@ name location start_date_str duration move_time_seconds
 heart_rate_average v02max stress_score calories
 """.split()
 
+    @classmethod
+    def indexed_attributes(cls) -> Tuple[str]:
+        """The column names of :meth:`indexed_values`."""
+        return ('move_time_seconds',) + tuple(cls.INDEXED_KEYS.keys())
+
+    def indexed_values(self) -> Tuple[Any]:
+        """The values stored in their own database columns, which are taken
+        straight from the JSON since not all sport types have subclasses.
+
+        """
+        try:
+            secs = self.move_time_seconds
+        except (KeyError, ValueError):
+            secs = None
+        return (secs,) + tuple(map(self.raw.get, self.INDEXED_KEYS.values()))
+
     def _attr_names(self):
         return self.common_attributes()
 
@@ -247,3 +273,157 @@ class Backup(object):
 
     def __str__(self):
         return f'{self.timestr}: {self.path}'
+
+
+@dataclass
+class ImportCheckpoint(object):
+    """The progress of a (possibly multi-page) activity import, which is
+    persisted after each page so an interrupted import can be resumed.
+
+    """
+    start_index: int
+    """The 0 based index of the next page of activities to download."""
+
+    end_index: int
+    """The (exclusive) index where the import ends."""
+
+    time: datetime = field(default_factory=lambda: datetime.now())
+    """When the last page was completed."""
+
+    @property
+    def remaining(self) -> int:
+        """The number of activities left to import."""
+        return max(self.end_index - self.start_index, 0)
+
+    def __str__(self):
+        return (f'{self.start_index} -> {self.end_index} ' +
+                f'({self.remaining} left) at {self.time}')
+
+
+@dataclass
+class SheetRowIndex(object):
+    """The date to row mapping of the training spreadsheet cached in the
+    database, which is checked against the sheet by its first and last dates
+    before it is used.  The dates of the rows are stored separately.
+
+    """
+    sheet_id: str
+    """The ID of the spreadsheet."""
+
+    date_range: str
+    """The date column cell range that was read to create the index."""
+
+    rows: int
+    """The number of dated rows."""
+
+    last_idx: int
+    """The (0 based) index of the last row with completed data or queued to be
+    written, or -1 if there are none.
+
+    """
+    first_date: str
+    """The text of the date in the first row."""
+
+    last_date: str
+    """The text of the date in the last row."""
+
+    time: datetime = field(default_factory=lambda: datetime.now())
+    """When the index was created from the sheet."""
+
+    def __str__(self):
+        return (f'{self.sheet_id}: {self.rows} rows ({self.first_date} - ' +
+                f'{self.last_date}), last: {self.last_idx}')
+
+
+@dataclass
+class SyncStats(object):
+    """Counts of what was added by a sync.
+
+    """
+    activities: int = field(default=0)
+    """The number of activities added to the database."""
+
+    updated: int = field(default=0)
+    """The number of activities edited in Garmin Connect since they were added
+    and updated in the database.
+
+    """
+
+    downloaded: int = field(default=0)
+    """The number of TCX files downloaded."""
+
+    imported: int = field(default=0)
+    """The number of TCX files copied to the import directory."""
+
+    @property
+    def changed(self) -> bool:
+        """Whether anything was added."""
+        return (self.activities + self.updated + self.downloaded +
+                self.imported) > 0
+
+    def __str__(self):
+        return (f'{self.activities} activities, {self.updated} updated, ' +
+                f'{self.downloaded} downloaded, {self.imported} imported')
+
+
+@dataclass
+class FsckReport(object):
+    """The differences found between the activities directory and the
+    download state recorded in the database.
+
+    """
+    missing: List[str] = field(default_factory=list)
+    """IDs of activities marked as downloaded without a file."""
+
+    unmarked: List[str] = field(default_factory=list)
+    """IDs of activities with a file that are not marked as downloaded."""
+
+    misplaced: List[Path] = field(default_factory=list)
+    """Files that are not in their directory per the configured layout."""
+
+    orphans: List[Path] = field(default_factory=list)
+    """Files with no activity in the database."""
+
+    files: int = field(default=0)
+    """The number of files found."""
+
+    @property
+    def clean(self) -> bool:
+        """Whether the directory and database agree."""
+        return (len(self.missing) + len(self.unmarked) +
+                len(self.misplaced) + len(self.orphans)) == 0
+
+    def write(self, writer=sys.stdout, detail: bool = False):
+        writer.write(f'files: {self.files}\n')
+        for name in 'missing unmarked misplaced orphans'.split():
+            items = getattr(self, name)
+            writer.write(f'{name}: {len(items)}\n')
+            if detail:
+                for item in items:
+                    writer.write(f'  {item}\n')
+
+
+@dataclass
+class Duplicate(object):
+    """An activity recorded at the same time as another of the same sheet
+    column type, such as by both a watch and a bike computer.  The secondary
+    activity is left out of the spreadsheet and the daily totals.
+
+    """
+    activity_id: str
+    """The ID of the secondary activity."""
+
+    primary_id: str
+    """The ID of the activity kept in its place."""
+
+    start_time: datetime
+    """The start time of the secondary activity."""
+
+    overlap: float
+    """The fraction of the shorter activity's moving time that overlaps the
+    other.
+
+    """
+    def __str__(self):
+        return (f'{self.activity_id} ({self.start_time}) -> ' +
+                f'{self.primary_id}: {self.overlap:.0%} overlap')
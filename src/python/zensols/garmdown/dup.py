@@ -0,0 +1,146 @@
+"""Finds activities recorded more than once by different devices.
+
+"""
+__author__ = 'Paul Landes'
+
+from typing import Dict, Tuple, List, Iterable
+from dataclasses import dataclass, field
+import logging
+import heapq
+from datetime import datetime, timedelta
+from zensols.config import Settings
+from . import GarmdownError, Duplicate, Persister
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DuplicateDetector(object):
+    """Finds activities of the same spreadsheet column type (i.e. a ride on
+    both a watch and a bike computer) whose moving times overlap by at least
+    :obj:`min_overlap`.  Of each group of overlapping activities, the one with
+    the most moving time is the primary and the others are its secondaries,
+    which are left out of the spreadsheet and the daily totals.
+
+    Activities are swept in start time order, keeping a heap by end time of
+    those still going, so the whole history is checked in O(n log n).  Only
+    the activities added or changed since the last check, and those starting
+    within :obj:`max_seconds` of them, are swept by :meth:`detect`.
+
+    """
+    SKIP = '<skip>'
+    """The column type of activities that are not in the spreadsheet, which
+    are not checked.
+
+    """
+    persister: Persister = field()
+    """Reads activity start and moving times and stores the duplicates."""
+
+    act_char_to_col_type: Settings = field()
+    """Activity type characters to spreadsheet columns, where activities of
+    types of the same column are compared.
+
+    """
+    min_overlap: float = field(default=0.5)
+    """The fraction of the shorter activity's moving time that must overlap
+    the other for them to be duplicates.
+
+    """
+    max_seconds: float = field(default=86400)
+    """The longest moving time of the activities, which bounds the activities
+    swept with those added since the last check.
+
+    """
+    def __post_init__(self):
+        if isinstance(self.act_char_to_col_type, Settings):
+            self.act_char_to_col_type = self.act_char_to_col_type.asdict()
+        if not 0 < self.min_overlap <= 1:
+            raise GarmdownError(f'bad duplicate overlap: {self.min_overlap}')
+
+    def _sweep(self, spans: Iterable[Tuple[str, datetime, str, float]]) -> \
+            List[Duplicate]:
+        """Return the duplicates of activities ordered by start time (see
+        :meth:`.Persister.get_activity_spans`).
+
+        """
+        epoch = datetime(1970, 1, 1)
+        cols = self.act_char_to_col_type
+        min_overlap = self.min_overlap
+        # activity ID to its start, start seconds and moving seconds
+        acts: Dict[str, Tuple[datetime, float, float]] = {}
+        # activity ID to the parent in its group (union-find)
+        parent: Dict[str, str] = {}
+        # column type to heap of (end, ID, start seconds, moving seconds)
+        going: Dict[str, List[Tuple[float, str, float, float]]] = {}
+
+        def root(aid: str) -> str:
+            while parent[aid] != aid:
+                parent[aid] = parent[parent[aid]]
+                aid = parent[aid]
+            return aid
+
+        for aid, start, atype, secs in spans:
+            col = cols.get(atype, atype)
+            if col == self.SKIP or secs is None or secs <= 0:
+                continue
+            t0 = (start - epoch).total_seconds()
+            t1 = t0 + secs
+            acts[aid] = (start, t0, secs)
+            parent[aid] = aid
+            heap = going.setdefault(col, [])
+            while len(heap) > 0 and heap[0][0] <= t0:
+                heapq.heappop(heap)
+            for end, oid, _, osecs in heap:
+                if (min(end, t1) - t0) / min(secs, osecs) >= min_overlap:
+                    parent[root(oid)] = root(aid)
+            heapq.heappush(heap, (t1, aid, t0, secs))
+        groups: Dict[str, List[str]] = {}
+        for aid in acts.keys():
+            groups.setdefault(root(aid), []).append(aid)
+        dups: List[Duplicate] = []
+        for group in filter(lambda g: len(g) > 1, groups.values()):
+            # keep the longest recording, then the first to start
+            primary = min(group, key=lambda i: (-acts[i][2], acts[i][1], i))
+            _, p0, psecs = acts[primary]
+            for aid in filter(lambda i: i != primary, group):
+                start, t0, secs = acts[aid]
+                overlap = min(p0 + psecs, t0 + secs) - max(p0, t0)
+                dups.append(Duplicate(aid, primary, start,
+                                      max(overlap, 0) / min(secs, psecs)))
+        dups.sort(key=lambda d: d.start_time)
+        return dups
+
+    def detect(self, full: bool = False) -> Tuple[Duplicate]:
+        """Find the duplicates of the activities added or changed since the
+        last check, and replace those stored for the time they span.
+
+        :param full: whether to check all activities, including those archived
+
+        :return: the duplicates found
+
+        """
+        persister = self.persister
+        pending: Dict[str, datetime] = persister.get_duplicate_pending()
+        times = tuple(filter(lambda t: t is not None, pending.values()))
+        if full:
+            start = end = None
+            spans = persister.get_activity_spans()
+        elif len(times) == 0:
+            if len(pending) > 0:
+                persister.clear_duplicate_pending(pending.keys())
+            return ()
+        else:
+            # activities that overlap the pending ones start in this span,
+            # and are compared with those going when the span starts
+            margin = timedelta(seconds=self.max_seconds)
+            start, end = min(times) - margin, max(times) + margin
+            spans = persister.get_activity_spans(
+                start - margin, end + margin)
+        dups = self._sweep(spans)
+        if not full:
+            dups = list(filter(lambda d: start <= d.start_time < end, dups))
+        persister.replace_duplicates(dups, start, end)
+        persister.clear_duplicate_pending(pending.keys())
+        logger.info(f'found {len(dups)} duplicates of {len(spans)} ' +
+                    'activities')
+        return tuple(dups)
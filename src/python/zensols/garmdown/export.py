@@ -0,0 +1,394 @@
+"""Write downloaded activity files to the import directory in other formats.
+
+"""
+__author__ = 'Paul Landes'
+
+from typing import Dict, Tuple, List, Iterable
+from dataclasses import dataclass, field
+from abc import ABC, abstractmethod
+import logging
+import os
+import csv
+import shutil
+from io import TextIOBase
+from pathlib import Path
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape
+from . import GarmdownError, Track, Lap, FitReader, read_points, read_laps
+
+logger = logging.getLogger(__name__)
+
+
+class TrackpointWriter(ABC):
+    """Writes the trackpoints of an activity to a file one at a time, so that
+    the activity is converted without keeping its track.
+
+    """
+    PRECISION = {'latitude': 7, 'longitude': 7, 'altitude': 2,
+                 'distance': 2, 'heart_rate': 0, 'cadence': 0, 'power': 0,
+                 'speed': 3}
+    """The number of decimal places written of each column."""
+
+    def __init__(self, writer: TextIOBase, sport: str, laps: Tuple[Lap]):
+        """Initialize.
+
+        :param writer: the file to write
+
+        :param sport: the sport name of the activity, such as ``cycling``,
+                      or ``None`` if not known
+
+        :param laps: the laps of the activity
+
+        """
+        self.writer = writer
+        self.sport = sport
+        self.laps = laps
+
+    @staticmethod
+    def _time(secs: float) -> str:
+        """Format seconds since the UNIX epoch as an ISO 8601 UTC time."""
+        return datetime.fromtimestamp(secs, timezone.utc).\
+            strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    @classmethod
+    def _num(cls, col: str, val: float) -> str:
+        places = cls.PRECISION[col]
+        if places == 0:
+            return str(round(val))
+        return f'{val:.{places}f}'
+
+    def start(self):
+        """Write what comes before the trackpoints."""
+        pass
+
+    @abstractmethod
+    def write(self, point: Dict[str, float]):
+        """Write a trackpoint given as column names to values."""
+        pass
+
+    def end(self):
+        """Write what comes after the trackpoints."""
+        pass
+
+
+class CsvWriter(TrackpointWriter):
+    """Writes trackpoints as CSV with a column for each of
+    :obj:`.Track.COLUMNS`, where the time is in UTC and values that were not
+    recorded are empty.
+
+    """
+    def start(self):
+        self._csv = csv.writer(self.writer)
+        self._csv.writerow(Track.COLUMNS)
+
+    def write(self, point: Dict[str, float]):
+        num = self._num
+        row = [self._time(point['time'])]
+        for col in Track.COLUMNS[1:]:
+            val = point.get(col)
+            row.append('' if val is None else num(col, val))
+        self._csv.writerow(row)
+
+
+class GpxWriter(TrackpointWriter):
+    """Writes trackpoints as a GPX 1.1 track, with the heart rate and cadence
+    in the Garmin track point extension and the power as a ``power``
+    extension.  Trackpoints without a position are left out.
+
+    """
+    def start(self):
+        w = self.writer.write
+        w('<?xml version="1.0" encoding="UTF-8"?>\n')
+        w('<gpx version="1.1" creator="garmdown" ' +
+          'xmlns="http://www.topografix.com/GPX/1/1" xmlns:gpxtpx=' +
+          '"http://www.garmin.com/xmlschemas/TrackPointExtension/v1">\n')
+        w(' <trk>\n')
+        if self.sport is not None:
+            w(f'  <type>{escape(self.sport)}</type>\n')
+        w('  <trkseg>\n')
+
+    def write(self, point: Dict[str, float]):
+        lat, lon = point.get('latitude'), point.get('longitude')
+        if lat is None or lon is None:
+            return
+        num = self._num
+        parts = [f'   <trkpt lat="{num("latitude", lat)}" ' +
+                 f'lon="{num("longitude", lon)}">']
+        if 'altitude' in point:
+            parts.append(f'<ele>{num("altitude", point["altitude"])}</ele>')
+        parts.append(f'<time>{self._time(point["time"])}</time>')
+        tpx = []
+        if 'heart_rate' in point:
+            tpx.append(f'<gpxtpx:hr>{num("heart_rate", point["heart_rate"])}' +
+                       '</gpxtpx:hr>')
+        if 'cadence' in point:
+            tpx.append(f'<gpxtpx:cad>{num("cadence", point["cadence"])}' +
+                       '</gpxtpx:cad>')
+        if 'power' in point or len(tpx) > 0:
+            parts.append('<extensions>')
+            if 'power' in point:
+                parts.append(f'<power>{num("power", point["power"])}</power>')
+            if len(tpx) > 0:
+                parts.append('<gpxtpx:TrackPointExtension>')
+                parts.extend(tpx)
+                parts.append('</gpxtpx:TrackPointExtension>')
+            parts.append('</extensions>')
+        parts.append('</trkpt>\n')
+        self.writer.write(''.join(parts))
+
+    def end(self):
+        self.writer.write('  </trkseg>\n </trk>\n</gpx>\n')
+
+
+class TcxWriter(TrackpointWriter):
+    """Writes trackpoints as a TCX activity with the trackpoints of each lap
+    in the lap, which is the one started most recently before the trackpoint.
+
+    """
+    SPORTS = {'running': 'Running', 'cycling': 'Biking'}
+    """Sport names to those of TCX, which are otherwise ``Other``."""
+
+    def start(self):
+        w = self.writer.write
+        w('<?xml version="1.0" encoding="UTF-8"?>\n')
+        w('<TrainingCenterDatabase xmlns=' +
+          '"http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2" ' +
+          'xmlns:ns3="http://www.garmin.com/xmlschemas/ActivityExtension/v2">'
+          + '\n')
+        w(' <Activities>\n')
+        w(f'  <Activity Sport="{self.SPORTS.get(self.sport, "Other")}">\n')
+        self._starts = tuple(map(
+            lambda lp: lp.start_time.replace(tzinfo=timezone.utc).timestamp()
+            if lp.start_time is not None else None, self.laps))
+        # the index of the next lap to write and whether its track is open
+        self._lap = 0
+        self._open = False
+        self._id = False
+
+    def _write_id(self, secs: float):
+        if not self._id:
+            self.writer.write(f'   <Id>{self._time(secs)}</Id>\n')
+            self._id = True
+
+    def _close_lap(self):
+        w = self.writer.write
+        lap = self.laps[self._lap - 1] \
+            if 0 < self._lap <= len(self.laps) else None
+        if self._open:
+            w('     </Track>\n')
+        if lap is not None and lap.power_average is not None:
+            w('     <Extensions><ns3:LX><ns3:AvgWatts>' +
+              f'{round(lap.power_average)}</ns3:AvgWatts></ns3:LX>' +
+              '</Extensions>\n')
+        w('    </Lap>\n')
+        self._open = False
+
+    def _open_lap(self, secs: float, track: bool):
+        """Start the next lap (or a lap of all trackpoints if there are no
+        laps) at ``secs``.
+
+        """
+        w = self.writer.write
+        lap = self.laps[self._lap] if self._lap < len(self.laps) else Lap(0)
+        self._lap += 1
+        if lap.start_time is not None:
+            secs = self._starts[self._lap - 1]
+        self._write_id(secs)
+        w(f'    <Lap StartTime="{self._time(secs)}">\n')
+        w(f'     <TotalTimeSeconds>{lap.total_seconds or 0:.1f}' +
+          '</TotalTimeSeconds>\n')
+        w(f'     <DistanceMeters>{lap.distance or 0:.2f}</DistanceMeters>\n')
+        w(f'     <Calories>{round(lap.calories or 0)}</Calories>\n')
+        for tag, val in (('AverageHeartRateBpm', lap.heart_rate_average),
+                         ('MaximumHeartRateBpm', lap.heart_rate_max)):
+            if val is not None:
+                w(f'     <{tag}><Value>{round(val)}</Value></{tag}>\n')
+        intensity = 'Resting' if lap.intensity == 'resting' else 'Active'
+        w(f'     <Intensity>{intensity}</Intensity>\n')
+        if lap.cadence is not None and self.sport != 'running':
+            w(f'     <Cadence>{round(lap.cadence)}</Cadence>\n')
+        w('     <TriggerMethod>Manual</TriggerMethod>\n')
+        if track:
+            w('     <Track>\n')
+        self._open = track
+
+    def write(self, point: Dict[str, float]):
+        secs = point['time']
+        starts = self._starts
+        if self._lap == 0:
+            self._open_lap(secs, True)
+        # start the laps that started by this point
+        while self._lap < len(starts) and starts[self._lap] is not None and \
+                starts[self._lap] <= secs:
+            self._close_lap()
+            self._open_lap(secs, True)
+        num = self._num
+        parts = [f'      <Trackpoint><Time>{self._time(secs)}</Time>']
+        lat, lon = point.get('latitude'), point.get('longitude')
+        if lat is not None and lon is not None:
+            parts.append('<Position><LatitudeDegrees>' +
+                         f'{num("latitude", lat)}</LatitudeDegrees>' +
+                         f'<LongitudeDegrees>{num("longitude", lon)}' +
+                         '</LongitudeDegrees></Position>')
+        for col, tag in (('altitude', 'AltitudeMeters'),
+                         ('distance', 'DistanceMeters')):
+            if col in point:
+                parts.append(f'<{tag}>{num(col, point[col])}</{tag}>')
+        if 'heart_rate' in point:
+            parts.append('<HeartRateBpm><Value>' +
+                         f'{num("heart_rate", point["heart_rate"])}' +
+                         '</Value></HeartRateBpm>')
+        running = self.sport == 'running'
+        if 'cadence' in point and not running:
+            parts.append(f'<Cadence>{num("cadence", point["cadence"])}' +
+                         '</Cadence>')
+        tpx = []
+        if 'speed' in point:
+            tpx.append(f'<ns3:Speed>{num("speed", point["speed"])}' +
+                       '</ns3:Speed>')
+        if 'cadence' in point and running:
+            tpx.append(f'<ns3:RunCadence>{num("cadence", point["cadence"])}' +
+                       '</ns3:RunCadence>')
+        if 'power' in point:
+            tpx.append(f'<ns3:Watts>{num("power", point["power"])}' +
+                       '</ns3:Watts>')
+        if len(tpx) > 0:
+            parts.append(f'<Extensions><ns3:TPX>{"".join(tpx)}</ns3:TPX>' +
+                         '</Extensions>')
+        parts.append('</Trackpoint>\n')
+        self.writer.write(''.join(parts))
+
+    def end(self):
+        # laps after the last trackpoint, or all laps if there are none
+        while self._lap < len(self.laps):
+            if self._lap > 0:
+                self._close_lap()
+            self._open_lap(0, False)
+        if self._lap > 0:
+            self._close_lap()
+        self._write_id(0)
+        self.writer.write('  </Activity>\n </Activities>\n' +
+                          '</TrainingCenterDatabase>\n')
+
+
+@dataclass
+class ActivityExporter(object):
+    """Writes downloaded activity files to the import directory in each of
+    :obj:`formats`.  The trackpoints of a file are streamed to the writers of
+    all converted formats in one pass without keeping its track or document.
+    Files that are newer than the downloaded file are up to date and are not
+    written again.
+
+    """
+    FORMATS = {'native': None, 'tcx': TcxWriter, 'gpx': GpxWriter,
+               'csv': CsvWriter, 'fit': None}
+    """The formats to the writers that convert to them, or ``None`` for those
+    that are only copied.
+
+    """
+    SUFFIXES = ('tcx', 'fit', 'gpx', 'csv')
+    """The file name extensions of all written formats."""
+
+    formats: Tuple[str] = field(default=('native',))
+    """The formats written, which are:
+
+      * ``native``: the downloaded TCX or FIT file as is
+      * ``tcx``: TCX, which is converted from FIT downloads
+      * ``gpx``: GPX 1.1 of the trackpoints with a position
+      * ``csv``: CSV of all trackpoints
+      * ``fit``: FIT downloads as is, which is skipped for TCX downloads
+
+    """
+    def __post_init__(self):
+        self.formats = tuple(self.formats)
+        bad = set(self.formats) - set(self.FORMATS.keys())
+        if len(bad) > 0:
+            raise GarmdownError(f'unknown import formats: {", ".join(bad)}')
+
+    def outputs(self, source: Path, import_dir: Path) -> Dict[Path, str]:
+        """Return the files written for a downloaded file to their format,
+        which is ``None`` for those copied.
+
+        """
+        suffix = source.suffix[1:]
+        outputs: Dict[Path, str] = {}
+        for fmt in self.formats:
+            if fmt == 'native':
+                fmt = suffix
+            elif fmt == 'fit' and suffix != 'fit':
+                continue
+            path = import_dir / f'{source.stem}.{fmt}'
+            outputs[path] = None if fmt == suffix else fmt
+        return outputs
+
+    def _convert(self, source: Path, outputs: Dict[Path, str]):
+        """Write the converted formats of a file in one pass over its
+        trackpoints.
+
+        """
+        sport: str = None
+        if source.suffix == '.fit':
+            with open(source, 'rb') as f:
+                sport, laps = FitReader().decode_summary(f.read())
+        elif 'tcx' in outputs.values():
+            laps = read_laps(source)
+        else:
+            laps = ()
+        files: List[TextIOBase] = []
+        writers: List[TrackpointWriter] = []
+        try:
+            for path, fmt in outputs.items():
+                f = open(path, 'w', newline='')
+                files.append(f)
+                writers.append(self.FORMATS[fmt](f, sport, laps))
+            for writer in writers:
+                writer.start()
+            points: Iterable[Dict[str, float]] = read_points(source)
+            for point in points:
+                for writer in writers:
+                    writer.write(point)
+            for writer in writers:
+                writer.end()
+        finally:
+            for f in files:
+                f.close()
+
+    def export(self, import_dir: Path, source: Path) -> Tuple[Path]:
+        """Write a downloaded file in each of :obj:`formats` that is not up to
+        date.  Each file is written to a temporary file that is renamed when
+        all are written, so an interrupted export leaves no partial files.
+
+        :param import_dir: the directory of the written files
+
+        :param source: the downloaded activity file
+
+        :return: the files written
+
+        """
+        mtime = source.stat().st_mtime
+        outputs: Dict[Path, str] = {}
+        for path, fmt in self.outputs(source, import_dir).items():
+            if not path.exists() or path.stat().st_mtime < mtime:
+                outputs[path] = fmt
+        if len(outputs) == 0:
+            logger.debug(f'import files of {source} are up to date')
+            return ()
+        parts: Dict[Path, Path] = {
+            path: path.with_name(f'{path.name}.{os.getpid()}')
+            for path in outputs.keys()}
+        try:
+            converted = {parts[p]: f for p, f in outputs.items()
+                         if f is not None}
+            if len(converted) > 0:
+                self._convert(source, converted)
+            for path, fmt in outputs.items():
+                if fmt is None:
+                    shutil.copy(source, parts[path])
+            for path, part in parts.items():
+                part.replace(path)
+        finally:
+            for part in parts.values():
+                if part.exists():
+                    part.unlink()
+        logger.debug(f'wrote {", ".join(map(str, outputs.keys()))}')
+        return tuple(outputs.keys())
@@ -1,24 +1,67 @@
-"""Fetches activities and downloads TCX files from Garmin.
+"""Fetches activities and downloads TCX and FIT files from Garmin.
 
 """
 __author__ = 'Paul Landes'
 
+from typing import TYPE_CHECKING, Iterable, Tuple, Union, Callable, BinaryIO
 from dataclasses import dataclass, field
 import logging
 import itertools as it
+import os
+import re
+import time
+import threading
+import json
+import shutil
+import zipfile
+import tempfile
 from io import TextIOBase
-from garminexport.garminclient import GarminClient
+from pathlib import Path
 from zensols.persist import persisted
 from zensols.config import Settings
-from . import ActivityFactory
+from . import Activity, ActivityFactory
+
+if TYPE_CHECKING:
+    from garminexport.garminclient import GarminClient
 
 logger = logging.getLogger(__name__)
 
 
+@dataclass
+class RateLimiter(object):
+    """Spaces requests to Garmin Connect at least :obj:`interval` seconds apart,
+    which is shared by threads (i.e. fetchers of several accounts).
+
+    """
+    interval: float = field(default=0)
+    """The minimum number of seconds between requests."""
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self._next_time = 0
+
+    def wait(self):
+        """Block until the next request is allowed."""
+        if self.interval > 0:
+            with self._lock:
+                now = time.monotonic()
+                delay = self._next_time - now
+                self._next_time = max(now, self._next_time) + self.interval
+            if delay > 0:
+                logger.debug(f'rate limiting for {delay:.2f}s')
+                time.sleep(delay)
+
+
 @dataclass
 class Fetcher(object):
     """Downloads Garmin TXC files and activities (metadata).
 
+    """
+    AUTH_FAILURE = re.compile(r':\s*(?:401|403)\b|sso\.garmin\.com')
+    """Matches the status code in the error messages of the client library,
+    or a redirect to the login page, of requests that failed because the
+    session expired.
+
     """
     activity_factory: ActivityFactory = field()
     """Create activity instances."""
@@ -40,20 +83,152 @@ class Fetcher(object):
     """The max number of retries when accessing Garmin Connect before failing.
 
     """
+    rate_limiter: RateLimiter = field(default=None)
+    """Throttles requests to Garmin Connect, or ``None`` to not throttle."""
+
+    session_file: Path = field(default=None)
+    """Where the cookies of the login session are cached so later runs can
+    skip logging in, or ``None`` to always log in.
+
+    """
+    session_max_age: float = field(default=24)
+    """The number of hours a cached login session is reused."""
+
+    def __post_init__(self):
+        self._session_restored = False
+
+    def _throttle(self):
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait()
+
+    def _load_session(self, client: 'GarminClient') -> bool:
+        """Restore the cookies of a cached login session in to ``client``.
+
+        :return: whether a session was restored
+
+        """
+        import requests
+        path = self.session_file
+        if path is None or not path.is_file():
+            return False
+        try:
+            with open(path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f'could not read session file {path}: {e}')
+            return False
+        now = time.time()
+        if cache.get('username') != client.username:
+            logger.info('cached session is for a different user')
+            return False
+        if (now - cache['time']) > (self.session_max_age * 60 * 60):
+            logger.info('cached session has expired')
+            return False
+        session = requests.Session()
+        for cookie in cache['cookies']:
+            expires = cookie['expires']
+            if expires is None or expires > now:
+                session.cookies.set(
+                    cookie['name'], cookie['value'], domain=cookie['domain'],
+                    path=cookie['path'], expires=expires,
+                    secure=cookie['secure'])
+        client.session = session
+        return True
+
+    def _save_session(self, client: 'GarminClient'):
+        """Cache the cookies of the login session of ``client``, which is only
+        readable by the user since it holds credentials.
+
+        """
+        path = self.session_file
+        if path is None:
+            return
+        cookies = tuple(map(lambda c: {'name': c.name, 'value': c.value,
+                                       'domain': c.domain, 'path': c.path,
+                                       'expires': c.expires,
+                                       'secure': c.secure},
+                            client.session.cookies))
+        cache = {'username': client.username,
+                 'time': time.time(),
+                 'cookies': cookies}
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f)
+        os.chmod(path, 0o600)
+        logger.debug(f'saved session to {path}')
+
+    def _login(self, client: 'GarminClient'):
+        """Log in to Garmin Connect and cache the new session."""
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f'logging in with {client.username}')
+        client.connect()
+        self._session_restored = False
+        self._save_session(client)
+
     @property
-    @persisted('_client', cache_global=True)
-    def client(self) -> GarminClient:
+    @persisted('_client')
+    def client(self) -> 'GarminClient':
         """The client that manages the connection to the Garmin Connect server.
+        The client library is imported here so actions that only use the
+        database do not pay to load it.  A cached login session is reused
+        when available (see :obj:`session_file`).
+
         """
+        from garminexport.garminclient import GarminClient
         login = self.login
-        if logger.isEnabledFor(logging.INFO):
-            logger.info(f'logging in with {login.username}')
         client = GarminClient(login.username, login.password,
                               retry_delay=self.retry_delay,
                               max_retries=self.max_retries)
-        client.connect()
+        if self._load_session(client):
+            logger.info(f'reusing cached session for {login.username}')
+            self._session_restored = True
+        else:
+            self._login(client)
         return client
 
+    @classmethod
+    def _is_auth_failure(cls, e: Exception) -> bool:
+        """Return whether a request failed because the session expired, which
+        is an HTTP 401 or 403, or a redirect to the SSO login page.
+
+        """
+        res = getattr(e, 'response', None)
+        if res is not None:
+            url = str(getattr(res, 'url', ''))
+            return getattr(res, 'status_code', None) in {401, 403} or \
+                'sso.garmin.com' in url
+        return cls.AUTH_FAILURE.search(str(e)) is not None
+
+    def _invoke(self, method: Union[str, Callable], *args):
+        """Call a client method, logging in again and retrying once if it fails
+        authentication on the first call of a restored session, which might
+        have been expired by Garmin.  Other failures are raised.
+
+        :param method: the name of the client method, or a callable that is
+                       given the client as the first argument
+
+        """
+        def call():
+            if isinstance(method, str):
+                return getattr(client, method)(*args)
+            return method(client, *args)
+
+        self._throttle()
+        client = self.client
+        try:
+            res = call()
+        except Exception as e:
+            if not self._session_restored or not self._is_auth_failure(e):
+                raise e
+            logger.info(f'cached session failed ({e})--logging in again')
+            self._login(client)
+            self._throttle()
+            return call()
+        # the restored session is good once a call succeeds
+        self._session_restored = False
+        return res
+
     def _iterate_activities(self, index: int, chunk_size: int):
         """Yield downloaded activities.
 
@@ -63,30 +238,94 @@ class Fetcher(object):
 
         """
         afactory = self.activity_factory
-        search = self.client.fetch_activities(index, chunk_size)
+        search = self._invoke('fetch_activities', index, chunk_size)
         for item in search:
             activity = afactory.create(item)
             logger.debug(f'activity: {activity}')
             yield activity
 
-    def get_activities(self, limit: int = None, start_index: int = 0):
-        """Download and return ``limit`` activities.
+    def get_activity_pages(self, limit: int = None, start_index: int = 0) -> \
+            Iterable[Tuple[int, Tuple[Activity]]]:
+        """Download ``limit`` activities a page at a time.  Iteration stops
+        early when the end of the account's history is reached.
 
         :param limit: the number of activities to download
         :param start_index: the 0 based activity index (not contiguous page
             based)
+
+        :return: tuples of the page's start index and its activities
         """
         activity_chunk_size = self.download.activity_chunk_size
         activity_num = self.download.activity_num
         if limit is None:
             limit = activity_chunk_size
-        al = map(lambda x: self._iterate_activities(x, activity_chunk_size),
-                 range(start_index, activity_num, activity_chunk_size))
-        return it.islice(it.chain(*al), limit)
+        end_index = min(start_index + limit, activity_num)
+        for index in range(start_index, end_index, activity_chunk_size):
+            size = min(activity_chunk_size, end_index - index)
+            page = tuple(self._iterate_activities(index, size))
+            yield index, page
+            if len(page) < size:
+                end = index + len(page)
+                logger.info(f'reached end of activities at {end}')
+                break
+
+    def get_activities(self, limit: int = None, start_index: int = 0):
+        """Download and return ``limit`` activities.
+
+        :param limit: the number of activities to download
+        :param start_index: the 0 based activity index (not contiguous page
+            based)
+        """
+        pages = self.get_activity_pages(limit, start_index)
+        return it.chain.from_iterable(map(lambda p: p[1], pages))
 
     def download_tcx(self, activity_id: int, writer: TextIOBase):
         """Download the TCX file for ``activity`` and dump the contents to ``writer``.
 
         """
-        content: str = self.client.get_activity_tcx(activity_id)
+        content: str = self._invoke('get_activity_tcx', activity_id)
         writer.write(content)
+
+    def _fetch_original(self, client: 'GarminClient', activity_id: int) -> \
+            BinaryIO:
+        """Return the zip archive of the original activity file spooled to a
+        temporary file, or ``None`` if the activity has no original file.
+
+        """
+        url = self.download.original_url.format(activity_id)
+        res = client.session.get(url, stream=True)
+        try:
+            # Garmin gives 404 for activities without a file source; server
+            # errors are raised so the download is retried
+            if res.status_code == 404:
+                return None
+            res.raise_for_status()
+            spool = tempfile.SpooledTemporaryFile(max_size=1 << 20)
+            for chunk in res.iter_content(chunk_size=1 << 16):
+                spool.write(chunk)
+            spool.seek(0)
+            return spool
+        finally:
+            res.close()
+
+    def download_fit(self, activity_id: int, writer: BinaryIO) -> bool:
+        """Download the original FIT file of an activity and write it to
+        ``writer``.  The zip archive given by Garmin is streamed to a
+        temporary file, which stays in memory unless large, and the FIT file
+        is extracted from it a chunk at a time.
+
+        :return: whether the activity has an original FIT file, which is not
+                 the case for manually entered activities or those uploaded
+                 in another format
+
+        """
+        spool = self._invoke(self._fetch_original, activity_id)
+        if spool is None:
+            return False
+        with spool, zipfile.ZipFile(spool) as zf:
+            for info in zf.infolist():
+                if info.filename.lower().endswith('.fit'):
+                    with zf.open(info) as f:
+                        shutil.copyfileobj(f, writer)
+                    return True
+        return False
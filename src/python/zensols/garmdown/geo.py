@@ -0,0 +1,158 @@
+"""A grid index of where activities went from the positions of their tracks.
+
+"""
+__author__ = 'Paul Landes'
+
+from typing import Tuple, List, Iterable
+from dataclasses import dataclass, field
+import logging
+import math
+from pathlib import Path
+from . import GarmdownError, Track, read_track
+
+logger = logging.getLogger(__name__)
+
+GeoBox = Tuple[float, float, float, float]
+"""A bounding box as the minimum latitude, minimum longitude, maximum latitude
+and maximum longitude in degrees.
+
+"""
+
+
+@dataclass
+class GeoGrid(object):
+    """Divides the earth in to cells of :obj:`cell_size` degrees of latitude
+    and longitude.  The integer ID of a cell increases with longitude and then
+    latitude, so the cells of a row of a bounding box are a range of IDs,
+    which are looked up with one index range scan.
+
+    """
+    EARTH_RADIUS = 6371008.8
+    """The mean radius of the earth in meters."""
+
+    cell_size: float = field(default=0.005)
+    """The width and height of a cell in degrees, where 0.005 degrees of
+    latitude is about 550 meters.
+
+    """
+    def __post_init__(self):
+        if not 0 < self.cell_size <= 1:
+            raise GarmdownError(f'bad geo cell size: {self.cell_size}')
+        self._columns = math.ceil(360 / self.cell_size)
+        self._rows = math.ceil(180 / self.cell_size)
+
+    def _row(self, lat: float) -> int:
+        return min(max(math.floor((lat + 90) / self.cell_size), 0),
+                   self._rows - 1)
+
+    def _column(self, lon: float) -> int:
+        return min(max(math.floor((lon + 180) / self.cell_size), 0),
+                   self._columns - 1)
+
+    def cell(self, lat: float, lon: float) -> int:
+        """Return the ID of the cell of a position."""
+        return self._row(lat) * self._columns + self._column(lon)
+
+    def track_cells(self, track: Track) -> Tuple[Tuple[int], GeoBox]:
+        """Return the cells a track passes through and its bounding box, or
+        ``None`` for the box of a track without positions.
+
+        """
+        cells = set()
+        box = None
+        lats, lons = track.latitude, track.longitude
+        valid = tuple(filter(
+            lambda p: not (math.isnan(p[0]) or math.isnan(p[1])),
+            zip(lats, lons)))
+        if len(valid) > 0:
+            cell = self.cell
+            cells.update(map(lambda p: cell(*p), valid))
+            plats = tuple(map(lambda p: p[0], valid))
+            plons = tuple(map(lambda p: p[1], valid))
+            box = (min(plats), min(plons), max(plats), max(plons))
+        return tuple(sorted(cells)), box
+
+    def read_cells(self, path: Path) -> Tuple[Tuple[int], GeoBox]:
+        """Like :meth:`track_cells` but read the track from a downloaded
+        activity file.
+
+        """
+        return self.track_cells(read_track(path))
+
+    def box_ranges(self, box: GeoBox) -> List[Tuple[int, int]]:
+        """Return the first and last cell ID of each row of cells that
+        overlaps a bounding box.
+
+        """
+        min_lat, min_lon, max_lat, max_lon = box
+        if min_lat > max_lat or min_lon > max_lon:
+            raise GarmdownError(f'bad bounding box: {box}')
+        first, last = self._column(min_lon), self._column(max_lon)
+        cols = self._columns
+        return list(map(lambda r: (r * cols + first, r * cols + last),
+                        range(self._row(min_lat), self._row(max_lat) + 1)))
+
+    def near_box(self, lat: float, lon: float, radius: float) -> GeoBox:
+        """Return the bounding box of the circle of ``radius`` meters around a
+        position.
+
+        """
+        dlat = math.degrees(radius / self.EARTH_RADIUS)
+        coslat = max(math.cos(math.radians(min(abs(lat) + dlat, 90))), 1e-6)
+        dlon = min(dlat / coslat, 180)
+        return (max(lat - dlat, -90), max(lon - dlon, -180),
+                min(lat + dlat, 90), min(lon + dlon, 180))
+
+    def near_ranges(self, lat: float, lon: float, radius: float) -> \
+            List[Tuple[int, int]]:
+        """Return the first and last cell ID of each row of cells that
+        overlaps the circle of ``radius`` meters around a position.
+
+        """
+        size = self.cell_size
+        meters = math.radians(self.EARTH_RADIUS)
+        cols = self._columns
+        ranges = []
+        min_lat, _, max_lat, _ = self.near_box(lat, lon, radius)
+        for row in range(self._row(min_lat), self._row(max_lat) + 1):
+            south = row * size - 90
+            north = south + size
+            # the latitude in the row closest to the position
+            near = min(max(lat, south), north)
+            dy = abs(lat - near) * meters
+            if dy > radius:
+                continue
+            half = math.sqrt(radius ** 2 - dy ** 2)
+            coslat = max(math.cos(math.radians(near)), 1e-6)
+            dlon = min(half / (meters * coslat), 180)
+            ranges.append((row * cols + self._column(lon - dlon),
+                           row * cols + self._column(lon + dlon)))
+        return ranges
+
+    def clip(self, ranges: Iterable[Tuple[int, int]],
+             box: GeoBox) -> List[Tuple[int, int]]:
+        """Return the part of the cell ranges of rows (see :meth:`box_ranges`)
+        in a bounding box.
+
+        """
+        min_lat, min_lon, max_lat, max_lon = box
+        first_row, last_row = self._row(min_lat), self._row(max_lat)
+        first, last = self._column(min_lon), self._column(max_lon)
+        cols = self._columns
+        clipped = []
+        for lo, hi in ranges:
+            row = lo // cols
+            if first_row <= row <= last_row:
+                lo = max(lo, row * cols + first)
+                hi = min(hi, row * cols + last)
+                if lo <= hi:
+                    clipped.append((lo, hi))
+        return clipped
+
+    @staticmethod
+    def parse_position(text: str) -> Tuple[float, ...]:
+        """Parse comma separated degrees, such as ``45.52,-122.68``."""
+        try:
+            return tuple(map(float, text.split(',')))
+        except ValueError:
+            raise GarmdownError(f'bad position (need lat,lon): {text}')
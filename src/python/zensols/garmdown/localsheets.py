@@ -0,0 +1,328 @@
+"""A local stand-in for Google Sheets and a benchmark of the sheet sync.
+
+"""
+__author__ = 'Paul Landes'
+
+from typing import Dict, Tuple, List, Any
+from dataclasses import dataclass, field, replace
+import logging
+import sys
+import os
+import re
+import time
+import json
+import tempfile
+from io import TextIOBase
+from pathlib import Path
+from datetime import datetime, timedelta
+from . import GarmdownError, SheetUpdater
+
+logger = logging.getLogger(__name__)
+
+
+class _Request(object):
+    """A pending request, which is made by :meth:`execute` as with the Google
+    client.
+
+    """
+    def __init__(self, service: 'LocalSheetsService', method: str,
+                 params: Dict[str, Any]):
+        self.service = service
+        self.method = method
+        self.params = params
+
+    def execute(self) -> Dict[str, Any]:
+        return self.service._execute(self.method, self.params)
+
+
+class _Values(object):
+    """The ``spreadsheets().values()`` resource."""
+    def __init__(self, service: 'LocalSheetsService'):
+        self.service = service
+
+    def get(self, **params) -> _Request:
+        return _Request(self.service, 'get', params)
+
+    def batchGet(self, **params) -> _Request:
+        return _Request(self.service, 'batchGet', params)
+
+    def update(self, **params) -> _Request:
+        return _Request(self.service, 'update', params)
+
+    def batchUpdate(self, **params) -> _Request:
+        return _Request(self.service, 'batchUpdate', params)
+
+
+class _Spreadsheets(object):
+    """The ``spreadsheets()`` resource."""
+    def __init__(self, service: 'LocalSheetsService'):
+        self.service = service
+
+    def values(self) -> _Values:
+        return _Values(self.service)
+
+
+@dataclass
+class LocalSheetsService(object):
+    """An in process implementation of the part of the Google Sheets API used
+    by :class:`.SheetUpdater`, which are the ``get``, ``batchGet``, ``update``
+    and ``batchUpdate`` methods of ``spreadsheets().values()``.  Cell values
+    are kept as text by spreadsheet ID and A1 cell name, and saved to
+    :obj:`path` after each update.  Each request is counted with the size of
+    its JSON, and is delayed by :obj:`latency` to approximate the round trip
+    to Google.
+
+    """
+    CELL_RANGE_REGEX = re.compile(
+        r'^(?:(.+)!)?([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?$')
+    """Parses the sheet name, first column and row, and last column and row of
+    a cell range.
+
+    """
+    path: Path = field(default=None)
+    """The JSON file with the cell values, or ``None`` to keep them only in
+    memory.
+
+    """
+    latency: float = field(default=0)
+    """The number of seconds each request takes."""
+
+    def __post_init__(self):
+        self.cells: Dict[str, Dict[str, str]] = {}
+        if self.path is not None and self.path.is_file():
+            with open(self.path) as f:
+                self.cells = json.load(f)
+        self.reset()
+
+    def reset(self):
+        """Clear the request statistics."""
+        self.requests: Dict[str, int] = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    @property
+    def request_count(self) -> int:
+        """The number of requests made since the last :meth:`reset`."""
+        return sum(self.requests.values())
+
+    def spreadsheets(self) -> _Spreadsheets:
+        return _Spreadsheets(self)
+
+    @staticmethod
+    def _column(name: str) -> int:
+        col = 0
+        for c in name:
+            col = col * 26 + ord(c) - ord('A') + 1
+        return col
+
+    @staticmethod
+    def _column_name(col: int) -> str:
+        name = ''
+        while col > 0:
+            col, rem = divmod(col - 1, 26)
+            name = chr(ord('A') + rem) + name
+        return name
+
+    def _parse_range(self, cell_range: str) -> \
+            Tuple[str, int, int, int, int]:
+        """Return the sheet name and the first and last (1 based) column and
+        row of a cell range.
+
+        """
+        m = self.CELL_RANGE_REGEX.match(cell_range)
+        if m is None:
+            raise GarmdownError(f'unsupported cell range: {cell_range}')
+        sheet, col, row, end_col, end_row = m.groups()
+        sheet = '' if sheet is None else sheet
+        end_col = col if end_col is None else end_col
+        end_row = row if end_row is None else end_row
+        return (sheet, self._column(col), int(row),
+                self._column(end_col), int(end_row))
+
+    def _cell(self, sheet: str, col: int, row: int) -> str:
+        return f'{sheet}!{self._column_name(col)}{row}'
+
+    def get_values(self, spreadsheet_id: str, cell_range: str) -> \
+            Dict[str, Any]:
+        """Return the cells of a range as the Google API does, which leaves out
+        empty cells at the end of rows and empty rows at the end.
+
+        """
+        cells = self.cells.get(spreadsheet_id, {})
+        sheet, col, row, end_col, end_row = self._parse_range(cell_range)
+        rows = []
+        for r in range(row, end_row + 1):
+            vals = [cells.get(self._cell(sheet, c, r), '')
+                    for c in range(col, end_col + 1)]
+            while len(vals) > 0 and vals[-1] == '':
+                vals.pop()
+            rows.append(vals)
+        while len(rows) > 0 and len(rows[-1]) == 0:
+            rows.pop()
+        res = {'range': cell_range, 'majorDimension': 'ROWS'}
+        if len(rows) > 0:
+            res['values'] = rows
+        return res
+
+    def set_values(self, spreadsheet_id: str, cell_range: str,
+                   values: List[List[Any]]):
+        """Set the cells of a range.  A ``None`` value leaves the cell as it is
+        and an empty string clears it.
+
+        """
+        cells = self.cells.setdefault(spreadsheet_id, {})
+        sheet, col, row, end_col, end_row = self._parse_range(cell_range)
+        for r, vals in enumerate(values, row):
+            for c, val in enumerate(vals, col):
+                if r > end_row or c > end_col:
+                    raise GarmdownError(
+                        f'values outside of range: {cell_range}')
+                cell = self._cell(sheet, c, r)
+                if val == '':
+                    cells.pop(cell, None)
+                elif val is not None:
+                    cells[cell] = str(val)
+
+    def save(self):
+        """Write the cell values to :obj:`path`."""
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(f'{self.path.name}.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(self.cells, f)
+            os.replace(tmp, self.path)
+
+    def _execute(self, method: str, params: Dict[str, Any]) -> \
+            Dict[str, Any]:
+        if self.latency > 0:
+            time.sleep(self.latency)
+        sid = params['spreadsheetId']
+        if method == 'get':
+            res = self.get_values(sid, params['range'])
+        elif method == 'batchGet':
+            res = {'spreadsheetId': sid,
+                   'valueRanges': list(map(lambda r: self.get_values(sid, r),
+                                           params['ranges']))}
+        elif method == 'update':
+            self.set_values(sid, params['range'], params['body']['values'])
+            res = {'spreadsheetId': sid, 'updatedRange': params['range']}
+        else:
+            data = params['body']['data']
+            for vr in data:
+                self.set_values(sid, vr['range'], vr['values'])
+            res = {'spreadsheetId': sid, 'totalUpdatedRows': sum(
+                map(lambda vr: len(vr['values']), data))}
+        if method in {'update', 'batchUpdate'}:
+            self.save()
+        self.requests[method] = self.requests.get(method, 0) + 1
+        self.bytes_sent += len(json.dumps(params))
+        self.bytes_received += len(json.dumps(res))
+        return res
+
+
+@dataclass
+class SheetBenchmarkResult(object):
+    """The cost of one :meth:`.SheetUpdater.sync` in a benchmark.
+
+    """
+    name: str = field()
+    """The name of the scenario."""
+
+    requests: Dict[str, int] = field()
+    """The number of requests by API method."""
+
+    bytes_sent: int = field()
+    """The size of the JSON of the requests."""
+
+    bytes_received: int = field()
+    """The size of the JSON of the responses."""
+
+    seconds: float = field()
+    """The wall time of the sync."""
+
+    def __str__(self):
+        reqs = ', '.join(map(lambda x: f'{x[0]}={x[1]}',
+                             sorted(self.requests.items())))
+        return (f'{self.name}: {sum(self.requests.values())} requests ' +
+                f'({reqs}), {self.bytes_sent} bytes sent, ' +
+                f'{self.bytes_received} received in {self.seconds:.3f}s')
+
+
+@dataclass
+class SheetBenchmark(object):
+    """Measures the requests, bytes and wall time of
+    :meth:`.SheetUpdater.sync` against a :class:`.LocalSheetsService` for a
+    full year catch up and for a one day incremental update, both with and
+    without the row index.  A copy of the configured updater is used with a
+    temporary database of synthesized activities, so neither the activity
+    database nor the spreadsheet are touched.
+
+    """
+    sheet_updater: SheetUpdater = field()
+    """The updater that is copied for the benchmark."""
+
+    latency: float = field(default=0.05)
+    """The number of seconds each request to the local service takes."""
+
+    def _activity(self, i: int, day: datetime) -> Dict[str, Any]:
+        """Synthesize the JSON of an activity of each sport in turn."""
+        atype = ('cycling', 'running', 'lap_swimming')[i % 3]
+        return {'activityId': 1000 + i,
+                'activityName': f'benchmark {i}',
+                'activityType': {'typeKey': atype},
+                'startTimeLocal': (day + timedelta(hours=7)).strftime(
+                    '%Y-%m-%d %H:%M:%S'),
+                'duration': 3700.0,
+                'movingDuration': 3600.0}
+
+    def _sync(self, updater: SheetUpdater, name: str) -> SheetBenchmarkResult:
+        service = updater.backend
+        service.reset()
+        t0 = time.time()
+        updater.sync()
+        return SheetBenchmarkResult(
+            name, dict(service.requests), service.bytes_sent,
+            service.bytes_received, time.time() - t0)
+
+    def _run_mode(self, tmp: Path, row_index: bool) -> \
+            Tuple[SheetBenchmarkResult]:
+        mode = 'indexed' if row_index else 'full read'
+        src = self.sheet_updater
+        persister = replace(src.persister, db_file=tmp / f'{mode}.sqlite3',
+                            archive_file=None)
+        service = LocalSheetsService(tmp / f'{mode}.json', self.latency)
+        updater = replace(src, persister=persister, backend=service,
+                          sheet_id='benchmark', row_index=row_index)
+        # fill the date column with a row per day ending today
+        m = updater.CELL_RANGE_REGEX.match(updater.date_cell_range)
+        if m is None or m.group(4) is None:
+            raise GarmdownError(
+                f'bad date cell range: {updater.date_cell_range}')
+        rows = int(m.group(4)) - int(m.group(3)) + 1
+        now = datetime.now()
+        today = datetime(now.year, now.month, now.day)
+        days = tuple(map(lambda i: today - timedelta(days=rows - i - 1),
+                         range(rows)))
+        service.set_values('benchmark', updater.date_cell_range,
+                           list(map(lambda d: [d.strftime('%m/%d/%Y')], days)))
+        factory = persister.activity_factory
+        acts = tuple(map(lambda x: factory.create(self._activity(*x)),
+                         enumerate(days)))
+        # all but today's activity are there for the catch up
+        persister.insert_activities(acts[:-1])
+        catch_up = self._sync(updater, f'{mode} catch up ({rows - 1} days)')
+        persister.insert_activities(acts[-1:])
+        incremental = self._sync(updater, f'{mode} incremental (1 day)')
+        return catch_up, incremental
+
+    def run(self) -> Tuple[SheetBenchmarkResult]:
+        """Run the benchmark scenarios."""
+        with tempfile.TemporaryDirectory(prefix='garmdown-') as tmp:
+            tmp = Path(tmp)
+            return self._run_mode(tmp, True) + self._run_mode(tmp, False)
+
+    def write(self, writer: TextIOBase = sys.stdout):
+        """Run the benchmark and write the results."""
+        writer.write(f'request latency: {self.latency}s\n')
+        for res in self.run():
+            writer.write(f'{res}\n')
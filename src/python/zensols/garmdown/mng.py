@@ -3,18 +3,48 @@
 """
 __author__ = 'Paul Landes'
 
+from typing import Dict, Tuple, List, Iterable, Callable, Any
 from dataclasses import dataclass, field
 import logging
 import sys
+import os
+import socket
+import time
+import itertools as it
 from io import TextIOBase
 from pathlib import Path
 from datetime import datetime
-import shutil
-from zensols.garmdown import Activity, Backuper, Persister, Fetcher
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, Future
+from zensols.garmdown import (
+    GarmdownError, Activity, Duplicate, ImportCheckpoint, SyncStats,
+    FsckReport, Backuper, Persister, Fetcher, Track, GeoGrid, SeriesPyramid,
+    DuplicateDetector, ActivityExporter, read_track, read_laps
+)
 
 logger = logging.getLogger(__name__)
 
 
+def _read_file(read: Callable[[Path], Any], path: Path) -> Tuple[Any, str]:
+    """Read an activity file in a pool process.  The error is returned rather
+    than raised so a bad file does not stop the others.
+
+    :return: what ``read`` returns (or ``None`` if it raised) and the error
+             (or ``None``)
+
+    """
+    try:
+        return read(path), None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+
+
+def _read_chunk(read: Callable[[Path], Any], paths: Tuple[Path]) -> \
+        List[Tuple[Any, str]]:
+    """Read activity files in a pool process (see :func:`_read_file`)."""
+    return list(map(partial(_read_file, read), paths))
+
+
 @dataclass
 class Manager(object):
     """Manages downloading and database work.  This includes downloading data from
@@ -43,86 +73,359 @@ class Manager(object):
 
     """
 
-    def sync_activities(self, limit: int = None, start_index: int = 0):
+    layout: str = field(default='flat')
+    """How TCX files are organized in :obj:`activities_dir`, which is one of:
+
+      * ``flat``: ``<date>_<id>.<format>``
+      * ``year``: ``<year>/<date>_<id>.<format>``
+      * ``month``: ``<year>/<month>/<date>_<id>.<format>``
+
+    Use :meth:`fsck` to move existing files after changing the layout.
+
+    """
+    download_format: str = field(default='tcx')
+    """The format of downloaded activity files, which is either ``tcx`` or
+    ``fit`` for the original file recorded by the device.  TCX is downloaded
+    for activities with no original FIT file.
+
+    """
+    claim_size: int = field(default=10)
+    """The number of activities claimed at a time to download (see
+    :meth:`sync_tcx`).
+
+    """
+    lease_seconds: float = field(default=600)
+    """The number of seconds a claim on activities to download lasts unless
+    renewed.
+
+    """
+    geo_grid: GeoGrid = field(default=None)
+    """The grid of the geo index of activity tracks, or ``None`` to not index
+    them (see :meth:`index_tracks`).
+
+    """
+    series_pyramid: SeriesPyramid = field(default=None)
+    """Downsamples the series of activity tracks to preview them, or ``None``
+    to not downsample them (see :meth:`build_series`).
+
+    """
+    read_workers: int = field(default=None)
+    """The number of processes that read laps, positions and series from
+    activity files, or ``None`` for one per CPU (see :meth:`_read_files`).
+
+    """
+    read_batch_size: int = field(default=200)
+    """The number of activity files whose data is committed at a time."""
+
+    duplicate_detector: DuplicateDetector = field(default=None)
+    """Finds activities recorded by more than one device after they are
+    added, or ``None`` to not look for them.
+
+    """
+    exporter: ActivityExporter = field(default=None)
+    """Writes the downloaded files to :obj:`import_dir` in each import format,
+    which defaults to copying them as is (see :meth:`import_tcx`).
+
+    """
+
+    LAYOUTS = frozenset('flat year month'.split())
+    FORMATS = ('tcx', 'fit')
+    POOL_MIN_FILES = 8
+    """The fewest activity files read by a process pool rather than in this
+    process.
+
+    """
+
+    def __post_init__(self):
+        if self.layout not in self.LAYOUTS:
+            raise GarmdownError(f'unknown activities layout: {self.layout}')
+        if self.download_format not in self.FORMATS:
+            raise GarmdownError(
+                f'unknown download format: {self.download_format}')
+        if self.exporter is None:
+            self.exporter = ActivityExporter()
+
+    @property
+    def worker(self) -> str:
+        """The name of this process used to claim activities to download."""
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def _update_edited(self, acts: Tuple[Activity]) -> int:
+        """Update the activities in ``acts`` that were edited in Garmin Connect
+        since they were added, which are found by comparing fingerprints of
+        their JSON.  Unchanged activities are not written.  If the start time,
+        moving time or distance changed, the recording was probably edited
+        (i.e. trimmed), so the downloaded and import files are removed and the
+        activity is downloaded and imported again.
+
+        :return: the number of activities updated
+
+        """
+        persister = self.persister
+        fingerprint = persister.codec.fingerprint
+        prints = persister.get_fingerprints(map(lambda a: a.id, acts))
+        edited: List[Activity] = []
+        redownload: List[str] = []
+        for act in acts:
+            state = prints.get(act.id)
+            if state is None or state[0] == fingerprint(act.raw):
+                continue
+            logger.info(f'activity {act} was edited')
+            edited.append(act)
+            old_start, old_secs, old_dist = state[1:]
+            secs, dist = act.indexed_values()[0], act.raw.get('distance')
+            if (old_start, old_secs, old_dist) != (act.start_time, secs, dist):
+                date_str = old_start.strftime('%Y-%m-%d')
+                stem = f'{date_str}_{act.id}'
+                paths = [self._shard_dir(date_str) / f'{stem}.{fmt}'
+                         for fmt in self.FORMATS]
+                paths.extend(self.import_dir / f'{stem}.{fmt}'
+                             for fmt in ActivityExporter.SUFFIXES)
+                for path in paths:
+                    if path.exists():
+                        logger.info(f'removing edited activity {path}')
+                        path.unlink()
+                redownload.append(act.id)
+        if len(edited) > 0:
+            persister.update_activities(edited, redownload)
+        return len(edited)
+
+    def sync_activities(self, limit: int = None,
+                        start_index: int = None) -> SyncStats:
         """Download and add activities to the SQLite database.  Note that this does not
-        download the TCX files.
+        download the TCX files.  Activities already in the database that were
+        edited in Garmin Connect are updated (see :meth:`_update_edited`).
+
+        Each page of activities is committed and followed by a checkpoint in
+        the database.  If a previous import was interrupted, it is resumed from
+        its checkpoint when ``start_index`` is not given.  A resumed import
+        downloads at most ``limit`` activities, and the checkpoint is kept
+        until all of the interrupted import is downloaded.
 
-        :param limit: the number of activities to download
+        :param limit: the number of activities to download, which defaults to
+                      the rest of an interrupted import
 
         :param start_index: the 0 based activity index (not contiguous page
                             based)
 
+        :return: the number of activities added and updated
+
         """
-        # acts will be an iterable
-        acts = self.fetcher.get_activities(limit, start_index)
-        self.persister.insert_activities(acts)
+        persister = self.persister
+        stats = SyncStats()
+        checkpoint: ImportCheckpoint = None
+        if start_index is None:
+            checkpoint = persister.get_import_checkpoint()
+            if checkpoint is None:
+                start_index = 0
+            else:
+                start_index = checkpoint.start_index
+                if limit is None or limit > checkpoint.remaining:
+                    limit = checkpoint.remaining
+                logger.info(f'resuming activity import from {checkpoint} ' +
+                            f'with {limit} activities')
+        if limit is None:
+            limit = self.fetcher.download.activity_chunk_size
+        end_index = start_index + limit
+        # a limited resume leaves the rest of the import in the checkpoint
+        import_end = end_index if checkpoint is None else checkpoint.end_index
+        position = start_index
+        for index, acts in self.fetcher.get_activity_pages(limit, start_index):
+            stats.updated += self._update_edited(acts)
+            stats.activities += persister.insert_activities(acts)
+            position = index + len(acts)
+            persister.set_import_checkpoint(
+                ImportCheckpoint(position, import_end))
+        # stopping short of the end is the end of the account's history
+        if position < end_index or position >= import_end:
+            persister.clear_import_checkpoint()
+        return stats
 
     @staticmethod
-    def _tcx_filename(activity):
+    def _activity_filename(activity: Activity, fmt: str) -> str:
         """Format a (non-directory) file name for ``activity``."""
-        return f'{activity.start_date_str}_{activity.id}.tcx'
+        return f'{activity.start_date_str}_{activity.id}.{fmt}'
 
-    def _write_activity(self, act: Activity):
-        dl_dir = self.activities_dir
-        dl_path = Path(dl_dir, self._tcx_filename(act))
-        if dl_path.exists():
-            logger.warning(f'activity {act.id} is downloaded ' +
-                           'but not marked--marking now')
-        else:
-            logger.debug(f'downloading {dl_path}')
-            with open(dl_path, 'w') as f:
-                self.fetcher.download_tcx(act.id, f)
-            sr = dl_path.stat()
+    def _shard_dir(self, date_str: str) -> Path:
+        """Return the directory of a file per :obj:`layout`.
+
+        :param date_str: the start date of the activity as ``yyyy-mm-dd``
+
+        """
+        if self.layout == 'year':
+            return self.activities_dir / date_str[:4]
+        elif self.layout == 'month':
+            return self.activities_dir / date_str[:4] / date_str[5:7]
+        return self.activities_dir
+
+    def _activity_path(self, activity: Activity, fmt: str) -> Path:
+        """Return the path of the downloaded file of ``activity``."""
+        return self._shard_dir(activity.start_date_str) / \
+            self._activity_filename(activity, fmt)
+
+    def _find_download(self, activity: Activity) -> Path:
+        """Return the path of the downloaded file of ``activity`` in any
+        format, or the path in :obj:`download_format` if not downloaded.
+
+        """
+        fmts = sorted(self.FORMATS, key=lambda f: f != self.download_format)
+        paths = tuple(map(lambda f: self._activity_path(activity, f), fmts))
+        for path in paths:
+            if path.exists():
+                return path
+        return paths[0]
+
+    def _scan_activities_dir(self) -> Dict[str, List[Path]]:
+        """Return the file names without extension to the paths of all
+        activity files in the activities directory in a single pass over all
+        layouts.  An activity has more than one file when it was downloaded
+        in each format, and the file in :obj:`download_format` is first.
+
+        """
+        suffixes = set(map(lambda f: f'.{f}', self.FORMATS))
+        preferred = f'.{self.download_format}'
+        files: Dict[str, List[Path]] = {}
+        dirs = [self.activities_dir] if self.activities_dir.is_dir() else []
+        while len(dirs) > 0:
+            with os.scandir(dirs.pop()) as entries:
+                for ent in entries:
+                    if ent.is_dir(follow_symlinks=False):
+                        dirs.append(ent.path)
+                    else:
+                        stem, suffix = os.path.splitext(ent.name)
+                        if suffix in suffixes:
+                            files.setdefault(stem, []).append(Path(ent.path))
+        for paths in files.values():
+            paths.sort(key=lambda p: (p.suffix != preferred, str(p)))
+        return files
+
+    def _download(self, act: Activity, fmt: str) -> bool:
+        """Download the file of an activity in format ``fmt``.
+
+        :return: whether the activity has a file in the format
+
+        """
+        dl_path = self._activity_path(act, fmt)
+        logger.debug(f'downloading {dl_path}')
+        dl_path.parent.mkdir(parents=True, exist_ok=True)
+        # download to a temporary file so no other process sees a partial
+        # file as downloaded
+        part_path = dl_path.with_name(f'{dl_path.name}.{os.getpid()}')
+        try:
+            if fmt == 'fit':
+                with open(part_path, 'wb') as f:
+                    if not self.fetcher.download_fit(act.id, f):
+                        return False
+            else:
+                with open(part_path, 'w') as f:
+                    self.fetcher.download_tcx(act.id, f)
+            sr = part_path.stat()
             logger.debug(f'{dl_path} has size {sr.st_size}')
             if sr.st_size < self.download_min_size:
                 m = f'downloaded file {dl_path} has size ' + \
                     f'{sr.st_size} < {self.download_min_size}'
                 raise ValueError(m)
+            part_path.replace(dl_path)
+            return True
+        finally:
+            if part_path.exists():
+                part_path.unlink()
 
-    def sync_tcx(self, limit: int = None):
+    def _write_activity(self, act: Activity):
+        if self._find_download(act).exists():
+            logger.warning(f'activity {act.id} is downloaded ' +
+                           'but not marked--marking now')
+        elif not self._download(act, self.download_format):
+            logger.info(f'activity {act.id} has no original FIT file--' +
+                        'downloading TCX')
+            self._download(act, 'tcx')
+
+    def read_track(self, activity: Activity) -> Track:
+        """Read the trackpoints of the downloaded file of ``activity``."""
+        path = self._find_download(activity)
+        if not path.exists():
+            raise GarmdownError(f'activity {activity.id} is not downloaded')
+        return read_track(path)
+
+    def sync_tcx(self, limit: int = None) -> int:
         """Download TCX files and record each succesful download as such in the
         database.
 
+        Activities are claimed :obj:`claim_size` at a time before they are
+        downloaded so several processes, possibly on different hosts, can
+        download from the same database without downloading the same files.
+        The claims are renewed while downloading, released when this method
+        exits, and taken over by others after :obj:`lease_seconds` if this
+        process dies.
+
         :param limit: the maximum number of TCX files to download, which
-                      defaults to all
+                      defaults to the persister's ``tcx_chunk_size``
+
+        :return: the number of TCX files downloaded
 
         """
         persister = self.persister
-        acts = persister.get_missing_downloaded(limit)
-        logger.info(f'downloading {len(acts)} tcx files')
-        act: Activity
-        for act in acts:
-            self._write_activity(act)
-            persister.mark_downloaded(act)
-
-    def import_tcx(self, limit: int = None):
-        """Download TCX files and record each succesful download as such in the
-        database.
-
-        :param limit: the maximum number of TCX files to download, which
+        worker = self.worker
+        lease = self.lease_seconds
+        if limit is None:
+            limit = persister.tcx_chunk_size
+        downloaded = 0
+        try:
+            while downloaded < limit:
+                acts = persister.claim_downloads(
+                    worker, min(self.claim_size, limit - downloaded), lease)
+                if len(acts) == 0:
+                    break
+                logger.info(f'downloading {len(acts)} tcx files')
+                renewed = time.time()
+                for i, act in enumerate(acts):
+                    if time.time() - renewed > lease / 2:
+                        ids = tuple(map(lambda a: a.id, acts[i:]))
+                        persister.renew_claims(worker, ids, lease)
+                        renewed = time.time()
+                    self._write_activity(act)
+                    persister.mark_downloaded(act)
+                    downloaded += 1
+        finally:
+            persister.release_claims(worker)
+        logger.info(f'downloaded {downloaded} tcx files')
+        return downloaded
+
+    def import_tcx(self, limit: int = None) -> int:
+        """Write the downloaded files of activities not yet imported to
+        :obj:`import_dir` in each format of :obj:`exporter`, and record each
+        as imported in the database.  The files are converted by a pool of
+        processes (see :meth:`_read_files`).  An activity is recorded as
+        imported only after all of its formats are written, so those that
+        failed are written on the next invocation, and files that are already
+        up to date are not written again.
+
+        :param limit: the maximum number of activities to import, which
             defaults to all
 
+        :return: the number of activities imported
+
         """
         persister = self.persister
-        dl_dir = self.activities_dir
         import_dir = self.import_dir
         if not import_dir.exists():
             logger.info(f'creating imported directory {import_dir}')
             import_dir.mkdir(parents=True)
-        acts = persister.get_missing_imported(limit)
-        logger.info(f'importing {len(acts)} activities')
-        act: Activity
-        for act in acts:
-            fname = self._tcx_filename(act)
-            dl_path = Path(dl_dir, fname)
-            import_path = Path(import_dir, fname)
-            if import_path.exists():
-                logger.warning(f'activity {act.id} is imported ' +
-                               'but not marked--marking now')
-            else:
-                logger.info(f'copying {dl_path} -> {import_path}')
-                shutil.copy(dl_path, import_path)
-            persister.mark_imported(act)
+        # mark after streaming since the read cursor blocks writes, and files
+        # written but not marked are up to date on the next invocation
+        pending = tuple(map(lambda a: (a.id, a.start_time),
+                            persister.stream_missing_imported(limit)))
+
+        def store(batch: List[Tuple[str, Tuple[Path], str]]) -> int:
+            ids = tuple(map(lambda r: r[0],
+                            filter(lambda r: r[2] is None, batch)))
+            if len(ids) > 0:
+                persister.set_imported(ids)
+            return len(ids)
+
+        return self._read_files(
+            pending, partial(self.exporter.export, import_dir), store,
+            'imports')
 
     def import_tcx_from_date(self, date: datetime):
         """Import TCX files from the database starting on or after ``date``.
@@ -135,16 +438,183 @@ class Manager(object):
         for act in self.persister.get_activities_on_after_date(date):
             self._write_activity(act)
 
-    def sync(self, limit=None):
-        """Sync activitives and TCX files.
+    def _read_files(self, pending: Tuple[Tuple[str, datetime]],
+                    read: Callable[[Path], Any],
+                    store: Callable[[List[Tuple[str, Any, str]]], int],
+                    name: str) -> int:
+        """Read downloaded activity files and store what was read in the
+        database.  The activities directory is scanned once and the files are
+        read by a pool of :obj:`read_workers` processes.  What was read is
+        stored every :obj:`read_batch_size` files, so an interrupted backfill
+        resumes with the files not yet stored.
+
+        :param pending: the ID and start time of the activities to read
+
+        :param read: reads a file (in a pool process), so it must pickle
+
+        :param store: stores the activity ID, what ``read`` returned and the
+                      error reading the file of each activity, and returns the
+                      number of items stored
+
+        :param name: what is read, which is used for logging
+
+        :return: the sum of what ``store`` returned
+
+        """
+        if len(pending) == 0:
+            return 0
+        files: Dict[str, List[Path]] = self._scan_activities_dir()
+        ids: List[str] = []
+        paths: List[Path] = []
+        missing: List[str] = []
+        for aid, start_time in pending:
+            found = files.get(f'{start_time.strftime("%Y-%m-%d")}_{aid}')
+            if found is None:
+                missing.append(aid)
+            else:
+                ids.append(aid)
+                paths.append(found[0])
+        if len(missing) > 0:
+            logger.warning(f'{len(missing)} activities marked downloaded ' +
+                           f'have no file to read {name} (run fsck --fix): ' +
+                           ', '.join(missing[:10]) +
+                           (', ...' if len(missing) > 10 else ''))
+        workers = self.read_workers or os.cpu_count() or 1
+        logger.info(f'reading {name} of {len(paths)} activity files')
+        reader = partial(_read_file, read)
+        pool: ProcessPoolExecutor = None
+        if workers > 1 and len(paths) >= self.POOL_MIN_FILES:
+            pool = ProcessPoolExecutor(workers)
+        futures: List[Future] = []
+        added = 0
+        try:
+            results: Iterable[Tuple[Any, str]]
+            if pool is None:
+                results = map(reader, paths)
+            else:
+                chunk = max(1, min(32, len(paths) // (workers * 4)))
+                for i in range(0, len(paths), chunk):
+                    futures.append(pool.submit(
+                        _read_chunk, read, tuple(paths[i:i + chunk])))
+                results = it.chain.from_iterable(
+                    map(lambda f: f.result(), futures))
+            batch: List[Tuple[str, Any, str]] = []
+            for aid, path, (res, error) in zip(ids, paths, results):
+                if error is not None:
+                    logger.warning(f'can not read {name} of {path}: {error}')
+                batch.append((aid, res, error))
+                if len(batch) >= self.read_batch_size:
+                    added += store(batch)
+                    batch.clear()
+            if len(batch) > 0:
+                added += store(batch)
+        finally:
+            if pool is not None:
+                # cancel the chunks not started when storing fails
+                for future in futures:
+                    future.cancel()
+                pool.shutdown()
+        logger.info(f'added {added} {name}')
+        return added
+
+    def extract_laps(self, limit: int = None) -> int:
+        """Add the laps of downloaded activity files (including those of
+        archived activities) that have not been extracted to the database (see
+        :meth:`_read_files`).
+
+        :param limit: the maximum number of files to read, which defaults to
+                      all of them
+
+        :return: the number of laps added
+
+        """
+        persister = self.persister
+        return self._read_files(persister.get_laps_pending(limit), read_laps,
+                                persister.insert_laps, 'laps')
+
+    def index_tracks(self, limit: int = None) -> int:
+        """Add the cells of the positions of downloaded activity files
+        (including those of archived activities) that are not in the geo index
+        to the database (see :meth:`_read_files`).  Activities indexed with a
+        different :obj:`geo_grid` cell size are indexed again.
+
+        :param limit: the maximum number of files to read, which defaults to
+                      all of them
+
+        :return: the number of cells added
+
+        """
+        if self.geo_grid is None:
+            raise GarmdownError('no geo grid configured')
+        persister = self.persister
+        size = self.geo_grid.cell_size
+        return self._read_files(
+            persister.get_tracks_pending(size, limit),
+            self.geo_grid.read_cells,
+            partial(persister.insert_track_cells, size), 'track cells')
+
+    def build_series(self, limit: int = None) -> int:
+        """Add the downsampled series of downloaded activity files (including
+        those of archived activities) that have not been downsampled to the
+        database (see :meth:`_read_files`).  Activities downsampled with a
+        different :obj:`series_pyramid` configuration are downsampled again.
+
+        :param limit: the maximum number of files to read, which defaults to
+                      all of them
+
+        :return: the number of levels added
+
+        """
+        pyramid = self.series_pyramid
+        if pyramid is None:
+            raise GarmdownError('no series pyramid configured')
+        if not pyramid.available:
+            raise GarmdownError('numpy is needed for series')
+        persister = self.persister
+        return self._read_files(
+            persister.get_series_pending(pyramid.key, limit),
+            pyramid.read_levels,
+            partial(persister.insert_series, pyramid.key), 'series levels')
+
+    def find_duplicates(self, full: bool = False) -> Tuple[Duplicate]:
+        """Find activities recorded by more than one device (see
+        :class:`.DuplicateDetector`).
+
+        :param full: whether to check all activities rather than only those
+                     added or changed since the last check
+
+        :return: the duplicates found
+
+        """
+        if self.duplicate_detector is None:
+            raise GarmdownError('no duplicate detector configured')
+        return self.duplicate_detector.detect(full)
+
+    def sync(self, limit=None) -> SyncStats:
+        """Sync activitives and TCX files, find duplicate activities, and
+        extract the laps, geo index cells and downsampled series of the
+        downloaded files.
 
         :param limit: the number of activities to download and import, which
             defaults to the configuration values
 
+        :return: the counts of what was added
+
         """
-        self.sync_activities(limit)
-        self.sync_tcx(limit)
-        self.import_tcx()
+        stats: SyncStats = self.sync_activities(limit)
+        if self.duplicate_detector is not None:
+            self.duplicate_detector.detect()
+        stats.downloaded = self.sync_tcx(limit)
+        if stats.downloaded > 0:
+            # the most recent files, which are those just downloaded
+            self.extract_laps(stats.downloaded)
+            if self.geo_grid is not None:
+                self.index_tracks(stats.downloaded)
+            pyramid = self.series_pyramid
+            if pyramid is not None and pyramid.available:
+                self.build_series(stats.downloaded)
+        stats.imported = self.import_tcx()
+        return stats
 
     def clean_imported(self, limit=None):
         """Delete all TCX files from the import directory.  This is useful so that
@@ -158,6 +628,81 @@ class Manager(object):
                 logger.info(f'removing {path}')
                 path.unlink()
 
+    def fsck(self, fix: bool = False) -> FsckReport:
+        """Reconcile the activity files (of every format) in the activities
+        directory with the download state in the database.  The directory is
+        scanned once and compared with the database in bulk.
+
+        :param fix: if ``True``, move misplaced files to their directory per
+                    :obj:`layout` (which migrates to a new layout), mark
+                    activities with files as downloaded, and unmark those
+                    without files so they are downloaded again; orphan files
+                    are only reported
+
+        """
+        files: Dict[str, List[Path]] = self._scan_activities_dir()
+        report = FsckReport(files=sum(map(len, files.values())))
+        known = set()
+        for aid, start_time, download_time in \
+                self.persister.get_download_states():
+            date_str = start_time.strftime('%Y-%m-%d')
+            fname = f'{date_str}_{aid}'
+            known.add(fname)
+            paths = files.get(fname)
+            if paths is None:
+                if download_time is not None:
+                    report.missing.append(aid)
+            else:
+                if download_time is None:
+                    report.unmarked.append(aid)
+                shard_dir = self._shard_dir(date_str)
+                report.misplaced.extend(
+                    filter(lambda p: p.parent != shard_dir, paths))
+        for fname in sorted(set(files.keys()) - known):
+            report.orphans.extend(files[fname])
+        logger.info(f'found {report.files} files, clean: {report.clean}')
+        if fix:
+            for path in report.misplaced:
+                dst = self._shard_dir(path.name[:10]) / path.name
+                logger.debug(f'moving {path} -> {dst}')
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                path.rename(dst)
+                parent = path.parent
+                while parent != self.activities_dir and \
+                        not any(parent.iterdir()):
+                    parent.rmdir()
+                    parent = parent.parent
+            logger.info(f'moved {len(report.misplaced)} files')
+            if len(report.unmarked) > 0:
+                self.persister.set_downloaded(report.unmarked, True)
+            if len(report.missing) > 0:
+                self.persister.set_downloaded(report.missing, False)
+        return report
+
+    def archive(self) -> int:
+        """Move old downloaded and imported activities to the archive database,
+        then compact the database and backup the archive.
+
+        :return: the number of activities archived
+
+        """
+        persister = self.persister
+        moved = persister.archive_activities()
+        if moved > 0:
+            persister.compact()
+            self.backuper.backup_archive()
+        return moved
+
+    def write_duplicates(self, writer: TextIOBase = sys.stdout):
+        """Write the activities found recorded by more than one device and
+        the activity kept for each.
+
+        :param writer: the stream to output, which defaults to stdout
+
+        """
+        for dup in self.persister.get_duplicates():
+            writer.write(f'{dup}\n')
+
     def write_not_downloaded(self, detail: bool = False, limit: int = None,
                              writer: TextIOBase = sys.stdout):
         """Write human readable formatted data of all activities not yet downloaded.
@@ -170,7 +715,7 @@ class Manager(object):
 
         """
         act: Activity
-        for act in self.persister.get_missing_downloaded(limit):
+        for act in self.persister.stream_missing_downloaded(limit):
             act.write(writer, detail=detail)
 
     def write_not_imported(self, detail: bool = False,
@@ -184,5 +729,5 @@ class Manager(object):
 
         """
         act: Activity
-        for act in self.persister.get_missing_imported(limit):
+        for act in self.persister.stream_missing_imported(limit):
             act.write(writer, detail=detail)
@@ -0,0 +1,143 @@
+"""Syncs several Garmin Connect accounts concurrently.
+
+"""
+__author__ = 'Paul Landes'
+
+from typing import Dict, Tuple
+from dataclasses import dataclass, field, replace
+import logging
+import sys
+import time
+from io import TextIOBase
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from zensols.config import Settings
+from . import SyncStats, RateLimiter, Manager
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class AccountSyncResult(object):
+    """The outcome of syncing one account.
+
+    """
+    name: str = field()
+    """The name of the account."""
+
+    stats: SyncStats = field(default=None)
+    """What was added, or ``None`` if the sync failed."""
+
+    seconds: float = field(default=0)
+    """The wall time of the sync in seconds."""
+
+    error: Exception = field(default=None)
+    """The error that stopped the sync, if any."""
+
+    @property
+    def throughput(self) -> float:
+        """The number of activities and files processed per second."""
+        if self.stats is None or self.seconds == 0:
+            return 0
+        stats = self.stats
+        return (stats.activities + stats.updated + stats.downloaded +
+                stats.imported) / self.seconds
+
+    def __str__(self):
+        if self.error is not None:
+            return (f'{self.name}: failed after {self.seconds:.1f}s: ' +
+                    f'{self.error}')
+        return (f'{self.name}: {self.stats} in {self.seconds:.1f}s ' +
+                f'({self.throughput:.2f}/s)')
+
+
+@dataclass
+class MultiAccountSyncer(object):
+    """Syncs several Garmin Connect accounts concurrently.  Each account has its
+    own database, activities and backup directories under
+    :obj:`accounts_dir`, and its own Garmin client.  All accounts share a rate
+    limiter so together they do not make requests faster than a single
+    account would be allowed.
+
+    """
+    manager: Manager = field()
+    """The single account manager used as the template for each account."""
+
+    logins: Dict[str, Settings] = field()
+    """The account names to their login (``username`` and ``password``)."""
+
+    accounts_dir: Path = field()
+    """The directory with a sub directory of data for each account."""
+
+    concurrency: int = field(default=4)
+    """The maximum number of accounts synced at the same time."""
+
+    rate_limiter: RateLimiter = field(default=None)
+    """Throttles the requests to Garmin Connect across all accounts."""
+
+    def _create_manager(self, name: str, login: Settings) -> Manager:
+        """Create a manager that uses the account's own login and directories.
+
+        """
+        mng = self.manager
+        acct_dir = self.accounts_dir / name
+        session_file = mng.fetcher.session_file
+        if session_file is not None:
+            session_file = acct_dir / 'db' / session_file.name
+        fetcher = replace(mng.fetcher, login=login,
+                          rate_limiter=self.rate_limiter,
+                          session_file=session_file)
+        db_file = acct_dir / 'db' / mng.persister.db_file.name
+        archive_file = mng.persister.archive_file
+        if archive_file is not None:
+            archive_file = acct_dir / 'db' / archive_file.name
+        persister = replace(mng.persister, db_file=db_file,
+                            archive_file=archive_file)
+        backuper = replace(mng.backuper, persister=persister,
+                           backup_dir=acct_dir / 'db' / 'backup')
+        detector = mng.duplicate_detector
+        if detector is not None:
+            detector = replace(detector, persister=persister)
+        # accounts sync in threads, and forking a process pool from them can
+        # deadlock on locks other threads hold, so files are read in process
+        return replace(mng, fetcher=fetcher, persister=persister,
+                       backuper=backuper, duplicate_detector=detector,
+                       activities_dir=acct_dir / 'activities',
+                       import_dir=mng.import_dir / name, read_workers=1)
+
+    def _sync_account(self, name: str, limit: int) -> AccountSyncResult:
+        result = AccountSyncResult(name)
+        t0 = time.time()
+        try:
+            mng = self._create_manager(name, self.logins[name])
+            mng.activities_dir.mkdir(parents=True, exist_ok=True)
+            logger.info(f'syncing account {name}')
+            result.stats = mng.sync(limit)
+            mng.backuper.backup()
+        except Exception as e:
+            logger.error(f'could not sync account {name}: {e}', exc_info=True)
+            result.error = e
+        result.seconds = time.time() - t0
+        logger.info(f'synced {result}')
+        return result
+
+    def sync(self, limit: int = None) -> Tuple[AccountSyncResult]:
+        """Sync all accounts, at most :obj:`concurrency` at a time.  An account
+        that fails does not stop the others.
+
+        :param limit: the number of activities to download and import per
+                      account, which defaults to the configuration values
+
+        """
+        names = sorted(self.logins.keys())
+        logger.info(f'syncing {len(names)} accounts with ' +
+                    f'concurrency {self.concurrency}')
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            return tuple(pool.map(
+                lambda n: self._sync_account(n, limit), names))
+
+    def write_results(self, results: Tuple[AccountSyncResult],
+                      writer: TextIOBase = sys.stdout):
+        """Write the per account throughput of a :meth:`sync`."""
+        for res in results:
+            writer.write(f'{res}\n')
@@ -3,26 +3,119 @@
 """
 __author__ = 'Paul Landes'
 
-from typing import Tuple
-from dataclasses import dataclass, field
+from typing import Tuple, List, Set, Dict, Iterable, Union, Callable, Any
+from dataclasses import dataclass, field, replace
 import logging
 import sys
-from pathlib import Path
-from datetime import datetime
 import json
+import threading
+import functools
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
 import sqlite3
 from zensols.config import Settings
 from zensols.persist import resource
-from . import Activity, ActivityFactory, Backup
+from . import (
+    GarmdownError, Activity, ActivityFactory, Backup, ActivityQuery,
+    ImportCheckpoint, SheetRowIndex, RawCodec, Lap, ActivityLap, GeoGrid,
+    GeoBox, Duplicate
+)
 
 logger = logging.getLogger(__name__)
 
 
 class connection(resource):
+    """Gives the decorated :class:`.Persister` method a connection.  Unlike the
+    others, the shared connection (see :meth:`.Persister.shared_connection`)
+    is not closed after the method, so it is rolled back when the method
+    raises to discard its changes and release the database lock.
+
+    """
     def __init__(self):
         super(connection, self).__init__(
             '_create_connection', '_dispose_connection')
 
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def rollback(inst, conn, *args, **kwargs):
+            try:
+                return fn(inst, conn, *args, **kwargs)
+            except Exception:
+                if conn is inst._shared_conn:
+                    inst.rollback()
+                raise
+
+        return super(connection, self).__call__(rollback)
+
+
+class ActivityCache(object):
+    """A bounded least recently used cache of the activities read from the
+    database by ID.  The cache is emptied when the version of the activities
+    it was filled from changes, which is counted by database triggers on each
+    update of the activity JSON and deletion of an activity.  Since the
+    version is in the database, changes made by other processes are seen.
+
+    """
+    def __init__(self, size: int):
+        """Initialize.
+
+        :param size: the maximum number of activities to keep
+
+        """
+        self.size = size
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._acts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def validate(self, version: int):
+        """Empty the cache if ``version`` is not that of the cached activities.
+
+        """
+        with self._lock:
+            if version != self.version:
+                if len(self._acts) > 0:
+                    logger.debug(f'activities changed ({self.version} -> ' +
+                                 f'{version}): clearing cache')
+                self._acts.clear()
+                self.version = version
+
+    def get(self, id: str) -> Activity:
+        """Return the activity with ``id`` or ``None`` if it is not cached."""
+        with self._lock:
+            act = self._acts.get(id)
+            if act is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._acts.move_to_end(id)
+            return act
+
+    def put(self, id: str, act: Activity):
+        """Add an activity, which evicts the least recently used if full."""
+        with self._lock:
+            self._acts[id] = act
+            if len(self._acts) > self.size:
+                self._acts.popitem(last=False)
+
+    def clear(self):
+        """Remove all activities."""
+        with self._lock:
+            self._acts.clear()
+            self.version = None
+
+    def __len__(self) -> int:
+        return len(self._acts)
+
+    def __str__(self) -> str:
+        total = self.hits + self.misses
+        ratio = 0 if total == 0 else self.hits / total
+        return (f'{len(self)}/{self.size} cached activities, ' +
+                f'{self.hits} hits, {self.misses} misses ({ratio:.0%})')
+
 
 @dataclass
 class Persister(object):
@@ -41,10 +134,43 @@ class Persister(object):
     sql: Settings = field()
     """SQL queries."""
 
+    fetch_size: int = field(default=100)
+    """The number of rows read at a time by the ``stream_*`` methods."""
+
+    codec: RawCodec = field(default_factory=RawCodec)
+    """Encodes the raw activity JSON written to the database.  Rows are
+    decoded regardless of how they were encoded.
+
+    """
+    archive_file: Path = field(default=None)
+    """The SQLite file of activities moved out of :obj:`db_file` by
+    :meth:`archive_activities`, which is attached to connections only when a
+    query needs activities older than the archive boundary.
+
+    """
+    archive_age: int = field(default=365)
+    """The number of days after which :meth:`archive_activities` moves
+    downloaded and imported activities to :obj:`archive_file`.
+
+    """
+    cache_size: int = field(default=1000)
+    """The number of activities kept by :obj:`activity_cache`, or 0 to not
+    cache them.
+
+    """
+
+    def __post_init__(self):
+        self._shared_conn = None
+        self.activity_cache = ActivityCache(self.cache_size) \
+            if self.cache_size > 0 else None
+
     def _create_connection(self):
-        """Create a connection to the SQLite database (file).
+        """Create a connection to the SQLite database (file), or return the
+        connection shared by :meth:`shared_connection`.
 
         """
+        if self._shared_conn is not None:
+            return self._shared_conn
         logger.debug('creating connection')
         db_file = self.db_file
         created = False
@@ -63,19 +189,172 @@ class Persister(object):
                 logger.debug(f'invoking sql: {sql}')
                 conn.execute(sql)
                 conn.commit()
+        self._upgrade_database(conn)
         return conn
 
+    def _upgrade_database(self, conn):
+        """Apply the schema changes in ``upgrade_sql`` not yet applied to the
+        database, which are tracked by SQLite's ``user_version`` pragma.  Each
+        upgrade is either a key in the SQL settings or the name of a method in
+        this class that takes the connection.
+
+        """
+        upgrades = self.sql.upgrade_sql
+        version = conn.execute('pragma user_version').fetchone()[0]
+        if version < len(upgrades):
+            # schema changes are otherwise committed as they run, so a failed
+            # upgrade would leave them applied without the version bumped;
+            # the version is read again in case another process upgraded
+            conn.execute('begin immediate')
+            try:
+                version = conn.execute('pragma user_version').fetchone()[0]
+                if version < len(upgrades):
+                    logger.info(f'upgrading database from version {version} ' +
+                                f'to {len(upgrades)}')
+                for key in upgrades[version:]:
+                    if hasattr(self.sql, key):
+                        sql = getattr(self.sql, key)
+                        logger.debug(f'invoking sql: {sql}')
+                        conn.execute(sql)
+                    else:
+                        logger.debug(f'invoking upgrade: {key}')
+                        getattr(self, key)(conn)
+                conn.execute(f'pragma user_version = {len(upgrades)}')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def _backfill_indexed_columns(self, conn):
+        """Populate the indexed (queryable) columns from the raw JSON of the
+        activities persisted before the columns existed.
+
+        """
+        codec = self.codec
+        acts = map(lambda r: self.activity_factory.create(codec.decode(r[1])),
+                   conn.execute(self.sql.all_raw))
+        rows = map(lambda a: (*a.indexed_values(), a.id), acts)
+        conn.executemany(self.sql.update_act_indexed, tuple(rows))
+
+    def _backfill_fingerprints(self, conn):
+        """Populate the fingerprints of activities persisted before the column
+        existed.
+
+        """
+        codec = self.codec
+        rows = map(lambda r: (codec.fingerprint(codec.decode(r[1])), r[0]),
+                   conn.execute(self.sql.all_raw))
+        conn.executemany(self.sql.update_fingerprint, tuple(rows))
+
     def _dispose_connection(self, conn):
-        """Close the connection to the database."""
-        logger.debug(f'closing connection {conn} at {self.db_file}')
-        conn.close()
+        """Close the connection to the database unless it is shared."""
+        if conn is not self._shared_conn:
+            logger.debug(f'closing connection {conn} at {self.db_file}')
+            conn.close()
+
+    @contextmanager
+    def shared_connection(self):
+        """Use one connection for all database access in the context rather
+        than one per method call, which is useful for long running processes.
+        The connection is only usable by the thread that entered the context.
+
+        """
+        if self._shared_conn is not None:
+            yield self._shared_conn
+        else:
+            conn = self._create_connection()
+            self._shared_conn = conn
+            try:
+                yield conn
+            finally:
+                self._shared_conn = None
+                self._dispose_connection(conn)
+
+    def rollback(self):
+        """Discard the uncommitted changes of the shared connection (see
+        :meth:`shared_connection`), such as those of a write that failed, so
+        that it does not keep the database locked.
+
+        """
+        conn = self._shared_conn
+        if conn is not None and conn.in_transaction:
+            logger.warning('rolling back uncommitted database changes')
+            conn.rollback()
+
+    def _archive_boundary(self, conn) -> datetime:
+        """Return the start time before which activities might be in the
+        archive, or ``None`` if nothing has been archived.
+
+        """
+        row = conn.execute(self.sql.get_archive_before).fetchone()
+        return None if row is None else row[0]
+
+    def _attach_archive(self, conn, create: bool = False) -> bool:
+        """Attach :obj:`archive_file` as the ``archive`` schema to ``conn``,
+        which adds any columns the archive table is missing.
+
+        :param create: whether to create the archive if it does not exist
+
+        :return: whether the archive is attached
+
+        """
+        path = self.archive_file
+        if path is None or (not create and not path.is_file()):
+            return False
+        attached = map(lambda r: r[1], conn.execute('pragma database_list'))
+        if 'archive' in set(attached):
+            return True
+        logger.debug(f'attaching archive {path}')
+        conn.execute(self.sql.attach_archive, (str(path.absolute()),))
+        conn.execute(self.sql.create_archive_act)
+        cols = self._columns(conn, 'main')
+        have = set(self._columns(conn, 'archive'))
+        for col, ctype in filter(lambda c: c[0] not in have, cols.items()):
+            conn.execute(f'alter table archive.activity add column {col} ' +
+                         ctype)
+        for sql in self.sql.create_archive_idx:
+            conn.execute(getattr(self.sql, sql))
+        conn.commit()
+        return True
+
+    @staticmethod
+    def _day(date: datetime) -> datetime:
+        """Return the start of the day of ``date``."""
+        return datetime(date.year, date.month, date.day)
+
+    @staticmethod
+    def _columns(conn, schema: str):
+        """Return the column names to types of a schema's activity table."""
+        rows = conn.execute(f'pragma {schema}.table_info(activity)')
+        return {r[1]: r[2] for r in rows}
+
+    def _activity_sql(self, conn, sql: str,
+                      span: Union[bool, datetime]) -> str:
+        """Replace ``{activity}`` in ``sql`` with the activity table, or with
+        the activities of both the database and the attached archive.
+
+        :param span: whether the query should include the archive, or a start
+                     time that includes the archive if before the archive
+                     boundary
+
+        """
+        if isinstance(span, datetime):
+            boundary = self._archive_boundary(conn)
+            span = boundary is not None and span < boundary
+        table = 'activity'
+        if span and self._attach_archive(conn):
+            cols = ', '.join(self._columns(conn, 'main').keys())
+            table = self.sql.activity_span.format(columns=cols)
+        return sql.format(activity=table)
 
     def _activity_exists(self, conn, act):
         """"Return whether or not an activity already lives in the database."""
         cur = conn.cursor()
         exists = None
         try:
-            cur.execute(self.sql.exists_act, (act.id,))
+            sql = self._activity_sql(conn, self.sql.exists_act,
+                                     act.start_time)
+            cur.execute(sql, (act.id,))
             exists = cur.fetchone() is not None
         finally:
             cur.close()
@@ -90,17 +369,294 @@ class Persister(object):
 
         :param activities the activities to add to the database
 
+        :return: the number of activities added
+
         """
         logger.info('persisting activities')
         logger.debug(f'connection: {conn}')
+        added = 0
         for act in activities:
             if self._activity_exists(conn, act):
                 logger.debug(f'already found in database: {act}--skipping')
             else:
-                raw = json.dumps(act.raw)
-                row = (act.id, act.start_time, act.type_short, raw,)
+                raw = self.codec.encode(act.raw)
+                row = (act.id, act.start_time, act.type_short, raw,
+                       *act.indexed_values(), self.codec.fingerprint(act.raw))
                 logger.info(f'adding activity to db {act}')
                 conn.execute(self.sql.insert_act, row)
+                added += 1
+        conn.commit()
+        return added
+
+    @connection()
+    def get_fingerprints(self, conn, ids: Iterable[str]) -> \
+            Dict[str, Tuple[str, datetime, float, float]]:
+        """Return the fingerprints of activities in the database (not the
+        archive) with values used to tell whether their files need to be
+        downloaded again.
+
+        :param conn: the database connection (not provided on by the client of
+            this class)
+
+        :param ids: the IDs of the activities
+
+        :return: the found IDs to the fingerprint, start time, moving time
+                 and distance of their activity
+
+        """
+        ids = tuple(ids)
+        marks = ', '.join('?' * len(ids))
+        sql = self.sql.fingerprints.format(ids=marks)
+        return {r[0]: r[1:] for r in conn.execute(sql, ids)}
+
+    @connection()
+    def update_activities(self, conn, activities: Iterable[Activity],
+                          redownload: Iterable[str] = ()):
+        """Replace the JSON, fingerprint and columns derived from the JSON of
+        existing activities in one transaction.
+
+        :param conn: the database connection (not provided on by the client of
+            this class)
+
+        :param activities: the edited activities
+
+        :param redownload: the IDs of activities to mark as neither downloaded
+                           nor imported so their files are downloaded again
+
+        """
+        codec = self.codec
+        rows = tuple(map(
+            lambda a: (a.start_time, a.type_short, codec.encode(a.raw),
+                       *a.indexed_values(), codec.fingerprint(a.raw), a.id),
+            activities))
+        conn.executemany(self.sql.update_act, rows)
+        redownload = tuple(map(lambda i: (i,), redownload))
+        conn.executemany(self.sql.reset_act_state, redownload)
+        # the laps are extracted again from the new file
+        conn.executemany(self.sql.delete_laps, redownload)
+        conn.executemany(self.sql.delete_lap_file, redownload)
+        conn.executemany(self.sql.delete_track_cells, redownload)
+        conn.executemany(self.sql.delete_track_bounds, redownload)
+        conn.executemany(self.sql.delete_series, redownload)
+        conn.executemany(self.sql.delete_series_file, redownload)
+        conn.commit()
+        logger.info(f'updated {len(rows)} edited activities')
+
+    @connection()
+    def recode_activities(self, conn, batch_size: int = 500) -> int:
+        """Rewrite the raw JSON of activities not encoded with the current
+        :obj:`codec` settings.  Rows are read and committed in batches so the
+        database is not locked for long and an interrupted migration keeps
+        the work done so far.
+
+        :param conn: the database connection (not provided on by the client of
+            this class)
+
+        :param batch_size: the number of rows read per batch
+
+        :return: the number of activities rewritten
+
+        """
+        codec = self.codec
+        rowid = -1
+        recoded = 0
+        while True:
+            rows = conn.execute(
+                self.sql.raw_batch, (rowid, batch_size)).fetchall()
+            if len(rows) == 0:
+                break
+            rowid = rows[-1][0]
+            updates = tuple(map(
+                lambda r: (codec.encode(codec.decode(r[1])), r[0]),
+                filter(lambda r: not codec.is_current(r[1]), rows)))
+            if len(updates) > 0:
+                conn.executemany(self.sql.update_raw, updates)
+                conn.commit()
+                recoded += len(updates)
+                logger.info(f'recoded {recoded} activities')
+        return recoded
+
+    @connection()
+    def compact(self, conn):
+        """Update the query planner statistics and rebuild the database file
+        to reclaim the space of deleted and shrunk rows.
+
+        """
+        size = self.db_file.stat().st_size
+        conn.execute(self.sql.analyze)
+        conn.commit()
+        conn.execute(self.sql.vacuum)
+        logger.info(f'compacted {self.db_file} from {size} to ' +
+                    f'{self.db_file.stat().st_size} bytes')
+
+    @connection()
+    def archive_activities(self, conn, before: datetime = None) -> int:
+        """Move downloaded and imported activities that started before a time
+        to :obj:`archive_file` in one transaction.
+
+        :param conn: the database connection (not provided on by the client of
+            this class)
+
+        :param before: the start time before which activities are moved, which
+                       defaults to :obj:`archive_age` days ago
+
+        :return: the number of activities moved
+
+        """
+        if self.archive_file is None:
+            raise GarmdownError('no archive file configured')
+        if before is None:
+            before = datetime.now() - timedelta(days=self.archive_age)
+        boundary = self._archive_boundary(conn)
+        if boundary is None or boundary < before:
+            boundary = before
+        self._attach_archive(conn, True)
+        cols = ', '.join(self._columns(conn, 'main').keys())
+        conn.execute(self.sql.archive_acts.format(columns=cols), (before,))
+        moved = conn.execute(self.sql.delete_archived, (before,)).rowcount
+        conn.execute(self.sql.set_archive_before, (boundary,))
+        conn.commit()
+        logger.info(f'archived {moved} activities before {before} ' +
+                    f'to {self.archive_file}')
+        return moved
+
+    @connection()
+    def get_import_checkpoint(self, conn) -> ImportCheckpoint:
+        """Return the checkpoint of an unfinished activity import or ``None`` if
+        the last import completed.
+
+        """
+        row = conn.execute(self.sql.get_checkpoint).fetchone()
+        if row is not None:
+            return ImportCheckpoint(*row)
+
+    @connection()
+    def set_import_checkpoint(self, conn, checkpoint: ImportCheckpoint):
+        """Record the progress of an activity import.
+
+        :param conn: the database connection (not provided on by the client of
+            this class)
+
+        :param checkpoint: the last completed page of the import
+
+        """
+        logger.debug(f'import checkpoint: {checkpoint}')
+        conn.execute(self.sql.set_checkpoint, (
+            checkpoint.start_index, checkpoint.end_index, checkpoint.time))
+        conn.commit()
+
+    @connection()
+    def clear_import_checkpoint(self, conn):
+        """Remove the import checkpoint after an import completes."""
+        conn.execute(self.sql.clear_checkpoint)
+        conn.commit()
+
+    @connection()
+    def get_sheet_index(self, conn, sheet_id: str) -> SheetRowIndex:
+        """Return the cached row index of a spreadsheet or ``None`` if it has
+        not been created.
+
+        """
+        row = conn.execute(self.sql.get_sheet_index, (sheet_id,)).fetchone()
+        if row is not None:
+            return SheetRowIndex(*row)
+
+    @connection()
+    def set_sheet_index(self, conn, index: SheetRowIndex,
+                        dates: Iterable[Tuple[int, datetime]]):
+        """Replace the cached row index of a spreadsheet.
+
+        :param conn: the database connection (not provided on by the client of
+            this class)
+
+        :param index: the index read from the spreadsheet
+
+        :param dates: the (0 based) row index and date of each dated row
+
+        """
+        sid = index.sheet_id
+        logger.debug(f'setting sheet index: {index}')
+        conn.execute(self.sql.set_sheet_index, (
+            sid, index.date_range, index.rows, index.last_idx,
+            index.first_date, index.last_date, index.time))
+        conn.execute(self.sql.delete_sheet_rows, (sid,))
+        conn.executemany(self.sql.insert_sheet_row,
+                         map(lambda r: (sid, *r), dates))
+        conn.commit()
+
+    @connection()
+    def set_sheet_last_idx(self, conn, sheet_id: str, last_idx: int):
+        """Record the last spreadsheet row with completed data."""
+        conn.execute(self.sql.set_sheet_last_idx, (last_idx, sheet_id))
+        conn.commit()
+
+    @connection()
+    def get_sheet_rows(self, conn, sheet_id: str, after_idx: int,
+                       before: datetime) -> Tuple[Tuple[int, datetime]]:
+        """Return the cached rows of a spreadsheet after a row and before a
+        date.
+
+        :param sheet_id: the ID of the spreadsheet
+
+        :param after_idx: the rows returned have a greater (0 based) index
+
+        :param before: the rows returned have an earlier date
+
+        :return: the index and date of each row ordered by index
+
+        """
+        return tuple(conn.execute(
+            self.sql.sheet_rows, (sheet_id, after_idx, before)))
+
+    @connection()
+    def queue_sheet_rows(self, conn, sheet_id: str,
+                         rows: Iterable[Tuple[datetime, Tuple]]):
+        """Add rows to the spreadsheet write queue, which replace any queued
+        rows of the same dates.
+
+        :param conn: the database connection (not provided on by the client of
+            this class)
+
+        :param sheet_id: the ID of the spreadsheet
+
+        :param rows: the date and completed cell values of each row
+
+        """
+        now = datetime.now()
+        conn.executemany(self.sql.queue_sheet_row, map(
+            lambda r: (sheet_id, r[0], json.dumps(r[1]), now), rows))
+        conn.commit()
+
+    @connection()
+    def get_sheet_queue(self, conn, sheet_id: str) -> \
+            Tuple[Tuple[datetime, Tuple, datetime, int]]:
+        """Return the queued rows of a spreadsheet.
+
+        :return: the date, cell values, time queued and failed write attempts
+                 of each row ordered by date
+
+        """
+        return tuple(map(lambda r: (r[0], tuple(json.loads(r[1])), *r[2:]),
+                         conn.execute(self.sql.sheet_queue, (sheet_id,))))
+
+    @connection()
+    def dequeue_sheet_rows(self, conn, sheet_id: str,
+                           rows: Iterable[Tuple[datetime, datetime]]):
+        """Remove written rows from the spreadsheet write queue.  Rows queued
+        again since they were read from the queue are kept.
+
+        :param rows: the date and time queued of each row
+
+        """
+        conn.executemany(self.sql.dequeue_sheet_row,
+                         map(lambda r: (sheet_id, *r), rows))
+        conn.commit()
+
+    @connection()
+    def fail_sheet_queue(self, conn, sheet_id: str, attempts: int,
+                         error: str):
+        """Record failed attempts to write the queued rows of a spreadsheet."""
+        conn.execute(self.sql.fail_sheet_queue, (attempts, error, sheet_id))
         conn.commit()
 
     def _thaw_activity(self, conn, sql, *params) -> Activity:
@@ -110,11 +666,67 @@ class Persister(object):
         :param sql: the string SQL used to query
         :param params: the parameters used in the SQL call
 
+        """
+        return self._thaw_rows(conn, conn.execute(sql, params))
+
+    def _thaw_rows(self, conn, rows: Iterable[Tuple[str, bytes]]) -> \
+            Iterable[Activity]:
+        """Create activities from ID and raw JSON rows, or return them from
+        :obj:`activity_cache` when they have already been created.
+
         """
         afactory = self.activity_factory
-        for raw in map(lambda x: x[0], conn.execute(sql, params)):
-            jobj = json.loads(raw)
-            yield afactory.create(jobj)
+        codec = self.codec
+        cache = self.activity_cache
+        if cache is None:
+            for aid, raw in rows:
+                yield afactory.create(codec.decode(raw))
+        else:
+            version = conn.execute(self.sql.activity_version).fetchone()[0]
+            cache.validate(version)
+            for aid, raw in rows:
+                act = cache.get(aid)
+                if act is None:
+                    act = afactory.create(codec.decode(raw))
+                    cache.put(aid, act)
+                yield act
+
+    def _stream_activity(self, sql, *params,
+                         span: Union[bool, datetime] = False,
+                         prepare: Callable = None) -> Iterable[Activity]:
+        """Like :meth:`_thaw_activity` but open a connection that stays open for
+        the lifetime of the returned iterator, and read the rows in batches of
+        :obj:`fetch_size`.  The connection is closed when the iterator is
+        exhausted or garbage collected.
+
+        :param sql: the string SQL used to query
+        :param params: the parameters used in the SQL call
+        :param span: whether to include the archive (see
+                     :meth:`_activity_sql`)
+        :param prepare: called with the connection before the query, such as
+                        to fill temporary tables it uses
+
+        """
+        conn = self._create_connection()
+        try:
+            if prepare is not None:
+                prepare(conn)
+            sql = self._activity_sql(conn, sql, span)
+            cur = conn.execute(sql, params)
+
+            def batches():
+                while True:
+                    rows = cur.fetchmany(self.fetch_size)
+                    if len(rows) == 0:
+                        break
+                    yield from rows
+
+            try:
+                yield from self._thaw_rows(conn, batches())
+            finally:
+                cur.close()
+        finally:
+            self._dispose_connection(conn)
 
     def _mark_state(self, conn, sql, action, act):
         """Mark something as downloaded or imported.
@@ -162,6 +774,97 @@ class Persister(object):
         update_sql = self.sql.update_downloaded
         self._mark_state(conn, update_sql, 'downloaded', activity)
 
+    @connection()
+    def claim_downloads(self, conn, worker: str, limit: int,
+                        lease_seconds: float) -> Tuple[Activity]:
+        """Claim activities to download that are neither downloaded nor claimed
+        by another worker with an unexpired lease.  The claim is a single
+        update, so concurrent workers (processes or hosts sharing the
+        database) claim disjoint activities.
+
+        :param conn: the database connection (not provided on by the client of
+            this class)
+
+        :param worker: the unique name of the claiming worker
+
+        :param limit: the maximum number of activities to claim
+
+        :param lease_seconds: the number of seconds until the claim expires
+                              unless renewed with :meth:`renew_claims`
+
+        :return: the claimed activities, which includes any left claimed by
+                 ``worker``
+
+        """
+        now = datetime.now()
+        expiry = now + timedelta(seconds=lease_seconds)
+        rc = conn.execute(self.sql.claim_downloads,
+                          (worker, expiry, now, limit)).rowcount
+        conn.commit()
+        logger.debug(f'{worker} claimed {rc} activities until {expiry}')
+        return tuple(self._thaw_activity(
+            conn, self.sql.claimed_downloads, worker))
+
+    @connection()
+    def renew_claims(self, conn, worker: str, ids: Iterable[str],
+                     lease_seconds: float):
+        """Extend the lease of activities claimed by ``worker``.
+
+        :param conn: the database connection (not provided on by the client of
+            this class)
+
+        :param worker: the name of the worker that claimed the activities
+
+        :param ids: the IDs of the activities
+
+        :param lease_seconds: the number of seconds from now the lease expires
+
+        """
+        expiry = datetime.now() + timedelta(seconds=lease_seconds)
+        conn.executemany(self.sql.renew_claim,
+                         map(lambda i: (expiry, worker, i), ids))
+        conn.commit()
+
+    @connection()
+    def release_claims(self, conn, worker: str):
+        """Release the claims of ``worker`` on activities not downloaded."""
+        rc = conn.execute(self.sql.release_claims, (worker,)).rowcount
+        logger.debug(f'{worker} released {rc} claims')
+        conn.commit()
+
+    @connection()
+    def get_download_states(self, conn) -> \
+            Tuple[Tuple[str, datetime, datetime]]:
+        """Return the ID, start time and download time (or ``None``) of every
+        activity without thawing them.
+
+        """
+        sql = self._activity_sql(conn, self.sql.download_states, True)
+        return tuple(conn.execute(sql))
+
+    @connection()
+    def set_downloaded(self, conn, ids: Iterable[str], downloaded: bool):
+        """Mark (or unmark) activities as downloaded in bulk.
+
+        :param conn: the database connection (not provided on by the client of
+            this class)
+
+        :param ids: the IDs of the activities to update
+
+        :param downloaded: whether to mark or clear the download time
+
+        """
+        if downloaded:
+            now = datetime.now()
+            rows = map(lambda i: (now, i), ids)
+            sql = self.sql.update_downloaded
+        else:
+            rows = map(lambda i: (i,), ids)
+            sql = self.sql.clear_downloaded
+        rc = conn.executemany(sql, rows).rowcount
+        logger.info(f'set downloaded={downloaded} on {rc} activities')
+        conn.commit()
+
     @connection()
     def get_missing_imported(self, conn, limit: int = None) -> Tuple[Activity]:
         """Return activities that have not yet been imported.
@@ -178,6 +881,44 @@ class Persister(object):
         return tuple(self._thaw_activity(
             conn, self.sql.missing_imported, limit))
 
+    def stream_missing_downloaded(self, limit: int = None) -> \
+            Iterable[Activity]:
+        """Like :meth:`get_missing_downloaded` but stream the activities (see
+        :meth:`_stream_activity`).
+
+        """
+        if limit is None:
+            limit = self.tcx_chunk_size
+        return self._stream_activity(self.sql.missing_downloads, limit)
+
+    def stream_missing_imported(self, limit: int = None) -> \
+            Iterable[Activity]:
+        """Like :meth:`get_missing_imported` but stream the activities (see
+        :meth:`_stream_activity`).  Activities should not be marked in the
+        database until the iteration completes since the open read cursor
+        blocks writes from other connections.
+
+        """
+        if limit is None:
+            limit = sys.maxsize
+        return self._stream_activity(self.sql.missing_imported, limit)
+
+    @connection()
+    def set_imported(self, conn, ids: Iterable[str]):
+        """Mark activities as imported in bulk.
+
+        :param conn: the database connection (not provided on by the client of
+            this class)
+
+        :param ids: the IDs of the activities to mark
+
+        """
+        now = datetime.now()
+        rc = conn.executemany(
+            self.sql.update_imported, map(lambda i: (now, i), ids)).rowcount
+        logger.info(f'marked {rc} activities as imported')
+        conn.commit()
+
     @connection()
     def mark_imported(self, conn, activity):
         """Mark ``activity`` as having been imported
@@ -209,15 +950,506 @@ class Persister(object):
         if len(backups) > 0:
             return backups[0]
 
+    def _primaries_sql(self, sql: str, primaries: bool) -> str:
+        """Replace ``{primaries}`` in ``sql`` with the condition that leaves
+        out duplicate activities (see :class:`.DuplicateDetector`) if
+        ``primaries`` is ``True``.
+
+        """
+        return sql.format(activity='{activity}', primaries=(
+            self.sql.primaries_only if primaries else ''))
+
     @connection()
-    def get_activities_by_date(self, conn, date: datetime) -> Tuple[Activity]:
+    def get_activities_by_date(self, conn, date: datetime,
+                               primaries: bool = False) -> Tuple[Activity]:
+        """Return the activities that started on a day.
+
+        :param date: the day of the activities
+
+        :param primaries: whether to leave out secondary duplicates
+
+        """
         datestr = date.strftime('%Y-%m-%d')
-        return tuple(self._thaw_activity(
-            conn, self.sql.activity_by_date, datestr))
+        sql = self._primaries_sql(self.sql.activity_by_date, primaries)
+        sql = self._activity_sql(conn, sql, self._day(date))
+        return tuple(self._thaw_activity(conn, sql, datestr, datestr))
+
+    def stream_activities_by_date(self, date: datetime,
+                                  primaries: bool = False) -> \
+            Iterable[Activity]:
+        """Like :meth:`get_activities_by_date` but stream the activities (see
+        :meth:`_stream_activity`).
+
+        """
+        datestr = date.strftime('%Y-%m-%d')
+        sql = self._primaries_sql(self.sql.activity_by_date, primaries)
+        return self._stream_activity(
+            sql, datestr, datestr, span=self._day(date))
 
     @connection()
     def get_activities_on_after_date(self, conn, date: datetime) -> \
             Tuple[Activity]:
         datestr = date.strftime('%Y-%m-%d')
+        sql = self._activity_sql(
+            conn, self.sql.activity_on_after_date, self._day(date))
+        return tuple(self._thaw_activity(conn, sql, datestr))
+
+    @property
+    def activity_categories(self) -> Tuple[str]:
+        """The activity type characters in configuration order, which are the
+        categories of the ``atype`` column of :meth:`get_activity_array`.
+
+        """
+        return tuple(self.activity_factory.char_to_name.keys())
+
+    @connection()
+    def get_activity_array(self, conn, start: datetime = None,
+                           end: datetime = None, batch_size: int = 10000,
+                           primaries: bool = False):
+        """Return activities as a NumPy structured array with a field for the
+        ID, start time, type and each indexed column (see
+        :meth:`.Activity.indexed_attributes`).  The array is built from one
+        query read in batches without creating activity instances or decoding
+        their JSON.  The type is the index of its character in
+        :obj:`activity_categories` and missing values are ``nan``.
+
+        :param start: the start of the first day of activities, or ``None`` to
+                      start with the first activity
+
+        :param end: the start of the day after the activities, or ``None`` to
+                    end with the last activity
+
+        :param batch_size: the number of rows read at a time
+
+        :param primaries: whether to leave out secondary duplicates
+
+        """
+        try:
+            import numpy as np
+        except ImportError as e:
+            raise GarmdownError(f'numpy is needed for arrays: {e}')
+        cols = Activity.indexed_attributes()
+        dtype = np.dtype([('id', 'i8'), ('start_time', 'datetime64[s]'),
+                          ('atype', 'u1')] + [(c, 'f8') for c in cols])
+        codes = {c: i for i, c in enumerate(self.activity_categories)}
+        sql = self.sql.activity_columns.format(
+            columns=', '.join(cols), activity='{activity}',
+            primaries=self.sql.primaries_only if primaries else '')
+        sql = self._activity_sql(
+            conn, sql, True if start is None else self._day(start))
+        cur = conn.execute(sql, (
+            '0001-01-01' if start is None else start.strftime('%Y-%m-%d'),
+            '9999-12-31' if end is None else end.strftime('%Y-%m-%d')))
+        chunks = []
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            chunk = np.empty(len(rows), dtype=dtype)
+            vals = tuple(zip(*rows))
+            chunk['id'] = vals[0]
+            chunk['start_time'] = np.array(vals[1], dtype='i8')
+            chunk['atype'] = tuple(map(codes.__getitem__, vals[2]))
+            for col, val in zip(cols, vals[3:]):
+                chunk[col] = np.array(val, dtype='f8')
+            chunks.append(chunk)
+        cur.close()
+        if len(chunks) == 0:
+            return np.empty(0, dtype=dtype)
+        return np.concatenate(chunks)
+
+    def get_activity_frame(self, start: datetime = None,
+                           end: datetime = None, primaries: bool = False):
+        """Like :meth:`get_activity_array` but return a pandas data frame,
+        which has the activity type as a categorical of the names of the
+        activity types.
+
+        """
+        try:
+            import pandas as pd
+        except ImportError as e:
+            raise GarmdownError(f'pandas is needed for data frames: {e}')
+        arr = self.get_activity_array(start, end, primaries=primaries)
+        names = self.activity_factory.char_to_name
+        df = pd.DataFrame(arr)
+        df['atype'] = pd.Categorical.from_codes(
+            arr['atype'], tuple(map(names.get, self.activity_categories)))
+        return df
+
+    @connection()
+    def get_daily_totals(self, conn, start: datetime, end: datetime) -> \
+            Tuple[Tuple[datetime, str, int, float, float]]:
+        """Return the totals of the activities of each day and type in one
+        grouped query, which leave out secondary duplicates.
+
+        :param start: the first day
+
+        :param end: the day after the last day
+
+        :return: the day, type (character), count, moving seconds and stress
+                 score of each day and activity type
+
+        """
+        sql = self._activity_sql(
+            conn, self.sql.daily_totals, self._day(start))
+        rows = conn.execute(sql, (start.strftime('%Y-%m-%d'),
+                                  end.strftime('%Y-%m-%d')))
+        return tuple(map(lambda r: (datetime.strptime(r[0], '%Y-%m-%d'),
+                                    *r[1:]), rows))
+
+    @connection()
+    def get_activities_by_query(self, conn, query: ActivityQuery) -> \
+            Tuple[Activity]:
+        """Return activities that match a compiled filter query.
+
+        :param conn: the database connection (not provided on by the client of
+            this class)
+
+        :param query: the query compiled by :class:`.QueryCompiler`
+
+        """
+        sql = self.sql.activity_query.format(
+            activity='{activity}', where=query.where, order=query.order)
+        sql = self._activity_sql(conn, sql, True)
         return tuple(self._thaw_activity(
-            conn, self.sql.activity_on_after_date, datestr))
+            conn, sql, *query.params, query.limit))
+
+    def stream_activities_by_query(self, query: ActivityQuery,
+                                   prepare: Callable = None) -> \
+            Iterable[Activity]:
+        """Like :meth:`get_activities_by_query` but stream the activities (see
+        :meth:`_stream_activity`).
+
+        :param prepare: called with the connection before the query
+
+        """
+        sql = self.sql.activity_query.format(
+            activity='{activity}', where=query.where, order=query.order)
+        return self._stream_activity(
+            sql, *query.params, query.limit, span=True, prepare=prepare)
+
+    @connection()
+    def get_laps_pending(self, conn, limit: int = None) -> \
+            Tuple[Tuple[str, datetime]]:
+        """Return the ID and start time of downloaded activities (including
+        those archived) whose laps have not been extracted, most recent first.
+
+        :param limit: the maximum number of activities to return, or ``None``
+                      for all of them
+
+        """
+        sql = self._activity_sql(conn, self.sql.laps_pending, True)
+        return tuple(conn.execute(sql, (-1 if limit is None else limit,)))
+
+    @connection()
+    def insert_laps(self, conn,
+                    extracted: Iterable[Tuple[str, Tuple[Lap], str]]) -> int:
+        """Replace the laps of activities in one transaction, and record that
+        their files were processed so they are not extracted again.
+
+        :param conn: the database connection (not provided on by the client of
+            this class)
+
+        :param extracted: the activity ID, laps (or ``None`` if the file could
+                          not be read) and the error reading the file (or
+                          ``None``) of each activity
+
+        :return: the number of laps added
+
+        """
+        now = datetime.now()
+        added = 0
+        for aid, laps, error in extracted:
+            laps = () if laps is None else laps
+            conn.execute(self.sql.delete_laps, (aid,))
+            conn.executemany(self.sql.insert_lap, map(
+                lambda lap: (aid, lap.index, *lap.values), laps))
+            conn.execute(self.sql.insert_lap_file,
+                         (aid, len(laps), error, now))
+            added += len(laps)
+        conn.commit()
+        return added
+
+    @connection()
+    def get_laps_by_query(self, conn, query: ActivityQuery) -> \
+            Tuple[ActivityLap]:
+        """Return laps that match a query compiled by
+        :class:`.LapQueryCompiler`.
+
+        :param conn: the database connection (not provided on by the client of
+            this class)
+
+        :param query: the compiled query
+
+        """
+        cols = Lap.COLUMNS[1:]
+        sql = self.sql.lap_query.format(
+            activity='{activity}', where=query.where, order=query.order,
+            columns=', '.join(cols),
+            lap_columns=', '.join(map(lambda c: f'l.{c}', cols)))
+        sql = self._activity_sql(conn, sql, True)
+        rows = conn.execute(sql, (*query.params, query.limit))
+        return tuple(map(lambda r: ActivityLap(
+            r[0], r[1], r[2], Lap(r[3], r[4], *r[5:])), rows))
+
+    @connection()
+    def get_tracks_pending(self, conn, cell_size: float,
+                           limit: int = None) -> Tuple[Tuple[str, datetime]]:
+        """Return the ID and start time of downloaded activities (including
+        those archived) whose tracks are not in the geo index of a cell size,
+        most recent first.
+
+        :param limit: the maximum number of activities to return, or ``None``
+                      for all of them
+
+        """
+        sql = self._activity_sql(conn, self.sql.tracks_pending, True)
+        return tuple(conn.execute(
+            sql, (cell_size, -1 if limit is None else limit)))
+
+    @connection()
+    def insert_track_cells(self, conn, cell_size: float,
+                           indexed: Iterable[Tuple[str, Any, str]]) -> int:
+        """Replace the geo index cells and bounding boxes of activities in one
+        transaction.
+
+        :param conn: the database connection (not provided on by the client of
+            this class)
+
+        :param cell_size: the size of the :class:`.GeoGrid` cells
+
+        :param indexed: the activity ID, cells and bounding box (see
+                        :meth:`.GeoGrid.track_cells`, or ``None`` if the file
+                        could not be read) and the error reading the file (or
+                        ``None``) of each activity
+
+        :return: the number of cells added
+
+        """
+        now = datetime.now()
+        added = 0
+        for aid, cells_box, error in indexed:
+            cells, box = ((), None) if cells_box is None else cells_box
+            box = (None,) * 4 if box is None else box
+            conn.execute(self.sql.delete_track_cells, (aid,))
+            conn.executemany(self.sql.insert_track_cell,
+                             map(lambda c: (c, aid), cells))
+            conn.execute(self.sql.insert_track_bounds,
+                         (aid, cell_size, len(cells), *box, error, now))
+            added += len(cells)
+        conn.commit()
+        return added
+
+    def _match_tracks(self, conn, grid: GeoGrid,
+                      ranges: List[Tuple[int, int]], box: GeoBox):
+        """Replace the IDs of the temporary ``track_match`` table with those of
+        the activities whose tracks pass through cells and whose bounding
+        boxes overlap a box.  Only the cells in the extent of the bounding
+        boxes that overlap the box are looked up.  The IDs are kept in a table
+        of the connection rather than bound as query parameters, of which
+        SQLite before 3.32 allows only 999.
+
+        """
+        size = grid.cell_size
+        min_lat, min_lon, max_lat, max_lon = box
+        conn.execute(self.sql.create_track_match)
+        conn.execute(self.sql.delete_track_match)
+        row = conn.execute(self.sql.track_extent, (
+            size, max_lat, min_lat, max_lon, min_lon)).fetchone()
+        if row[0] > 0:
+            # look up only the cells of the activities overlapping the box
+            ranges = grid.clip(ranges, row[1:])
+            logger.debug(f'{row[0]} activities overlap {box}, ' +
+                         f'searching {len(ranges)} cell ranges')
+            conn.executemany(self.sql.insert_track_match, map(
+                lambda r: (*r, size, max_lat, min_lat, max_lon, min_lon),
+                ranges))
+        conn.commit()
+
+    @connection()
+    def find_track_activities(self, conn, grid: GeoGrid,
+                              ranges: List[Tuple[int, int]],
+                              box: GeoBox) -> Set[str]:
+        """Return the IDs of activities whose tracks pass through cells and
+        whose bounding boxes overlap a box.
+
+        :param conn: the database connection (not provided on by the client of
+            this class)
+
+        :param grid: the grid the cells are in
+
+        :param ranges: the first and last cell of each row (see
+                       :meth:`.GeoGrid.box_ranges`)
+
+        :param box: the bounding box of the cells
+
+        """
+        self._match_tracks(conn, grid, ranges, box)
+        return set(map(lambda r: r[0], conn.execute(self.sql.track_match)))
+
+    def stream_activities_by_track(self, query: ActivityQuery, grid: GeoGrid,
+                                   ranges: List[Tuple[int, int]],
+                                   box: GeoBox) -> Iterable[Activity]:
+        """Like :meth:`stream_activities_by_query` but only of the activities
+        found by :meth:`find_track_activities`.
+
+        """
+        match = f'id in ({self.sql.track_match})'
+        where = f'{query.where} and {match}' if len(query.where) > 0 \
+            else f'where {match}'
+        return self.stream_activities_by_query(
+            replace(query, where=where),
+            lambda conn: self._match_tracks(conn, grid, ranges, box))
+
+    @connection()
+    def get_duplicate_pending(self, conn) -> Dict[str, datetime]:
+        """Return the activities added or changed since they were last checked
+        for duplicates, which are recorded by database triggers.
+
+        :return: the IDs to the start times of the activities, which are
+                 ``None`` for activities no longer in the database (i.e.
+                 archived)
+
+        """
+        return dict(conn.execute(self.sql.duplicate_pending))
+
+    @connection()
+    def get_activity_spans(self, conn, start: datetime = None,
+                           end: datetime = None) -> \
+            Tuple[Tuple[str, datetime, str, float]]:
+        """Return the ID, start time, type (character) and moving seconds of
+        activities ordered by start time without decoding their JSON.
+
+        :param start: the earliest start time, or ``None`` to start with the
+                      first activity
+
+        :param end: the (exclusive) latest start time, or ``None`` to end with
+                    the last activity
+
+        """
+        sql = self._activity_sql(
+            conn, self.sql.activity_spans, True if start is None else start)
+        return tuple(conn.execute(sql, (
+            '0001-01-01' if start is None else start,
+            '9999-12-31' if end is None else end)))
+
+    @connection()
+    def replace_duplicates(self, conn, duplicates: Iterable[Duplicate],
+                           start: datetime = None, end: datetime = None):
+        """Replace the duplicates whose secondary activity started in a time
+        span in one transaction.
+
+        :param conn: the database connection (not provided on by the client of
+            this class)
+
+        :param duplicates: the duplicates found in the span
+
+        :param start: the start of the span, or ``None`` for all time
+
+        :param end: the (exclusive) end of the span, or ``None`` for all time
+
+        """
+        now = datetime.now()
+        conn.execute(self.sql.delete_duplicates, (
+            '0001-01-01' if start is None else start,
+            '9999-12-31' if end is None else end))
+        conn.executemany(self.sql.insert_duplicate, map(
+            lambda d: (d.activity_id, d.primary_id, d.start_time, d.overlap,
+                       now), duplicates))
+        conn.commit()
+
+    @connection()
+    def clear_duplicate_pending(self, conn, ids: Iterable[str]):
+        """Record that activities were checked for duplicates."""
+        conn.executemany(self.sql.delete_duplicate_check,
+                         map(lambda i: (i,), ids))
+        conn.commit()
+
+    @connection()
+    def get_duplicates(self, conn) -> Tuple[Duplicate]:
+        """Return all duplicates ordered by the start time of the secondary
+        activity.
+
+        """
+        return tuple(map(lambda r: Duplicate(*r),
+                         conn.execute(self.sql.duplicates)))
+
+    @connection()
+    def get_series_pending(self, conn, key: str, limit: int = None) -> \
+            Tuple[Tuple[str, datetime]]:
+        """Return the ID and start time of downloaded activities (including
+        those archived) whose series have not been downsampled with the
+        configuration of a :class:`.SeriesPyramid`, most recent first.
+
+        :param key: the :obj:`.SeriesPyramid.key` of the configuration
+
+        :param limit: the maximum number of activities to return, or ``None``
+                      for all of them
+
+        """
+        sql = self._activity_sql(conn, self.sql.series_pending, True)
+        return tuple(conn.execute(sql, (key, -1 if limit is None else limit)))
+
+    @connection()
+    def insert_series(self, conn, key: str,
+                      built: Iterable[Tuple[str, Any, str]]) -> int:
+        """Replace the downsampled series of activities in one transaction.
+
+        :param conn: the database connection (not provided on by the client of
+            this class)
+
+        :param key: the :obj:`.SeriesPyramid.key` of the configuration
+
+        :param built: the activity ID, start and encoded levels (see
+                      :meth:`.SeriesPyramid.read_levels`, or ``None`` if the
+                      file could not be read) and the error reading the file
+                      (or ``None``) of each activity
+
+        :return: the number of levels added
+
+        """
+        now = datetime.now()
+        added = 0
+        for aid, start_levels, error in built:
+            start, levels = (None, ()) if start_levels is None \
+                else start_levels
+            if start is not None:
+                start = datetime.fromtimestamp(start, timezone.utc).replace(
+                    tzinfo=None)
+            conn.execute(self.sql.delete_series, (aid,))
+            conn.executemany(self.sql.insert_series, map(
+                lambda lv: (aid, lv[0], start, lv[1], lv[2]), levels))
+            conn.execute(self.sql.insert_series_file, (aid, key, error, now))
+            added += len(levels)
+        conn.commit()
+        return added
+
+    @connection()
+    def get_series(self, conn, activity_id: str = None,
+                   start: datetime = None, end: datetime = None) -> \
+            Tuple[Tuple[str, str, datetime, int, int, bytes]]:
+        """Return the downsampled series of an activity or of the activities
+        in a span of days.
+
+        :param activity_id: the ID of the activity, or ``None`` for those in
+                            the span of days
+
+        :param start: the first day
+
+        :param end: the day after the last day
+
+        :return: the activity ID, type (character), start (UTC), number of
+                 points, row count and encoded array of each level ordered by
+                 activity start time and then descending number of points
+
+        """
+        if activity_id is not None:
+            where, params, span = self.sql.series_by_activity, \
+                (activity_id,), True
+        else:
+            where, params, span = self.sql.series_by_date, \
+                (start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')), \
+                self._day(start)
+        sql = self.sql.series.format(activity='{activity}', where=where)
+        sql = self._activity_sql(conn, sql, span)
+        return tuple(conn.execute(sql, params))
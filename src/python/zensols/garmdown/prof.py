@@ -0,0 +1,221 @@
+"""Profiles the CPU time, memory allocations and method wall times of any
+action.
+
+"""
+__author__ = 'Paul Landes'
+
+from typing import Dict, List, Tuple, Callable, Any
+from dataclasses import dataclass, field
+from enum import Enum, auto
+import logging
+import sys
+import os
+import time
+import atexit
+import functools
+import inspect
+from io import TextIOBase
+from pathlib import Path
+from datetime import datetime
+from . import GarmdownError
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileMode(Enum):
+    """What is profiled by the ``--profile`` option."""
+    cpu = auto()
+    memory = auto()
+    time = auto()
+    all = auto()
+
+
+class MethodTimer(object):
+    """Wraps the methods of classes to total the number of calls and wall time
+    of each.  The time of a method includes that of the methods it calls, and
+    only the creation of generators is timed.
+
+    """
+    def __init__(self):
+        self.times: Dict[str, List[float]] = {}
+        self._originals: List[Tuple[type, str, Callable]] = []
+
+    def _wrap(self, name: str, meth: Callable) -> Callable:
+        times = self.times.setdefault(name, [0, 0., 0.])
+
+        @functools.wraps(meth)
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return meth(*args, **kwargs)
+            finally:
+                secs = time.perf_counter() - t0
+                times[0] += 1
+                times[1] += secs
+                times[2] = max(times[2], secs)
+
+        return timed
+
+    def patch(self, cls: type):
+        """Time the methods defined by ``cls`` (but not its super classes)."""
+        for name, meth in tuple(vars(cls).items()):
+            if inspect.isfunction(meth) and not name.startswith('__'):
+                self._originals.append((cls, name, meth))
+                setattr(cls, name, self._wrap(f'{cls.__name__}.{name}', meth))
+
+    def unpatch(self):
+        """Restore the methods replaced by :meth:`patch`."""
+        for cls, name, meth in reversed(self._originals):
+            setattr(cls, name, meth)
+        self._originals.clear()
+
+    def write(self, writer: TextIOBase = sys.stdout):
+        """Write the calls and time of each called method, slowest first."""
+        writer.write(f'{"method":<50} {"calls":>8} {"total s":>10} ' +
+                     f'{"mean ms":>10} {"max ms":>10}\n')
+        rows = sorted(filter(lambda r: r[1][0] > 0, self.times.items()),
+                      key=lambda r: r[1][1], reverse=True)
+        for name, (calls, total, most) in rows:
+            writer.write(f'{name:<50} {calls:>8} {total:>10.3f} ' +
+                         f'{total / calls * 1000:>10.2f} ' +
+                         f'{most * 1000:>10.2f}\n')
+
+
+@dataclass
+class Profiler(object):
+    """A first pass application that profiles the action given on the command
+    line with :mod:`cProfile` and/or :mod:`tracemalloc`, and optionally times
+    each call to the methods of the :obj:`timed_classes`.  Profiling starts
+    before the action is created and the reports are written to
+    :obj:`profile_dir` when the process exits.
+
+    """
+    CLI_META = {'first_pass': True,  # not a separate action
+                'option_overrides': {'profile': {'short_name': None}},
+                'mnemonic_overrides': {'start': 'profile'},
+                'mnemonic_includes': {'start'},
+                'option_includes': {'profile'}}
+
+    profile_dir: Path = field(default=None)
+    """The directory where the reports are written."""
+
+    profile: ProfileMode = field(default=None)
+    """Profile the action: cpu, memory, time of methods, or all."""
+
+    top: int = field(default=40)
+    """The number of functions and allocations in the text reports."""
+
+    memory_frames: int = field(default=10)
+    """The number of stack frames stored with each memory allocation."""
+
+    timed_classes: Tuple[str] = field(default=('Manager', 'Persister',
+                                               'Fetcher'))
+    """The names of the :mod:`zensols.garmdown` classes whose methods are
+    timed.
+
+    """
+    def __post_init__(self):
+        self._profiler = None
+        self._timer: MethodTimer = None
+
+    def _enabled(self, mode: ProfileMode) -> bool:
+        return self.profile in {mode, ProfileMode.all}
+
+    def start(self):
+        """Start profiling if an option to profile is given."""
+        if self.profile is None:
+            return
+        if self.profile_dir is None:
+            raise GarmdownError('no profile directory configured')
+        if self._enabled(ProfileMode.memory):
+            import tracemalloc
+            tracemalloc.start(self.memory_frames)
+        if self._enabled(ProfileMode.time):
+            from zensols import garmdown
+            self._timer = MethodTimer()
+            for name in self.timed_classes:
+                cls = getattr(garmdown, name, None)
+                if not inspect.isclass(cls):
+                    raise GarmdownError(f'no such class to time: {name}')
+                self._timer.patch(cls)
+        if self._enabled(ProfileMode.cpu):
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        atexit.register(self.stop)
+        logger.info(f'profiling {self.profile.name}')
+
+    def _write_cpu(self, prefix: Path) -> List[Path]:
+        import pstats
+        stats_path = prefix.with_suffix('.prof')
+        text_path = prefix.with_name(f'{prefix.name}-cpu.txt')
+        self._profiler.dump_stats(stats_path)
+        with open(text_path, 'w') as f:
+            stats = pstats.Stats(self._profiler, stream=f)
+            stats.sort_stats('cumulative').print_stats(self.top)
+            stats.sort_stats('tottime').print_stats(self.top)
+        self._profiler = None
+        return [stats_path, text_path]
+
+    def _write_memory(self, prefix: Path) -> List[Path]:
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # leave out the allocations of profiling
+        snapshot = snapshot.filter_traces(tuple(map(
+            lambda p: tracemalloc.Filter(False, p),
+            (tracemalloc.__file__, __file__, '*/cProfile.py',
+             '*/functools.py'))))
+        path = prefix.with_name(f'{prefix.name}-memory.txt')
+        with open(path, 'w') as f:
+            f.write(f'current: {current / 1024:.1f} KiB, ' +
+                    f'peak: {peak / 1024:.1f} KiB\n\n')
+            for title, key in (('line', 'lineno'),
+                               ('call stack', 'traceback')):
+                f.write(f'top {self.top} allocations by {title}:\n')
+                for stat in snapshot.statistics(key)[:self.top]:
+                    f.write(f'{stat}\n')
+                    if key == 'traceback':
+                        for line in stat.traceback.format():
+                            f.write(f'    {line}\n')
+                f.write('\n')
+        return [path]
+
+    def _write_time(self, prefix: Path) -> List[Path]:
+        self._timer.unpatch()
+        path = prefix.with_name(f'{prefix.name}-methods.txt')
+        with open(path, 'w') as f:
+            self._timer.write(f)
+        self._timer = None
+        return [path]
+
+    def stop(self) -> List[Path]:
+        """Stop profiling and write the reports, which is called when the
+        process exits.
+
+        :return: the files written
+
+        """
+        atexit.unregister(self.stop)
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        now = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        prefix = self.profile_dir / f'garmdown-{now}-{os.getpid()}'
+        paths: List[Path] = []
+        if self._profiler is not None:
+            self._profiler.disable()
+        if self._enabled(ProfileMode.memory):
+            import tracemalloc
+            # snapshot before the other reports allocate
+            if tracemalloc.is_tracing():
+                paths.extend(self._write_memory(prefix))
+        if self._profiler is not None:
+            paths.extend(self._write_cpu(prefix))
+        if self._timer is not None:
+            paths.extend(self._write_time(prefix))
+        for path in paths:
+            logger.info(f'wrote profile: {path}')
+        return paths
+
+    def __call__(self) -> Any:
+        return self.start()
@@ -0,0 +1,217 @@
+"""A small filter language for selecting activities that compiles to SQL.
+
+"""
+__author__ = 'Paul Landes'
+
+from typing import Tuple, List, Any
+from dataclasses import dataclass, field
+import logging
+import re
+from datetime import datetime, timedelta
+from . import GarmdownError, Activity, ActivityFactory, Lap
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ActivityQuery(object):
+    """A compiled activity query, which is the ``where`` and ``order by``
+    clauses with the parameters that are given to the SQL query.
+
+    """
+    where: str = field()
+    """The SQL ``where`` clause or an empty string for all activities."""
+
+    order: str = field()
+    """The SQL ``order by`` clause."""
+
+    params: Tuple[Any] = field()
+    """The parameters of the ``where`` clause."""
+
+    limit: int = field()
+    """The maximum number of activities to return."""
+
+    def __str__(self):
+        return (f'{self.where} {self.order} limit {self.limit}: ' +
+                f'{self.params}')
+
+
+@dataclass
+class QueryCompiler(object):
+    """Compiles a filter string in to an :class:`.ActivityQuery`.  The filter
+    is a white space separated list of terms that are *and*'ed together.  Each
+    term has the form ``<field><operator><value>``, where the operator is one
+    of ``=``, ``!=``, ``<``, ``<=``, ``>`` or ``>=``.  The fields are:
+
+      * ``type``: the sport type character (i.e. ``c`` for cycling) or Garmin
+        type name (i.e. ``road_biking``), which can be comma separated for
+        equals to match any of them
+
+      * ``date``: the start date in ``yyyy-mm-dd`` format
+
+      * ``year``: the year the activity started
+
+      * ``duration``: the moving time, which can be given in seconds or with
+        units such as ``3h``, ``90m`` or ``1h30m``
+
+      * any indexed column such as ``heart_rate_average`` or ``power_norm``
+
+    For example: ``type=c year=2025 duration>3h power_norm>0``.
+
+    """
+    TERM_REGEX = re.compile(r'^([a-z_]+)(<=|>=|!=|=|<|>)(.+)$')
+    DURATION_REGEX = re.compile(r'^(?:(\d+(?:\.\d+)?)h)?' +
+                                r'(?:(\d+(?:\.\d+)?)m)?' +
+                                r'(?:(\d+(?:\.\d+)?)s?)?$')
+    ALIASES = {'duration': 'move_time_seconds',
+               'date': 'start_time',
+               'type': 'atype'}
+
+    activity_factory: ActivityFactory = field()
+    """Used to map Garmin type names to sport type characters."""
+
+    limit: int = field(default=100)
+    """The default maximum number of activities to return."""
+
+    @property
+    def columns(self) -> Tuple[str]:
+        """The columns that can be filtered and ordered."""
+        return ('start_time', 'atype') + Activity.indexed_attributes()
+
+    def _column(self, name: str) -> str:
+        col = self.ALIASES.get(name, name)
+        if col not in self.columns:
+            raise GarmdownError(f'unknown query field: {name}')
+        return col
+
+    def _parse_type(self, val: str) -> str:
+        factory = self.activity_factory
+        if val in factory.char_to_name:
+            return val
+        if val in factory.type_to_char:
+            return factory.type_to_char[val]
+        raise GarmdownError(f'unknown sport type: {val}')
+
+    def _parse_date(self, val: str) -> datetime:
+        try:
+            return datetime.strptime(val, '%Y-%m-%d')
+        except ValueError:
+            raise GarmdownError(f'bad date (need yyyy-mm-dd): {val}')
+
+    def _parse_duration(self, val: str) -> float:
+        m = self.DURATION_REGEX.match(val)
+        if m is None or len(val) == 0:
+            raise GarmdownError(f'bad duration: {val}')
+        hours, mins, secs = map(lambda x: float(x or 0), m.groups())
+        return (hours * 60 * 60) + (mins * 60) + secs
+
+    def _parse_number(self, val: str) -> float:
+        try:
+            return float(val)
+        except ValueError:
+            raise GarmdownError(f'bad number: {val}')
+
+    def _date_term(self, op: str, start: datetime, end: datetime,
+                   params: List[Any]) -> str:
+        """Create a clause on ``start_time`` over the ``[start, end)`` range,
+        which keeps the clause a range so the start time index is used.
+
+        """
+        start, end = map(lambda d: d.strftime('%Y-%m-%d'), (start, end))
+        if op == '=':
+            params.extend((start, end))
+            return '(start_time >= ? and start_time < ?)'
+        if op == '!=':
+            params.extend((start, end))
+            return '(start_time < ? or start_time >= ?)'
+        sql_op, date = {'<': ('<', start),
+                        '<=': ('<', end),
+                        '>': ('>=', end),
+                        '>=': ('>=', start)}[op]
+        params.append(date)
+        return f'start_time {sql_op} ?'
+
+    def _compile_term(self, term: str, params: List[Any]) -> str:
+        m = self.TERM_REGEX.match(term)
+        if m is None:
+            raise GarmdownError(f'bad query term: {term}')
+        name, op, val = m.groups()
+        if name == 'year':
+            year = int(self._parse_number(val))
+            return self._date_term(
+                op, datetime(year, 1, 1), datetime(year + 1, 1, 1), params)
+        col = self._column(name)
+        if col == 'start_time':
+            date = self._parse_date(val)
+            return self._date_term(
+                op, date, date + timedelta(days=1), params)
+        if col == 'atype':
+            types = tuple(map(self._parse_type, val.split(',')))
+            if op not in {'=', '!='}:
+                raise GarmdownError(f'bad sport type operator: {op}')
+            params.extend(types)
+            marks = ', '.join('?' * len(types))
+            neg = 'not ' if op == '!=' else ''
+            return f'atype {neg}in ({marks})'
+        if col == self.ALIASES['duration']:
+            params.append(self._parse_duration(val))
+        else:
+            params.append(self._parse_number(val))
+        return f'{col} {op} ?'
+
+    def _compile_order(self, order: str) -> str:
+        desc = order.startswith('-')
+        col = self._column(order.lstrip('-'))
+        return f'order by {col} {"desc" if desc else "asc"}'
+
+    def compile(self, filter: str, limit: int = None,
+                order: str = '-date') -> ActivityQuery:
+        """Compile a filter string in to a parameterized query.
+
+        :param filter: the white space separated filter terms
+
+        :param limit: the maximum number of activities to return, which
+                      defaults to :obj:`limit`
+
+        :param order: the field to order by, which is descending when prefixed
+                      with ``-``
+
+        """
+        params: List[Any] = []
+        terms = tuple(map(lambda t: self._compile_term(t, params),
+                          filter.split()))
+        where = ' and '.join(terms)
+        if len(where) > 0:
+            where = f'where {where}'
+        query = ActivityQuery(
+            where=where,
+            order=self._compile_order(order),
+            params=tuple(params),
+            limit=self.limit if limit is None else limit)
+        logger.debug(f'compiled query: {query}')
+        return query
+
+
+@dataclass
+class LapQueryCompiler(QueryCompiler):
+    """Compiles a filter string of laps in to an :class:`.ActivityQuery` for
+    :meth:`.Persister.get_laps_by_query`.  The terms are those of
+    :class:`.QueryCompiler`, but ``duration`` is the timer time of the lap,
+    ``date``, ``year`` and ``type`` are those of the activity, ``lap`` is the
+    0 based lap index, and the other fields are the lap values such as
+    ``power_average`` or ``heart_rate_max``.
+
+    For example, the 20 minute interval laps of a season ordered by
+    ``-power_average``: ``type=c year=2025 duration>=19m duration<=21m``.
+
+    """
+    ALIASES = {'duration': 'total_seconds',
+               'date': 'start_time',
+               'type': 'atype',
+               'lap': 'lap_index'}
+
+    @property
+    def columns(self) -> Tuple[str]:
+        """The columns that can be filtered and ordered."""
+        return ('start_time', 'atype', 'lap_index') + tuple(filter(
+            lambda c: c not in {'start_time', 'intensity'}, Lap.COLUMNS))
@@ -1,14 +1,21 @@
-"""Report activities of a day.
+"""Report activities of a day, or activities and laps that match a query or
+where they went, and previews of their series.
 
 """
 __author__ = 'Paul Landes'
 
+from typing import Iterable, Tuple, List, Dict
 from dataclasses import dataclass, field
 import logging
 import sys
 from io import TextIOBase
+from datetime import datetime, timedelta
 import json
-from zensols.garmdown import Persister
+import textwrap
+from zensols.garmdown import (
+    Activity, ActivityLap, Persister, QueryCompiler, LapQueryCompiler,
+    GeoGrid, GeoBox, SeriesPyramid
+)
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +28,37 @@ class Reporter(object):
     persister: Persister = field()
     """Use to access backup tracking data."""
 
+    query_compiler: QueryCompiler = field()
+    """Compiles activity filter queries."""
+
+    lap_query_compiler: LapQueryCompiler = field(default=None)
+    """Compiles lap filter queries."""
+
+    geo_grid: GeoGrid = field(default=None)
+    """The grid of the geo index of activity tracks."""
+
+    series_pyramid: SeriesPyramid = field(default=None)
+    """Decodes the downsampled series of activity tracks."""
+
+    def _write_summary(self, acts: Iterable[Activity], writer: TextIOBase):
+        for act in acts:
+            writer.write(f'{act}\n')
+
+    def _write_detail(self, acts: Iterable[Activity], writer: TextIOBase):
+        for act in acts:
+            act.write(writer)
+
+    def _write_json(self, acts: Iterable[Activity], writer: TextIOBase):
+        """Write a JSON array of the raw data one activity at a time."""
+        sep = '\n'
+        writer.write('[')
+        for act in acts:
+            writer.write(sep)
+            raw = json.dumps(act.raw, indent=4)
+            writer.write(textwrap.indent(raw, '    '))
+            sep = ',\n'
+        writer.write(']' if sep == '\n' else '\n]')
+
     def write_summary(self, date, writer: TextIOBase = sys.stdout):
         """Write the summary of all activities for a day.
 
@@ -30,8 +68,8 @@ class Reporter(object):
 
         """
         logger.debug(f'summary on day {date}')
-        for act in self.persister.get_activities_by_date(date):
-            writer.write(f'{act}\n')
+        acts = self.persister.stream_activities_by_date(date)
+        self._write_summary(acts, writer)
 
     def write_detail(self, date, writer: TextIOBase = sys.stdout):
         """Write the detailed attributes of all activities for a day.
@@ -42,8 +80,8 @@ class Reporter(object):
 
         """
         logger.debug(f'detail on day {date}')
-        for act in self.persister.get_activities_by_date(date):
-            act.write(writer)
+        acts = self.persister.stream_activities_by_date(date)
+        self._write_detail(acts, writer)
 
     def write_json(self, date, writer: TextIOBase = sys.stdout):
         """Write the JSON, which contains all the data of all activities for a day.
@@ -54,6 +92,208 @@ class Reporter(object):
 
         """
         logger.debug(f'raw on day {date}')
-        acts = tuple(map(lambda x: x.raw,
-                         self.persister.get_activities_by_date(date)))
-        json.dump(acts, writer, indent=4)
+        acts = self.persister.stream_activities_by_date(date)
+        self._write_json(acts, writer)
+
+    def write_query(self, filter: str, format: str = 'summary',
+                    limit: int = None, order: str = '-date',
+                    writer: TextIOBase = sys.stdout):
+        """Write activities that match a filter query.
+
+        :param filter: the filter terms (see :class:`.QueryCompiler`)
+
+        :param format: the output format, which is one of ``summary``,
+                       ``detail`` or ``json``
+
+        :param limit: the maximum number of activities to write
+
+        :param order: the field to order by, which is descending when prefixed
+                      with ``-``
+
+        :param writer: the writer object, which default to sys.stdout
+
+        """
+        query = self.query_compiler.compile(filter, limit, order)
+        logger.debug(f'query: {query}')
+        acts = self.persister.stream_activities_by_query(query)
+        getattr(self, f'_write_{format}')(acts, writer)
+
+    def _write_geo(self, ranges, box: GeoBox, filter: str, format: str,
+                   limit: int, order: str, writer: TextIOBase):
+        query = self.query_compiler.compile(filter, limit, order)
+        acts = self.persister.stream_activities_by_track(
+            query, self.geo_grid, ranges, box)
+        getattr(self, f'_write_{format}')(acts, writer)
+
+    def write_near(self, lat: float, lon: float, radius: float,
+                   filter: str = '', format: str = 'summary',
+                   limit: int = None, order: str = '-date',
+                   writer: TextIOBase = sys.stdout):
+        """Write activities whose tracks pass near a position, which is to
+        within the size of the geo index cells.
+
+        :param lat: the latitude of the position in degrees
+
+        :param lon: the longitude of the position in degrees
+
+        :param radius: the distance from the position in meters
+
+        :param filter: the filter terms (see :class:`.QueryCompiler`)
+
+        :param format: the output format, which is one of ``summary``,
+                       ``detail`` or ``json``
+
+        :param limit: the maximum number of activities to write
+
+        :param order: the field to order by, which is descending when prefixed
+                      with ``-``
+
+        :param writer: the writer object, which default to sys.stdout
+
+        """
+        grid = self.geo_grid
+        self._write_geo(grid.near_ranges(lat, lon, radius),
+                        grid.near_box(lat, lon, radius),
+                        filter, format, limit, order, writer)
+
+    def write_box(self, box: GeoBox, filter: str = '',
+                  format: str = 'summary', limit: int = None,
+                  order: str = '-date', writer: TextIOBase = sys.stdout):
+        """Write activities whose tracks pass through a bounding box, which is
+        to within the size of the geo index cells: the bounding box of the
+        track overlaps the box, and the track passes through a cell that does.
+
+        :param box: the minimum latitude and longitude, and maximum latitude
+                    and longitude in degrees
+
+        :param filter: the filter terms (see :class:`.QueryCompiler`)
+
+        :param format: the output format, which is one of ``summary``,
+                       ``detail`` or ``json``
+
+        :param limit: the maximum number of activities to write
+
+        :param order: the field to order by, which is descending when prefixed
+                      with ``-``
+
+        :param writer: the writer object, which default to sys.stdout
+
+        """
+        self._write_geo(self.geo_grid.box_ranges(box), box,
+                        filter, format, limit, order, writer)
+
+    def _write_lap(self, alap: ActivityLap, writer: TextIOBase):
+        lap = alap.lap
+        name = self.persister.activity_factory.char_to_name[alap.type_char]
+        vals = []
+        if lap.total_seconds is not None:
+            mins, secs = divmod(round(lap.total_seconds), 60)
+            vals.append(f'{mins}:{secs:02}')
+        if lap.distance is not None:
+            vals.append(f'{lap.distance / 1000:.2f}km')
+        for attr, unit in (('heart_rate_average', 'bpm'),
+                           ('power_average', 'W'),
+                           ('cadence', 'rpm')):
+            val = getattr(lap, attr)
+            if val is not None:
+                vals.append(f'{val:.0f}{unit}')
+        if lap.intensity is not None:
+            vals.append(lap.intensity)
+        date = alap.start_time.strftime('%Y-%m-%d')
+        writer.write(f'{alap.activity_id}: date={date}, sport={name}, ' +
+                     f'lap {lap.index}: {", ".join(vals)}\n')
+
+    def write_laps(self, filter: str, limit: int = None, order: str = '-date',
+                   writer: TextIOBase = sys.stdout):
+        """Write laps that match a filter query.
+
+        :param filter: the filter terms (see :class:`.LapQueryCompiler`)
+
+        :param limit: the maximum number of laps to write
+
+        :param order: the field to order by, which is descending when prefixed
+                      with ``-``
+
+        :param writer: the writer object, which default to sys.stdout
+
+        """
+        query = self.lap_query_compiler.compile(filter, limit, order)
+        logger.debug(f'lap query: {query}')
+        for alap in self.persister.get_laps_by_query(query):
+            self._write_lap(alap, writer)
+
+    def _preview_series(self, rows: Iterable[Tuple], points: int) -> \
+            Iterable[Tuple[str, str, datetime, Dict[str, Tuple[List]]]]:
+        """Return the level of each activity with the fewest points that has
+        at least ``points``, or the level with the most points if none do.
+
+        :param rows: the levels of the activities ordered by descending
+                     points (see :meth:`.Persister.get_series`)
+
+        :return: the activity ID, type name, start (UTC) and the times,
+                 values, minimums and maximums of each series
+
+        """
+        names = self.persister.activity_factory.char_to_name
+        decode = self.series_pyramid.decode
+        chosen: Dict[str, Tuple] = {}
+        for row in rows:
+            aid, level_points = row[0], row[3]
+            if aid not in chosen or level_points >= points:
+                chosen[aid] = row
+        for aid, atype, start, _, _, data in chosen.values():
+            arr = decode(data)
+            series = {}
+            for name in filter(lambda n: f'{n}_time' in arr.dtype.names,
+                               self.series_pyramid.series):
+                times = arr[f'{name}_time']
+                # rows past the end of a series with fewer points are nan
+                valid = times == times
+                series[name] = tuple(map(
+                    lambda c: arr[c][valid].astype(float).round(2).tolist(),
+                    (f'{name}_time', name, f'{name}_min', f'{name}_max')))
+            yield aid, names[atype], start, series
+
+    def write_preview(self, activity_id: str = None, start: datetime = None,
+                      days: int = 1, points: int = 128,
+                      format: str = 'csv', writer: TextIOBase = sys.stdout):
+        """Write the downsampled series of an activity or the activities of a
+        span of days (see :class:`.SeriesPyramid`).
+
+        :param activity_id: the ID of the activity, or ``None`` for those
+                            starting in the span of days
+
+        :param start: the first day of the span
+
+        :param days: the number of days in the span
+
+        :param points: the fewest points to write of each series, which are
+                       taken from the smallest level with at least as many
+
+        :param format: ``csv`` for the activity, series, seconds from the
+                       start, value, minimum and maximum of each point, or
+                       ``json``
+
+        :param writer: the writer object, which default to sys.stdout
+
+        """
+        if start is not None:
+            start = datetime(start.year, start.month, start.day)
+        rows = self.persister.get_series(
+            activity_id, start,
+            None if start is None else start + timedelta(days=days))
+        previews = self._preview_series(rows, points)
+        if format == 'json':
+            json.dump(list(map(lambda p: {
+                'id': p[0], 'type': p[1], 'start': p[2].isoformat() + 'Z',
+                'series': {k: dict(zip('time value min max'.split(), v))
+                           for k, v in p[3].items()}}, previews)),
+                      writer, indent=4)
+            writer.write('\n')
+        else:
+            writer.write('id,series,seconds,value,min,max\n')
+            for aid, _, _, series in previews:
+                for name, cols in series.items():
+                    for vals in zip(*cols):
+                        writer.write(f'{aid},{name},' +
+                                     ','.join(map(str, vals)) + '\n')
@@ -0,0 +1,196 @@
+"""Downsampled series of activity tracks used to preview them.
+
+"""
+__author__ = 'Paul Landes'
+
+from typing import Tuple, Dict, Any
+from dataclasses import dataclass, field
+import logging
+import zlib
+from io import BytesIO
+from pathlib import Path
+from . import GarmdownError, Track, read_track
+
+logger = logging.getLogger(__name__)
+
+
+def _numpy():
+    """Import NumPy, which is optional and only needed for series."""
+    try:
+        import numpy as np
+    except ImportError as e:
+        raise GarmdownError(f'numpy is needed for series: {e}')
+    return np
+
+
+@dataclass
+class SeriesPyramid(object):
+    """Downsamples the series of a track to each of a few sizes (the levels of
+    the pyramid), so that a preview of an activity is read from the database
+    rather than parsed from its file.
+
+    Each series is downsampled with Largest Triangle Three Buckets (LTTB),
+    which keeps the point of each bucket that forms the largest triangle with
+    the point kept from the bucket before and the average of the bucket after,
+    so peaks and the shape of the series survive.  The minimum and maximum of
+    each bucket are kept with it as an envelope.  A level is a NumPy
+    structured array with a row per bucket and, for each series, the
+    ``<series>_time`` (seconds from the start of the activity) and value of
+    the kept point, and the ``<series>_min`` and ``<series>_max`` of the
+    bucket.  Series the track did not record are left out.
+
+    """
+    SERIES = ('heart_rate', 'power', 'speed', 'altitude')
+    """The track arrays that are downsampled by default."""
+
+    levels: Tuple[int] = field(default=(512, 128, 32))
+    """The number of points of each level."""
+
+    series: Tuple[str] = field(default=SERIES)
+    """The names of the :class:`.Track` arrays to downsample."""
+
+    def __post_init__(self):
+        self.levels = tuple(sorted(map(int, self.levels), reverse=True))
+        if len(self.levels) == 0 or self.levels[-1] < 3:
+            raise GarmdownError(
+                f'series levels must have at least 3 points: {self.levels}')
+        bad = set(self.series) - set(Track.COLUMNS[1:])
+        if len(bad) > 0:
+            raise GarmdownError(f'unknown track series: {", ".join(bad)}')
+
+    @property
+    def key(self) -> str:
+        """The levels and series, which are stored with the levels so that
+        they are built again after the configuration changes.
+
+        """
+        return f'{",".join(map(str, self.levels))}:{",".join(self.series)}'
+
+    @property
+    def available(self) -> bool:
+        """Whether NumPy, which is needed to build the series, is installed.
+        """
+        try:
+            _numpy()
+            return True
+        except GarmdownError:
+            return False
+
+    @staticmethod
+    def _lttb(np, x, y, edges):
+        """Return the indexes of the points kept by LTTB.  The first and last
+        points are kept and one point is kept from each bucket of the points
+        in between, which are split by ``edges``.
+
+        """
+        n = len(edges) + 2
+        # the average of each bucket (the last is the last point) computed
+        # from cumulative sums rather than a loop over the buckets
+        bounds = np.append(edges, len(x) - 1)
+        counts = np.diff(bounds)
+        cx = np.concatenate(([0], np.cumsum(x)))
+        cy = np.concatenate(([0], np.cumsum(y)))
+        avg_x = np.append((cx[bounds[1:]] - cx[bounds[:-1]]) / counts, x[-1])
+        avg_y = np.append((cy[bounds[1:]] - cy[bounds[:-1]]) / counts, y[-1])
+        idx = np.empty(n, dtype=np.intp)
+        idx[0], idx[-1] = 0, len(x) - 1
+        a = 0
+        for i in range(n - 2):
+            lo, hi = bounds[i], bounds[i + 1]
+            ax, ay = x[a], y[a]
+            # twice the area of the triangle with each point in the bucket
+            area = np.abs((ax - avg_x[i + 1]) * (y[lo:hi] - ay) -
+                          (ax - x[lo:hi]) * (avg_y[i + 1] - ay))
+            a = lo + int(np.argmax(area))
+            idx[i + 1] = a
+        return idx
+
+    def downsample(self, time, values, points: int) -> Tuple:
+        """Downsample a series.
+
+        :param time: the seconds of each value
+
+        :param values: the values, which have no ``nan``
+
+        :param points: the number of points to downsample to
+
+        :return: the time and value of each kept point, and the minimum and
+                 maximum of each bucket
+
+        """
+        np = _numpy()
+        size = len(values)
+        if size <= points:
+            return time, values, values, values
+        # split the points between the first and last in to points - 2 buckets
+        edges = np.linspace(1, size - 1, points - 1).astype(np.intp)[:-1]
+        idx = self._lttb(np, time, values, edges)
+        inner = values[1:-1]
+        starts = edges - 1
+        lows = np.concatenate(([values[0]], np.minimum.reduceat(inner, starts),
+                               [values[-1]]))
+        highs = np.concatenate(([values[0]],
+                                np.maximum.reduceat(inner, starts),
+                                [values[-1]]))
+        return time[idx], values[idx], lows, highs
+
+    def build(self, track: Track) -> Tuple[float, Tuple[Tuple[int, int, Any]]]:
+        """Downsample the series of a track to each level.
+
+        :return: the start of the track in seconds since the UNIX epoch (or
+                 ``None`` if it has no points), and the number of points, row
+                 count and structured array of each level
+
+        """
+        np = _numpy()
+        time = np.asarray(track.time, dtype=np.float64)
+        valid = np.isfinite(time)
+        if not valid.any():
+            return None, ()
+        start = float(time[valid][0])
+        time = time - start
+        series: Dict[str, Tuple] = {}
+        for name in self.series:
+            vals = np.asarray(getattr(track, name), dtype=np.float64)
+            mask = valid & np.isfinite(vals)
+            if mask.sum() >= 2:
+                series[name] = (time[mask], vals[mask])
+        levels = []
+        for points in self.levels:
+            cols = {name: self.downsample(t, v, points)
+                    for name, (t, v) in series.items()}
+            rows = max(map(lambda c: len(c[0]), cols.values()), default=0)
+            dtype = []
+            for name in cols.keys():
+                dtype.extend(((f'{name}_time', 'f4'), (name, 'f4'),
+                              (f'{name}_min', 'f4'), (f'{name}_max', 'f4')))
+            arr = np.full(rows, np.nan, dtype=dtype)
+            for name, col in cols.items():
+                for suffix, vals in zip(('_time', '', '_min', '_max'), col):
+                    arr[f'{name}{suffix}'][:len(vals)] = vals
+            levels.append((points, rows, arr))
+        return start, tuple(levels)
+
+    @staticmethod
+    def encode(arr) -> bytes:
+        """Return a level array as compressed bytes."""
+        bio = BytesIO()
+        _numpy().save(bio, arr, allow_pickle=False)
+        return zlib.compress(bio.getvalue())
+
+    @staticmethod
+    def decode(data: bytes):
+        """Return the level array of bytes created by :meth:`encode`."""
+        bio = BytesIO(zlib.decompress(data))
+        return _numpy().load(bio, allow_pickle=False)
+
+    def read_levels(self, path: Path) -> \
+            Tuple[float, Tuple[Tuple[int, int, bytes]]]:
+        """Like :meth:`build` but read the track from a downloaded activity
+        file and return the levels encoded (see :meth:`encode`), which is
+        smaller to send back from a pool process.
+
+        """
+        start, levels = self.build(read_track(path))
+        return start, tuple(map(lambda lv: (*lv[:2], self.encode(lv[2])),
+                                levels))
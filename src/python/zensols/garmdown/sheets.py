@@ -3,18 +3,17 @@
 """
 __author__ = 'Paul Landes'
 
-from typing import Iterable
+from typing import Iterable, Tuple, List, Dict, Any
 from dataclasses import dataclass, field
 import logging
+import re
+import time
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
 import itertools as it
-import httplib2 as hl
-from oauth2client import file, client, tools
-import googleapiclient.discovery as gd
 from zensols.persist import persisted
 from zensols.config import Settings
-from . import Persister, ActivityFactory
+from . import GarmdownError, Persister, ActivityFactory, SheetRowIndex
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +23,9 @@ class CompletedEntry(object):
     spreadsheet.
 
     """
+    COLUMNS = ('swim', 'bike', 'run', 'strength')
+    """The sport columns of a row in order."""
+
     def __init__(self, idx, row_offset, datestr,
                  swim=None, bike=None, run=None, strength=None):
         """Initialize.
@@ -35,6 +37,7 @@ class CompletedEntry(object):
         """
         self.idx = idx
         self.row_offset = row_offset
+        self.datestr = datestr
         self.date = datetime.strptime(datestr, '%m/%d/%Y')
         self.exists = not (swim is None and bike is None and run is None)
         self.swim = 0 if (swim is None or len(swim) == 0) else float(swim)
@@ -46,10 +49,18 @@ class CompletedEntry(object):
     def rowidx(self):
         return self.idx + self.row_offset
 
+    @property
+    def has_data(self) -> bool:
+        """Whether the row has data to write, which is the case for rows that
+        read as existing after they are written.
+
+        """
+        return any(map(lambda x: x is not None, self.row))
+
     @property
     @persisted('_row')
     def row(self):
-        row = (self.swim, self.bike, self.run, self.strength)
+        row = tuple(map(lambda c: getattr(self, c), self.COLUMNS))
         row = tuple(map(lambda x: None if x == 0 else x, row))
         return row
 
@@ -131,15 +142,70 @@ class SheetUpdater(object):
     completed_cell_range_format: str = field()
     """Completed data cell range (same as date_cell_range)."""
 
+    weekly_cell_range_format: str = field(default=None)
+    """The cell range of the weekly totals (same as
+    :obj:`completed_cell_range_format`), or ``None`` to not write them.  Each
+    row has the Monday of the week followed by the minutes, stress score and
+    number of activities of each sport column.
+
+    """
+    monthly_cell_range_format: str = field(default=None)
+    """Like :obj:`weekly_cell_range_format` but for each month."""
+
+    rollup_row_offset: int = field(default=2)
+    """The first row of the weekly and monthly totals."""
+
+    row_index: bool = field(default=True)
+    """Whether to cache the date to row mapping of the sheet in the database
+    and write rows through a queue in the database.  When the cache matches
+    the sheet, a sync reads only the first and last date cells and the rows it
+    writes rather than the entire date and completed columns.
+
+    """
+    flush_retries: int = field(default=3)
+    """The number of times a failed write of the queued rows is retried before
+    they are left in the queue for the next sync.
+
+    """
+    flush_backoff: float = field(default=2)
+    """The number of seconds before retrying a failed write of the queued
+    rows, which doubles after each retry.
+
+    """
+    backend: Any = field(default=None)
+    """The Sheets API service used instead of the Google service built from
+    :obj:`cred_file` and :obj:`token_file`, such as a
+    :class:`.LocalSheetsService`.
+
+    """
+    CELL_RANGE_REGEX = re.compile(
+        r'^(?:(.+)!)?([A-Z]+)(\d+)(?::[A-Z]+(\d+))?$')
+    """Parses the sheet name, column, first and last row of a cell range."""
+
     def __post_init__(self):
-        self.act_char_to_col_type = self.act_char_to_col_type.asdict()
+        if isinstance(self.act_char_to_col_type, Settings):
+            self.act_char_to_col_type = self.act_char_to_col_type.asdict()
 
     @property
-    @persisted('_service', cache_global=True)
     def service(self):
-        """The Google Sheets API wrapper service.
+        """The Sheets API wrapper service, which is :obj:`backend` if given.
+
+        """
+        if self.backend is not None:
+            return self.backend
+        return self._google_service
+
+    @property
+    @persisted('_google_service_pw', cache_global=True)
+    def _google_service(self):
+        """The Google Sheets API wrapper service.  The Google client libraries
+        are imported here so actions that only use the database do not pay to
+        load them.
 
         """
+        import httplib2 as hl
+        from oauth2client import file, client, tools
+        import googleapiclient.discovery as gd
         logger.info(f'getting last update with {self.cred_file} ' +
                     f'with file {self.token_file}')
         store = file.Storage(self.token_file)
@@ -191,6 +257,13 @@ class SheetUpdater(object):
             range=range,
             body=body).execute()
 
+    def _get_ranges(self, ranges: List[str]) -> List[Tuple[Tuple[str]]]:
+        "Get the data of several ranges in one request via the Google API."
+        result = self.sheet.values().batchGet(
+            spreadsheetId=self.sheet_id, ranges=ranges).execute()
+        return list(map(lambda r: r.get('values', ()),
+                        result.get('valueRanges', ())))
+
     @persisted('_completed_entries')
     def _get_completed_entries(self) -> Iterable[CompletedEntry]:
         "Return completed training entries from the spreadsheet."
@@ -203,10 +276,11 @@ class SheetUpdater(object):
         if ldates > lcompleted:
             completed = it.chain(completed, ((),) * (ldates - lcompleted))
         data = enumerate(zip(dates, completed))
-        return map(lambda x: CompletedEntry(
-            x[0], self.row_offset, x[1][0][0], *x[1][1]), data)
+        return tuple(map(lambda x: CompletedEntry(
+            x[0], self.row_offset, x[1][0][0], *x[1][1]), data))
 
-    def _get_update_range_entries(self, last_idx=None, end_date=None):
+    def _get_update_range_entries(self, last_idx=None, end_date=None,
+                                  entries=None):
         """Return an updated range.
 
         :param last_idx: the last completed work out entry index (0 based), or
@@ -215,8 +289,12 @@ class SheetUpdater(object):
         :param end_date: the last date to constraint entry range
         :type end_date: datetime.datetime
 
+        :param entries: the entries to select from, which defaults to all
+            those in the spreadsheet
+
         """
-        entries = tuple(self._get_completed_entries())
+        if entries is None:
+            entries = tuple(self._get_completed_entries())
         if last_idx is None:
             last_idx = -1
             for last in filter(lambda x: x.exists, entries):
@@ -227,6 +305,108 @@ class SheetUpdater(object):
         return filter(lambda x: x.idx > last_idx and x.date < end_date,
                       entries)
 
+    def _date_cell(self, idx: int) -> str:
+        """Return the date cell of the row with (0 based) index ``idx``, or
+        ``None`` if it is past the end of :obj:`date_cell_range`.
+
+        """
+        m = self.CELL_RANGE_REGEX.match(self.date_cell_range)
+        if m is None:
+            raise GarmdownError(
+                f'bad date cell range: {self.date_cell_range}')
+        sheet, col, start, end = m.groups()
+        row = int(start) + idx
+        if end is not None and row > int(end):
+            return None
+        return f'{sheet}!{col}{row}' if sheet is not None else f'{col}{row}'
+
+    def _index_rows(self, entries: Tuple[CompletedEntry]) -> SheetRowIndex:
+        """Create and persist the row index from all entries of the sheet."""
+        dates = tuple(map(lambda e: (e.idx, e.date), entries))
+        last_idx = -1
+        for last in filter(lambda x: x.exists, entries):
+            last_idx = last.idx
+        first, last = (None, None) if len(entries) == 0 else \
+            (entries[0].datestr, entries[-1].datestr)
+        index = SheetRowIndex(self.sheet_id, self.date_cell_range,
+                              len(entries), last_idx, first, last)
+        logger.info(f'indexed sheet rows: {index}')
+        self.persister.set_sheet_index(index, dates)
+        return index
+
+    def _get_row_index(self) -> SheetRowIndex:
+        """Return the cached row index, which is created from the entire sheet
+        if it is missing or was created from a different date range.
+
+        """
+        index = self.persister.get_sheet_index(self.sheet_id)
+        if index is None or index.date_range != self.date_cell_range:
+            index = self._index_rows(tuple(self._get_completed_entries()))
+        return index
+
+    def _read_queued_rows(self, dates: Tuple[datetime]) -> \
+            Tuple[SheetRowIndex, Dict[datetime, CompletedEntry]]:
+        """Return the sheet entries of the dates of queued rows.  The cached
+        row index is validated in the same request by reading the first and
+        last dated cells and the cell after the last.  The index is created
+        again from the entire sheet when it does not match.
+
+        :return: the index and the entries of the dates found in the sheet
+
+        """
+        index = self._get_row_index()
+        # the index was just created from the entries read in this sync
+        fresh = hasattr(self, '_completed_entries') and \
+            self._completed_entries.is_set()
+        if index.rows > 0 and not fresh:
+            rows = self.persister.get_sheet_rows(
+                self.sheet_id, -1, datetime.max)
+            date_to_idx = {d: i for i, d in rows}
+            idxs = sorted(filter(lambda i: i is not None,
+                                 map(date_to_idx.get, dates)))
+            checks = [self._date_cell(0), self._date_cell(index.rows - 1)]
+            after = self._date_cell(index.rows)
+            if after is not None:
+                checks.append(after)
+            spans = self._spans(idxs)
+            ranges = checks + list(map(
+                lambda s: self._get_completed_cell_range(
+                    s[0] + self.row_offset, s[-1] + self.row_offset), spans))
+            data = self._get_ranges(ranges)
+            cells = tuple(map(lambda d: d[0][0] if len(d) > 0 and
+                              len(d[0]) > 0 else None, data[:len(checks)]))
+            expect = (index.first_date, index.last_date, None)
+            if cells == expect[:len(cells)]:
+                idx_to_date = {i: d for d, i in date_to_idx.items()}
+                entries = {}
+                for span, vals in zip(spans, data[len(checks):]):
+                    vals = it.chain(vals, it.repeat(()))
+                    for idx, val in zip(span, vals):
+                        date = idx_to_date[idx]
+                        entries[date] = CompletedEntry(
+                            idx, self.row_offset, date.strftime('%m/%d/%Y'),
+                            *val)
+                return index, entries
+            logger.info(f'sheet changed since it was indexed: {cells}')
+        entries = tuple(self._get_completed_entries())
+        if not fresh:
+            index = self._index_rows(entries)
+        dates = set(dates)
+        return index, {e.date: e for e in entries if e.date in dates}
+
+    @staticmethod
+    def _spans(idxs: Iterable[int]) -> List[Tuple[int]]:
+        """Group sorted row indexes in to runs of consecutive rows."""
+        return list(map(lambda g: tuple(map(lambda x: x[1], g[1])),
+                        it.groupby(enumerate(idxs), lambda x: x[1] - x[0])))
+
+    def _set_ranges(self, data: List[Dict[str, Any]]):
+        "Set the data of several ranges in one request via the Google API."
+        self.sheet.values().batchUpdate(
+            spreadsheetId=self.sheet_id,
+            body={'valueInputOption': 'USER_ENTERED',
+                  'data': data}).execute()
+
     def _sync_entries_with_db(self, entries, clobber: bool = False):
         """Populate database data in to ``entries``.
 
@@ -240,13 +420,62 @@ class SheetUpdater(object):
         logger.info(f'syncing {len(entries)} with activity database')
         for entry in entries:
             if clobber or not entry.exists:
-                acts = self.persister.get_activities_by_date(entry.date)
+                acts = self.persister.get_activities_by_date(
+                    entry.date, primaries=True)
                 if logger.isEnabledFor(logging.DEBUG):
                     types = ', '.join(map(lambda x: x.type, acts))
                     logger.debug(f'found {types} activities for {entry}')
                 entry.update(acts, self.act_char_to_col_type)
             logger.debug(f'updated: {entry}')
 
+    def _get_rollups(self, first: datetime, last: datetime) -> \
+            List[Dict[str, Any]]:
+        """Return the weekly and monthly totals of the days of the sheet as
+        batch update data, which are computed from the daily totals of one
+        grouped query.
+
+        :param first: the first day in the sheet
+
+        :param last: the last day in the sheet
+
+        """
+        def week(day: datetime) -> datetime:
+            return day - timedelta(days=day.weekday())
+
+        def month(day: datetime) -> datetime:
+            return day.replace(day=1)
+
+        fmts = filter(lambda f: f[0], ((self.weekly_cell_range_format, week),
+                                       (self.monthly_cell_range_format, month)))
+        fmts = tuple(fmts)
+        if len(fmts) == 0 or first is None:
+            return []
+        end = last + timedelta(days=1)
+        totals = self.persister.get_daily_totals(first, end)
+        cols = CompletedEntry.COLUMNS
+        ndays = (end - first).days
+        data = []
+        for fmt, period in fmts:
+            # every period is written so totals that dropped to zero are too
+            periods = {}
+            for day in map(lambda i: first + timedelta(days=i), range(ndays)):
+                if period(day) not in periods:
+                    periods[period(day)] = {c: [0, 0, 0] for c in cols}
+            for day, atype, count, secs, tss in totals:
+                col = self.act_char_to_col_type.get(atype)
+                if col in cols:
+                    tot = periods[period(day)][col]
+                    tot[0] += (secs or 0) / 60
+                    tot[1] += tss
+                    tot[2] += count
+            rows = list(map(lambda p: [p[0].strftime('%m/%d/%Y'), *it.chain(
+                *map(lambda c: (round(p[1][c][0], 2), *p[1][c][1:]), cols))],
+                periods.items()))
+            start = self.rollup_row_offset
+            data.append({'range': fmt.format(start, start + len(rows) - 1),
+                         'values': rows})
+        return data
+
     def _upload_row_data(self, entries):
         """Upload workout data to Google.
 
@@ -258,12 +487,130 @@ class SheetUpdater(object):
         range = self._get_completed_cell_range(
             entries[0].rowidx, entries[-1].rowidx)
         logger.info(f'updating {len(rows)} rows with range {range}')
-        self._set_data(rows, range)
+        sheet = self._get_completed_entries()
+        rollups = self._get_rollups(sheet[0].date, sheet[-1].date)
+        if len(rollups) > 0:
+            self._set_ranges([{'range': range, 'values': rows}] + rollups)
+        else:
+            self._set_data(rows, range)
+
+    def enqueue(self, end_date: datetime = None) -> int:
+        """Add the rows of the days after the last queued or completed row to
+        the write queue.  The rows are computed from the cached row index and
+        the activity database without reading the sheet, unless there is no
+        index yet.  A row queued again replaces the one in the queue.
+
+        :param end_date: the day after the last row to queue, which defaults
+            to today
+
+        :return: the number of rows queued
 
-    def sync(self):
-        """Download outstanding activities and add them to the 
         """
-        entries = tuple(self._get_update_range_entries())
+        if end_date is None:
+            end_date = datetime.now()
+        index = self._get_row_index()
+        rows = self.persister.get_sheet_rows(
+            self.sheet_id, index.last_idx, end_date)
+        entries = tuple(map(lambda r: CompletedEntry(
+            r[0], self.row_offset, r[1].strftime('%m/%d/%Y')), rows))
         if len(entries) > 0:
             self._sync_entries_with_db(entries)
-            self._upload_row_data(entries)
+        entries = tuple(filter(lambda e: e.has_data, entries))
+        if len(entries) > 0:
+            self.persister.queue_sheet_rows(
+                self.sheet_id, map(lambda e: (e.date, e.row), entries))
+            self.persister.set_sheet_last_idx(self.sheet_id, entries[-1].idx)
+        logger.info(f'queued {len(entries)} sheet rows')
+        return len(entries)
+
+    def _flush(self, queue: Tuple[Tuple[datetime, Tuple, datetime, int]]) \
+            -> int:
+        """Write the queued rows that are not already completed in the sheet
+        and remove them from the queue.
+
+        """
+        index, entries = self._read_queued_rows(
+            tuple(map(lambda q: q[0], queue)))
+        rows = {}
+        for date, row, queue_time, attempts in queue:
+            entry = entries.get(date)
+            if entry is None:
+                logger.warning(f'no row in sheet for queued {date}')
+            elif entry.exists:
+                logger.info(f'skipping row completed in sheet: {entry}')
+            else:
+                rows[entry.idx] = row
+        spans = self._spans(sorted(rows.keys()))
+        data = list(map(lambda s: {
+            'range': self._get_completed_cell_range(
+                s[0] + self.row_offset, s[-1] + self.row_offset),
+            'values': list(map(rows.get, s))}, spans))
+        if len(data) > 0:
+            logger.info(f'updating {len(rows)} rows in {len(data)} ranges')
+            first, last = map(
+                lambda d: None if d is None else
+                datetime.strptime(d, '%m/%d/%Y'),
+                (index.first_date, index.last_date))
+            self._set_ranges(data + self._get_rollups(first, last))
+            if spans[-1][-1] > index.last_idx:
+                self.persister.set_sheet_last_idx(
+                    self.sheet_id, spans[-1][-1])
+        self.persister.dequeue_sheet_rows(
+            self.sheet_id, map(lambda q: (q[0], q[2]), queue))
+        return len(rows)
+
+    def flush(self) -> int:
+        """Write the queued rows to the sheet in one request.  A failed
+        request is retried :obj:`flush_retries` times, waiting
+        :obj:`flush_backoff` seconds doubled after each failure, after which
+        the rows are left in the queue for the next flush.
+
+        :return: the number of rows written
+
+        """
+        queue = self.persister.get_sheet_queue(self.sheet_id)
+        if len(queue) == 0:
+            return 0
+        for attempt in range(self.flush_retries + 1):
+            try:
+                return self._flush(queue)
+            except Exception as e:
+                if attempt == self.flush_retries:
+                    logger.error(f'could not write {len(queue)} queued ' +
+                                 f'sheet rows: {e}')
+                    self.persister.fail_sheet_queue(
+                        self.sheet_id, attempt + 1, str(e))
+                    return 0
+                wait = self.flush_backoff * (2 ** attempt)
+                logger.warning(f'sheet update failed ({e}), ' +
+                               f'retrying in {wait:.0f}s')
+                time.sleep(wait)
+                if hasattr(self, '_completed_entries'):
+                    self._completed_entries.clear()
+
+    def sync(self):
+        """Download outstanding activities and add them to the spreadsheet.  The
+        spreadsheet is read again on each call so that long running processes
+        see rows updated since the last call.
+
+        With :obj:`row_index`, the rows are added to the write queue and then
+        flushed (see :meth:`enqueue` and :meth:`flush`).  An update that can
+        not be written to the sheet stays queued and does not raise an error,
+        so it does not fail the Garmin sync.
+
+        """
+        if hasattr(self, '_completed_entries'):
+            self._completed_entries.clear()
+        if self.row_index:
+            try:
+                self.enqueue()
+            except Exception as e:
+                logger.error(f'could not queue sheet rows: {e}',
+                             exc_info=True)
+                return
+            self.flush()
+        else:
+            entries = tuple(self._get_update_range_entries())
+            if len(entries) > 0:
+                self._sync_entries_with_db(entries)
+                self._upload_row_data(entries)
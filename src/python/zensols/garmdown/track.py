@@ -0,0 +1,561 @@
+"""Read the trackpoints and laps of downloaded TCX and FIT activity files.
+
+"""
+__author__ = 'Paul Landes'
+
+from typing import Dict, Tuple, List, Set, Iterable, Callable
+from dataclasses import dataclass, field
+import logging
+import math
+import struct
+from array import array
+from pathlib import Path
+from datetime import datetime, timezone
+import xml.etree.ElementTree as et
+from . import GarmdownError
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Track(object):
+    """The trackpoints of an activity as parallel arrays of floats, one per
+    trackpoint, with ``nan`` where a value was not recorded.
+
+    """
+    COLUMNS = ('time latitude longitude altitude distance heart_rate ' +
+               'cadence power speed').split()
+    """The names of the arrays."""
+
+    time: array = field(default_factory=lambda: array('d'))
+    """The seconds since the UNIX epoch (UTC)."""
+
+    latitude: array = field(default_factory=lambda: array('d'))
+    """The latitude in degrees."""
+
+    longitude: array = field(default_factory=lambda: array('d'))
+    """The longitude in degrees."""
+
+    altitude: array = field(default_factory=lambda: array('d'))
+    """The altitude in meters."""
+
+    distance: array = field(default_factory=lambda: array('d'))
+    """The distance from the start in meters."""
+
+    heart_rate: array = field(default_factory=lambda: array('d'))
+    """The heart rate in beats per minute."""
+
+    cadence: array = field(default_factory=lambda: array('d'))
+    """The cadence in revolutions (or steps) per minute."""
+
+    power: array = field(default_factory=lambda: array('d'))
+    """The power in watts."""
+
+    speed: array = field(default_factory=lambda: array('d'))
+    """The speed in meters per second."""
+
+    def append(self, point: Dict[str, float]):
+        """Add a trackpoint given as column names to values."""
+        nan = math.nan
+        for col in self.COLUMNS:
+            getattr(self, col).append(point.get(col, nan))
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    def __str__(self) -> str:
+        return f'track: {len(self)} points'
+
+
+@dataclass
+class Lap(object):
+    """A lap (or split) of an activity as summarized by the device, with
+    ``None`` for values that were not recorded.
+
+    """
+    COLUMNS = ('start_time total_seconds distance heart_rate_average ' +
+               'heart_rate_max cadence power_average calories ' +
+               'intensity').split()
+    """The names of the values stored in the database."""
+
+    index: int = field()
+    """The 0 based index of the lap in the activity."""
+
+    start_time: datetime = field(default=None)
+    """When the lap started in (time zone naive) UTC."""
+
+    total_seconds: float = field(default=None)
+    """The timer time, which leaves out when the timer was paused."""
+
+    distance: float = field(default=None)
+    """The distance in meters."""
+
+    heart_rate_average: float = field(default=None)
+    """The average heart rate in beats per minute."""
+
+    heart_rate_max: float = field(default=None)
+    """The maximum heart rate in beats per minute."""
+
+    cadence: float = field(default=None)
+    """The average cadence in revolutions (or steps) per minute."""
+
+    power_average: float = field(default=None)
+    """The average power in watts."""
+
+    calories: float = field(default=None)
+    """The energy used in kilocalories."""
+
+    intensity: str = field(default=None)
+    """How the lap was planned, such as ``active``, ``resting``, ``warmup``
+    or ``cooldown``.
+
+    """
+    @property
+    def values(self) -> Tuple:
+        """The values of :obj:`COLUMNS`."""
+        return tuple(map(lambda c: getattr(self, c), self.COLUMNS))
+
+    def __str__(self) -> str:
+        return f'lap {self.index}: {self.total_seconds}s, {self.distance}m'
+
+
+@dataclass
+class ActivityLap(object):
+    """A lap found by a lap query with the activity it is part of.
+
+    """
+    activity_id: str = field()
+    """The ID of the activity."""
+
+    start_time: datetime = field()
+    """The (local) start time of the activity."""
+
+    type_char: str = field()
+    """The sport type character of the activity."""
+
+    lap: Lap = field()
+    """The lap."""
+
+
+class TcxReader(object):
+    """Reads the trackpoints or laps of a TCX file.  The file is parsed
+    incrementally and each trackpoint is discarded after it is read.
+
+    """
+    TAGS = {'LatitudeDegrees': 'latitude',
+            'LongitudeDegrees': 'longitude',
+            'AltitudeMeters': 'altitude',
+            'DistanceMeters': 'distance',
+            'Cadence': 'cadence',
+            'RunCadence': 'cadence',
+            'Watts': 'power',
+            'Speed': 'speed'}
+    """Trackpoint child element (local) names to :class:`.Track` columns."""
+
+    LAP_TAGS = {'TotalTimeSeconds': 'total_seconds',
+                'DistanceMeters': 'distance',
+                'Calories': 'calories',
+                'Cadence': 'cadence',
+                'AvgRunCadence': 'cadence',
+                'AvgWatts': 'power_average'}
+    """Lap (and lap extension) child element names to :class:`.Lap` values."""
+
+    LAP_HEART_RATES = {'AverageHeartRateBpm': 'heart_rate_average',
+                       'MaximumHeartRateBpm': 'heart_rate_max'}
+    """Lap heart rate element names to :class:`.Lap` values."""
+
+    @staticmethod
+    def _local(tag: str) -> str:
+        return tag[tag.rfind('}') + 1:]
+
+    @staticmethod
+    def _parse_time(text: str) -> datetime:
+        """Parse a TCX time, which Garmin ends with ``Z`` for UTC that
+        :meth:`datetime.fromisoformat` does not parse before Python 3.11.
+
+        """
+        text = text.strip()
+        if text.endswith('Z'):
+            text = text[:-1] + '+00:00'
+        return datetime.fromisoformat(text)
+
+    @classmethod
+    def _utc(cls, text: str) -> datetime:
+        """Parse a TCX time as a time zone naive UTC time."""
+        time = cls._parse_time(text)
+        if time.tzinfo is not None:
+            time = time.astimezone(timezone.utc).replace(tzinfo=None)
+        return time
+
+    def points(self, source: Path) -> Iterable[Dict[str, float]]:
+        """Generate the trackpoints of a TCX file as column names (see
+        :obj:`.Track.COLUMNS`) to values, leaving out those not recorded.
+
+        """
+        tags = self.TAGS
+        point: Dict[str, float] = None
+        stack: List[str] = []
+        for event, elem in et.iterparse(str(source), ('start', 'end')):
+            name = self._local(elem.tag)
+            if event == 'start':
+                if name == 'Trackpoint':
+                    point = {}
+                stack.append(name)
+                continue
+            stack.pop()
+            if point is None:
+                continue
+            if name == 'Trackpoint':
+                if 'time' in point:
+                    yield point
+                point = None
+                elem.clear()
+            elif name == 'Time':
+                point['time'] = self._parse_time(elem.text).timestamp()
+            elif name == 'Value' and stack[-1] == 'HeartRateBpm':
+                point['heart_rate'] = float(elem.text)
+            elif name in tags and elem.text is not None:
+                # the distance of a lap is not that of the trackpoint
+                if stack[-1] in {'Trackpoint', 'Position', 'TPX'}:
+                    point[tags[name]] = float(elem.text)
+
+    def read(self, source: Path) -> Track:
+        """Read the trackpoints of a TCX file."""
+        track = Track()
+        for point in self.points(source):
+            track.append(point)
+        return track
+
+    def read_laps(self, source: Path) -> Tuple[Lap]:
+        """Read the laps of a TCX file."""
+        tags = self.LAP_TAGS
+        rates = self.LAP_HEART_RATES
+        laps: List[Lap] = []
+        lap: Lap = None
+        stack: List[str] = []
+        for event, elem in et.iterparse(str(source), ('start', 'end')):
+            name = self._local(elem.tag)
+            if event == 'start':
+                if name == 'Lap':
+                    start = elem.get('StartTime')
+                    lap = Lap(len(laps),
+                              None if start is None else self._utc(start))
+                stack.append(name)
+                continue
+            stack.pop()
+            if lap is None:
+                continue
+            parent = stack[-1]
+            if name == 'Lap':
+                laps.append(lap)
+                lap = None
+                elem.clear()
+            elif name == 'Trackpoint':
+                elem.clear()
+            elif elem.text is None:
+                continue
+            elif parent in {'Lap', 'LX'}:
+                if name == 'Intensity':
+                    lap.intensity = elem.text.strip().lower()
+                elif name in tags:
+                    setattr(lap, tags[name], float(elem.text))
+            elif name == 'Value' and parent in rates and stack[-2] == 'Lap':
+                setattr(lap, rates[parent], float(elem.text))
+        return tuple(laps)
+
+
+@dataclass
+class _FitDefinition(object):
+    """A FIT definition message, which gives the layout of the data messages
+    of a local message type.
+
+    """
+    global_num: int
+    struct: struct.Struct
+    fields: Tuple[Tuple[int, int, Callable[[int], bool]]]
+    """The field number, index in the unpacked values and invalid value check
+    of each field that is read.
+
+    """
+
+
+class FitReader(object):
+    """A small decoder of FIT files that reads only the record messages, which
+    are the trackpoints, or the lap messages.  Each definition message is
+    compiled in to a :class:`struct.Struct` so that data messages are unpacked
+    in one call.
+
+    """
+    EPOCH = 631065600
+    """The UNIX time of the FIT epoch (1989-12-31 00:00 UTC)."""
+
+    RECORD = 20
+    """The global message number of the record (trackpoint) message."""
+
+    LAP = 19
+    """The global message number of the lap message."""
+
+    TIMESTAMP = 253
+    """The field number of the time stamp in all messages."""
+
+    BASE_TYPES = {0x00: ('B', 0xff), 0x01: ('b', 0x7f), 0x02: ('B', 0xff),
+                  0x83: ('h', 0x7fff), 0x84: ('H', 0xffff),
+                  0x85: ('i', 0x7fffffff), 0x86: ('I', 0xffffffff),
+                  0x88: ('f', None), 0x89: ('d', None),
+                  0x0a: ('B', 0), 0x8b: ('H', 0), 0x8c: ('I', 0),
+                  0x8e: ('q', 0x7fffffffffffffff),
+                  0x8f: ('Q', 0xffffffffffffffff), 0x90: ('Q', 0)}
+    """The FIT base types to their :mod:`struct` format and invalid value."""
+
+    SEMICIRCLES = 180 / 2 ** 31
+    """Degrees per semicircle (the unit of FIT positions)."""
+
+    RECORD_FIELDS = {253: ('time', 1, 0),
+                     0: ('latitude', 1 / SEMICIRCLES, 0),
+                     1: ('longitude', 1 / SEMICIRCLES, 0),
+                     2: ('altitude', 5, 500),
+                     78: ('altitude', 5, 500),
+                     5: ('distance', 100, 0),
+                     3: ('heart_rate', 1, 0),
+                     4: ('cadence', 1, 0),
+                     7: ('power', 1, 0),
+                     6: ('speed', 1000, 0),
+                     73: ('speed', 1000, 0)}
+    """The record field numbers to their column, scale and offset."""
+
+    LAP_FIELDS = {8: ('total_seconds', 1000),
+                  9: ('distance', 100),
+                  11: ('calories', 1),
+                  15: ('heart_rate_average', 1),
+                  16: ('heart_rate_max', 1),
+                  17: ('cadence', 1),
+                  19: ('power_average', 1)}
+    """The lap field numbers to their :class:`.Lap` value and scale."""
+
+    SESSION = 18
+    """The global message number of the session message."""
+
+    SESSION_SPORT = 5
+    """The field number of the sport of a session."""
+
+    SPORTS = ('generic', 'running', 'cycling')
+    """The sport names by their FIT enumeration value."""
+
+    LAP_START = 2
+    """The field number of the start time of a lap."""
+
+    LAP_INTENSITY = 23
+    """The field number of the intensity of a lap."""
+
+    INTENSITIES = ('active', 'resting', 'warmup', 'cooldown')
+    """The lap intensity names by their FIT enumeration value."""
+
+    def __init__(self):
+        self._invalid_checks = {}
+
+    def _invalid_check(self, base_type: int) -> Callable[[int], bool]:
+        check = self._invalid_checks.get(base_type)
+        if check is None:
+            invalid = self.BASE_TYPES[base_type][1]
+            if invalid is None:
+                def check(v):
+                    return math.isnan(v)
+            else:
+                def check(v):
+                    return v == invalid
+            self._invalid_checks[base_type] = check
+        return check
+
+    def _define(self, data: bytes, pos: int, dev: bool) -> \
+            Tuple[_FitDefinition, int]:
+        """Compile the definition message at ``pos``."""
+        big = data[pos + 1] == 1
+        global_num = struct.unpack_from(
+            '>H' if big else '<H', data, pos + 2)[0]
+        n_fields = data[pos + 4]
+        pos += 5
+        fmt = ['>' if big else '<']
+        fields = []
+        index = 0
+        for i in range(n_fields):
+            num, size, base = data[pos], data[pos + 1], data[pos + 2]
+            pos += 3
+            btype = self.BASE_TYPES.get(base)
+            if btype is not None and struct.calcsize(btype[0]) == size:
+                fmt.append(btype[0])
+                fields.append((num, index, self._invalid_check(base)))
+                index += 1
+            else:
+                fmt.append(f'{size}x')
+        if dev:
+            n_dev = data[pos]
+            pos += 1
+            for i in range(n_dev):
+                fmt.append(f'{data[pos + 1]}x')
+                pos += 3
+        defn = _FitDefinition(global_num, struct.Struct(''.join(fmt)),
+                              tuple(fields))
+        return defn, pos
+
+    def _messages(self, data: bytes, nums: Set[int]) -> \
+            Iterable[Tuple[int, Dict[int, int]]]:
+        """Generate the global message number and the valid field values by
+        field number of each data message with a global message number in
+        ``nums``.  The time of a compressed time stamp header is given as the
+        :obj:`TIMESTAMP` field.
+
+        """
+        if len(data) < 12 or data[8:12] != b'.FIT':
+            raise GarmdownError('not a FIT file')
+        header_size = data[0]
+        end = header_size + struct.unpack_from('<I', data, 4)[0]
+        pos = header_size
+        defs: Dict[int, _FitDefinition] = {}
+        last_time = 0
+        while pos < end:
+            header = data[pos]
+            pos += 1
+            offset_time = None
+            if header & 0x80:
+                # compressed time stamp header
+                local = (header >> 5) & 0x03
+                offset = header & 0x1f
+                offset_time = (last_time & ~0x1f) + offset
+                if offset < (last_time & 0x1f):
+                    offset_time += 0x20
+                last_time = offset_time
+            elif header & 0x40:
+                defs[header & 0x0f], pos = self._define(
+                    data, pos, bool(header & 0x20))
+                continue
+            else:
+                local = header & 0x0f
+            defn = defs.get(local)
+            if defn is None:
+                raise GarmdownError(f'undefined FIT local message {local} ' +
+                                    f'at byte {pos - 1}')
+            vals = defn.struct.unpack_from(data, pos)
+            pos += defn.struct.size
+            fields = {} if defn.global_num in nums else None
+            for num, index, invalid in defn.fields:
+                val = vals[index]
+                if invalid(val):
+                    continue
+                if num == self.TIMESTAMP:
+                    last_time = val
+                if fields is not None:
+                    fields[num] = val
+            if fields is not None:
+                if offset_time is not None:
+                    fields.setdefault(self.TIMESTAMP, offset_time)
+                yield defn.global_num, fields
+
+    def decode_points(self, data: bytes) -> Iterable[Dict[str, float]]:
+        """Generate the trackpoints of the FIT file content ``data`` as column
+        names (see :obj:`.Track.COLUMNS`) to values, leaving out those not
+        recorded.
+
+        """
+        record_fields = self.RECORD_FIELDS
+        for _, fields in self._messages(data, {self.RECORD}):
+            point = {}
+            for num, val in fields.items():
+                if num in record_fields:
+                    col, scale, off = record_fields[num]
+                    point[col] = (val / scale) - off
+            if 'time' in point:
+                point['time'] += self.EPOCH
+                yield point
+
+    def decode(self, data: bytes) -> Track:
+        """Decode the record messages of the FIT file content ``data``."""
+        track = Track()
+        for point in self.decode_points(data):
+            track.append(point)
+        return track
+
+    def decode_summary(self, data: bytes) -> Tuple[str, Tuple[Lap]]:
+        """Decode the sport of the (first) session and the laps of the FIT file
+        content ``data`` in one pass.
+
+        :return: the sport name (or ``None`` if not known) and the laps
+
+        """
+        lap_fields = self.LAP_FIELDS
+        intensities = self.INTENSITIES
+        sport: str = None
+        laps: List[Lap] = []
+        for num, fields in self._messages(data, {self.LAP, self.SESSION}):
+            if num == self.SESSION:
+                code = fields.get(self.SESSION_SPORT)
+                if sport is None and code is not None and \
+                        code < len(self.SPORTS):
+                    sport = self.SPORTS[code]
+                continue
+            lap = Lap(len(laps))
+            for num, val in fields.items():
+                if num in lap_fields:
+                    name, scale = lap_fields[num]
+                    setattr(lap, name, val / scale)
+            start = fields.get(self.LAP_START)
+            if start is not None:
+                lap.start_time = datetime.fromtimestamp(
+                    start + self.EPOCH, timezone.utc).replace(tzinfo=None)
+            intensity = fields.get(self.LAP_INTENSITY)
+            if intensity is not None and intensity < len(intensities):
+                lap.intensity = intensities[intensity]
+            laps.append(lap)
+        return sport, tuple(laps)
+
+    def decode_laps(self, data: bytes) -> Tuple[Lap]:
+        """Decode the lap messages of the FIT file content ``data``."""
+        return self.decode_summary(data)[1]
+
+    def read(self, source: Path) -> Track:
+        """Read the trackpoints of a FIT file."""
+        with open(source, 'rb') as f:
+            return self.decode(f.read())
+
+    def read_laps(self, source: Path) -> Tuple[Lap]:
+        """Read the laps of a FIT file."""
+        with open(source, 'rb') as f:
+            return self.decode_laps(f.read())
+
+
+def _reader(path: Path):
+    """Return the reader of a downloaded activity file by its extension."""
+    readers = {'.tcx': TcxReader, '.fit': FitReader}
+    reader = readers.get(path.suffix)
+    if reader is None:
+        raise GarmdownError(f'unknown activity file type: {path}')
+    return reader()
+
+
+def read_points(path: Path) -> Iterable[Dict[str, float]]:
+    """Generate the trackpoints of a downloaded activity file as column names
+    (see :obj:`.Track.COLUMNS`) to values without keeping them in a
+    :class:`.Track`.
+
+    """
+    reader = _reader(path)
+    if isinstance(reader, FitReader):
+        with open(path, 'rb') as f:
+            data = f.read()
+        return reader.decode_points(data)
+    return reader.points(path)
+
+
+def read_track(path: Path) -> Track:
+    """Read the trackpoints of a downloaded activity file, which is either a
+    TCX or FIT file.
+
+    """
+    return _reader(path).read(path)
+
+
+def read_laps(path: Path) -> Tuple[Lap]:
+    """Read the laps of a downloaded activity file, which is either a TCX or
+    FIT file.
+
+    """
+    return _reader(path).read_laps(path)
@@ -0,0 +1,237 @@
+"""Long running process that polls Garmin Connect and syncs new activities.
+
+"""
+__author__ = 'Paul Landes'
+
+from typing import Dict, Any
+from dataclasses import dataclass, field, asdict
+import logging
+import sys
+import os
+import time
+import json
+from io import TextIOBase
+from pathlib import Path
+from datetime import datetime, timedelta
+from . import GarmdownError, SyncStats, Manager, Backuper, SheetUpdater
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class WatchStatus(object):
+    """The state of a :class:`.Watcher` as of its last poll.
+
+    """
+    started: datetime = field(default_factory=datetime.now)
+    """When the watcher started."""
+
+    polls: int = field(default=0)
+    """The number of polls made since the watcher started."""
+
+    last_poll: datetime = field(default=None)
+    """When the last poll finished."""
+
+    last_seconds: float = field(default=0)
+    """The wall time of the last poll in seconds."""
+
+    last_stats: SyncStats = field(default=None)
+    """What was added by the last poll, or ``None`` if it failed."""
+
+    last_change: datetime = field(default=None)
+    """When a poll last added an activity or file."""
+
+    last_error: str = field(default=None)
+    """The error of the last poll, if it failed."""
+
+    totals: SyncStats = field(default_factory=SyncStats)
+    """What was added by all polls since the watcher started."""
+
+    next_poll: datetime = field(default=None)
+    """When the next poll is scheduled."""
+
+    def asjson(self) -> Dict[str, Any]:
+        """Return a JSON serializable representation."""
+        def conv(obj):
+            return obj.isoformat(timespec='seconds') \
+                if isinstance(obj, datetime) else obj
+
+        dct = asdict(self)
+        return {k: conv(v) for k, v in dct.items()}
+
+    def write(self, writer: TextIOBase = sys.stdout):
+        """Write the human readable status."""
+        for k, v in self.asjson().items():
+            if isinstance(v, dict):
+                v = SyncStats(**v)
+            elif isinstance(v, float):
+                v = f'{v:.1f}'
+            writer.write(f'{k.replace("_", " ")}: {v}\n')
+
+
+@dataclass
+class Watcher(object):
+    """Polls Garmin Connect for new activities and syncs them.  Unlike running
+    the ``sync`` action periodically, the Garmin client (and its login
+    session), the database connection and the Google Sheets service are
+    created once and kept for the life of the process.  The backup and sheet
+    steps only run when a poll adds an activity or file.
+
+    The interval between polls is adaptive: it drops to :obj:`min_interval`
+    after a poll that finds something new, grows by :obj:`backoff` after each
+    poll that does not (up to :obj:`max_interval`), and is at least
+    :obj:`quiet_interval` during the quiet hours.  The status of the last poll
+    is written to :obj:`status_file`.
+
+    """
+    manager: Manager = field()
+    """Manages downloading and database work."""
+
+    backuper: Backuper = field()
+    """Creates backups of the SQLite where activities are stored."""
+
+    sheet_updater: SheetUpdater = field()
+    """Updates the Google Sheets spreadsheet, or ``None`` to skip it."""
+
+    status_file: Path = field()
+    """The JSON file with the :class:`.WatchStatus` of the last poll."""
+
+    poll_limit: int = field(default=10)
+    """The number of most recent activities fetched by each poll."""
+
+    min_interval: float = field(default=60)
+    """The number of seconds between polls after an activity appears."""
+
+    max_interval: float = field(default=900)
+    """The maximum number of seconds between polls outside the quiet hours."""
+
+    backoff: float = field(default=2)
+    """The factor the interval grows by after each poll finds nothing."""
+
+    quiet_start: int = field(default=23)
+    """The hour of the day the quiet hours start."""
+
+    quiet_end: int = field(default=6)
+    """The hour of the day the quiet hours end."""
+
+    quiet_interval: float = field(default=3600)
+    """The minimum number of seconds between polls in the quiet hours."""
+
+    def __post_init__(self):
+        if self.min_interval <= 0 or self.max_interval < self.min_interval:
+            raise GarmdownError('watch intervals must satisfy ' +
+                                '0 < min_interval <= max_interval')
+        self._interval = self.min_interval
+
+    def _is_quiet(self, now: datetime) -> bool:
+        start, end, hour = self.quiet_start, self.quiet_end, now.hour
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def _next_interval(self, changed: bool, now: datetime) -> float:
+        """Return the number of seconds to wait until the next poll."""
+        if changed:
+            self._interval = self.min_interval
+        else:
+            self._interval = min(self._interval * self.backoff,
+                                 self.max_interval)
+        if self._is_quiet(now):
+            return max(self._interval, self.quiet_interval)
+        return self._interval
+
+    def _write_status(self, status: WatchStatus):
+        path = self.status_file
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'{path.name}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(status.asjson(), f, indent=4)
+        os.replace(tmp, path)
+
+    def read_status(self) -> WatchStatus:
+        """Return the status written by the last poll of a (possibly running)
+        watcher.
+
+        """
+        if not self.status_file.is_file():
+            raise GarmdownError(f'no watch status found: {self.status_file}')
+        with open(self.status_file) as f:
+            dct = json.load(f)
+        for k in 'last_stats totals'.split():
+            if dct[k] is not None:
+                dct[k] = SyncStats(**dct[k])
+        for k in 'started last_poll last_change next_poll'.split():
+            if dct[k] is not None:
+                dct[k] = datetime.fromisoformat(dct[k])
+        return WatchStatus(**dct)
+
+    def poll(self, status: WatchStatus) -> bool:
+        """Sync the most recent activities and, if anything is new (or on the
+        first poll), back up the database and update the spreadsheet.
+
+        :param status: updated with the outcome of the poll
+
+        :return: whether the poll added an activity or file
+
+        """
+        t0 = time.time()
+        stats: SyncStats = None
+        try:
+            stats = self.manager.sync(self.poll_limit)
+            logger.info(f'poll {status.polls + 1}: {stats}')
+            if stats.changed or status.polls == 0:
+                self.backuper.backup()
+                if self.sheet_updater is not None:
+                    self.sheet_updater.sync()
+            elif self.sheet_updater is not None:
+                # retry rows that could not be written by an earlier poll
+                self.sheet_updater.flush()
+            cache = self.manager.persister.activity_cache
+            if cache is not None:
+                logger.info(f'{cache}')
+            status.last_error = None
+        except Exception as e:
+            logger.error(f'poll failed: {e}', exc_info=True)
+            status.last_error = str(e)
+            # release the lock of a failed write before sleeping
+            self.manager.persister.rollback()
+        now = datetime.now()
+        status.polls += 1
+        status.last_poll = now
+        status.last_seconds = time.time() - t0
+        status.last_stats = stats
+        changed = stats is not None and stats.changed
+        if changed:
+            status.last_change = now
+            totals = status.totals
+            totals.activities += stats.activities
+            totals.updated += stats.updated
+            totals.downloaded += stats.downloaded
+            totals.imported += stats.imported
+        return changed
+
+    def watch(self, polls: int = None):
+        """Poll until interrupted.
+
+        :param polls: the number of polls after which to stop, or ``None`` to
+                      poll until the process is interrupted
+
+        """
+        status = WatchStatus()
+        logger.info(f'watching for activities every {self.min_interval}s ' +
+                    f'to {self.max_interval}s')
+        with self.manager.persister.shared_connection():
+            try:
+                while polls is None or status.polls < polls:
+                    changed = self.poll(status)
+                    now = datetime.now()
+                    wait = self._next_interval(changed, now)
+                    status.next_poll = now + timedelta(seconds=wait)
+                    self._write_status(status)
+                    if polls is not None and status.polls >= polls:
+                        break
+                    logger.info(f'next poll in {wait:.0f}s')
+                    time.sleep(wait)
+            except KeyboardInterrupt:
+                logger.info('watch interrupted')
+        return status
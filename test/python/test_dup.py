@@ -0,0 +1,113 @@
+import unittest
+from datetime import datetime, timedelta
+from zensols.garmdown import GarmdownError, DuplicateDetector
+
+
+class FakePersister(object):
+    """Stores the activity spans and duplicates in memory."""
+    def __init__(self, spans, pending):
+        self.spans = spans
+        self.pending = pending
+        self.queried = []
+        self.replaced = None
+        self.cleared = None
+
+    def get_duplicate_pending(self):
+        return dict(self.pending)
+
+    def get_activity_spans(self, start=None, end=None):
+        self.queried.append((start, end))
+        return tuple(filter(
+            lambda s: ((start is None or s[1] >= start) and
+                       (end is None or s[1] < end)), self.spans))
+
+    def replace_duplicates(self, dups, start=None, end=None):
+        self.replaced = (tuple(dups), start, end)
+
+    def clear_duplicate_pending(self, ids):
+        self.cleared = set(ids)
+
+
+def at(hour: int, minute: int = 0, day: int = 1) -> datetime:
+    return datetime(2025, 6, day, hour, minute)
+
+
+class TestDuplicate(unittest.TestCase):
+    COLS = {'c': 'cycling', 'v': 'cycling', 'r': 'running', 's': '<skip>'}
+
+    def _detector(self, spans=(), pending={}, **kwargs):
+        return DuplicateDetector(FakePersister(spans, pending), self.COLS,
+                                 **kwargs)
+
+    def _pairs(self, dups):
+        return list(map(lambda d: (d.activity_id, d.primary_id), dups))
+
+    def test_sweep(self):
+        spans = (('a', at(10), 'c', 3600),
+                 # virtual rides are in the same column
+                 ('b', at(10, 5), 'v', 3000),
+                 # different column
+                 ('c', at(10, 10), 'r', 3000),
+                 # overlaps 'a' by a third
+                 ('d', at(10, 50), 'c', 1800),
+                 ('e', at(12, 0), 's', 3600),
+                 ('f', at(12, 1), 's', 3600),
+                 ('g', at(12, 2), 'c', None))
+        dups = self._detector()._sweep(spans)
+        self.assertEqual([('b', 'a')], self._pairs(dups))
+        self.assertEqual(at(10, 5), dups[0].start_time)
+        self.assertEqual(1., dups[0].overlap)
+
+    def test_threshold(self):
+        spans = (('a', at(12), 'c', 1000),
+                 ('b', at(12, 5), 'c', 1000))
+        dups = self._detector()._sweep(spans)
+        # equal moving times keep the first to start
+        self.assertEqual([('b', 'a')], self._pairs(dups))
+        self.assertAlmostEqual(0.7, dups[0].overlap)
+        self.assertEqual([], self._detector(min_overlap=0.8)._sweep(spans))
+        self.assertEqual(1, len(self._detector(min_overlap=0.7)._sweep(spans)))
+        for bad in (0, 1.5):
+            with self.assertRaises(GarmdownError):
+                self._detector(min_overlap=bad)
+
+    def test_primary(self):
+        # 'b' overlaps both, grouping all three under the longest
+        spans = (('a', at(8), 'c', 1200),
+                 ('b', at(8, 10), 'c', 1800),
+                 ('c', at(8, 25), 'c', 1200))
+        dups = self._detector()._sweep(spans)
+        self.assertEqual([('a', 'b'), ('c', 'b')], self._pairs(dups))
+        self.assertAlmostEqual(10 / 20, dups[0].overlap)
+        self.assertAlmostEqual(15 / 20, dups[1].overlap)
+
+    def test_detect(self):
+        spans = (('a', at(10, day=1), 'c', 3600),
+                 ('b', at(10, 5, day=1), 'c', 3000),
+                 ('c', at(10, day=3), 'c', 3600),
+                 ('d', at(10, 5, day=3), 'c', 3000),
+                 ('e', at(10, day=6), 'c', 3600),
+                 ('f', at(10, 5, day=6), 'c', 3000))
+        # 'x' was archived
+        pending = {'d': at(10, 5, day=3), 'x': None}
+        detector = self._detector(spans, pending, max_seconds=86400)
+        dups = detector.detect()
+        persister = detector.persister
+        self.assertEqual([('d', 'c')], self._pairs(dups))
+        margin = timedelta(days=1)
+        start, end = at(10, 5, day=3) - margin, at(10, 5, day=3) + margin
+        self.assertEqual([(start - margin, end + margin)], persister.queried)
+        self.assertEqual((dups, start, end), persister.replaced)
+        self.assertEqual({'d', 'x'}, persister.cleared)
+        # all activities
+        dups = detector.detect(full=True)
+        self.assertEqual([('b', 'a'), ('d', 'c'), ('f', 'e')],
+                         self._pairs(dups))
+        self.assertEqual((None, None), persister.queried[-1])
+        self.assertEqual((dups, None, None), persister.replaced)
+
+    def test_detect_archived(self):
+        detector = self._detector((), {'x': None})
+        self.assertEqual((), detector.detect())
+        self.assertEqual([], detector.persister.queried)
+        self.assertEqual({'x'}, detector.persister.cleared)
@@ -0,0 +1,88 @@
+import unittest
+import os
+import csv
+import tempfile
+from io import StringIO
+from pathlib import Path
+import xml.etree.ElementTree as et
+from zensols.garmdown import (
+    TcxReader, TcxWriter, ActivityExporter, read_laps, read_track
+)
+from test_track import fit_activity
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.source = Path('test-resources/activity.tcx')
+        self._temp = tempfile.TemporaryDirectory()
+        self.dir = Path(self._temp.name)
+
+    def tearDown(self):
+        self._temp.cleanup()
+
+    def assertTracksEqual(self, a, b):
+        self.assertEqual(len(a), len(b))
+        for col in a.COLUMNS:
+            for x, y in zip(getattr(a, col), getattr(b, col)):
+                if x != x:
+                    self.assertTrue(y != y, col)
+                else:
+                    self.assertAlmostEqual(x, y, places=5, msg=col)
+
+    def test_tcx_round_trip(self):
+        reader = TcxReader()
+        laps = read_laps(self.source)
+        sio = StringIO()
+        writer = TcxWriter(sio, 'cycling', laps)
+        writer.start()
+        for point in reader.points(self.source):
+            writer.write(point)
+        writer.end()
+        path = self.dir / 'trip.tcx'
+        path.write_text(sio.getvalue())
+        self.assertTracksEqual(read_track(self.source), read_track(path))
+        self.assertEqual(laps, read_laps(path))
+        # each trackpoint is in the lap it was recorded in
+        ns = '{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}'
+        root = et.parse(path).getroot()
+        act = root.find(f'{ns}Activities/{ns}Activity')
+        self.assertEqual('Biking', act.get('Sport'))
+        self.assertEqual([2, 1], list(map(
+            lambda lap: len(lap.findall(f'{ns}Track/{ns}Trackpoint')),
+            act.findall(f'{ns}Lap'))))
+
+    def test_fit_to_tcx(self):
+        fit = self.dir / 'act.fit'
+        fit.write_bytes(fit_activity())
+        out = self.dir / 'out'
+        out.mkdir()
+        written = ActivityExporter(('tcx', 'fit')).export(out, fit)
+        self.assertEqual({out / 'act.tcx', out / 'act.fit'}, set(written))
+        self.assertEqual(fit.read_bytes(), (out / 'act.fit').read_bytes())
+        self.assertTracksEqual(read_track(fit), read_track(out / 'act.tcx'))
+        self.assertEqual(read_laps(fit), read_laps(out / 'act.tcx'))
+
+    def test_formats(self):
+        exporter = ActivityExporter(('native', 'gpx', 'csv', 'fit'))
+        written = exporter.export(self.dir, self.source)
+        self.assertEqual(['activity.csv', 'activity.gpx', 'activity.tcx'],
+                         sorted(map(lambda p: p.name, written)))
+        with open(self.dir / 'activity.csv') as f:
+            rows = tuple(csv.DictReader(f))
+        self.assertEqual(3, len(rows))
+        self.assertEqual('2019-05-01T12:00:00Z', rows[0]['time'])
+        self.assertEqual(('200', ''), (rows[0]['power'], rows[1]['power']))
+        # trackpoints without a position are not in the GPX track
+        ns = '{http://www.topografix.com/GPX/1/1}'
+        root = et.parse(self.dir / 'activity.gpx').getroot()
+        self.assertEqual(2, len(root.findall(f'{ns}trk/{ns}trkseg/{ns}trkpt')))
+
+    def test_up_to_date(self):
+        exporter = ActivityExporter(('native', 'csv'))
+        self.assertEqual(2, len(exporter.export(self.dir, self.source)))
+        self.assertEqual((), exporter.export(self.dir, self.source))
+        # an older output is written again
+        csv_path = self.dir / 'activity.csv'
+        os.utime(csv_path, (0, 0))
+        self.assertEqual((csv_path,), exporter.export(self.dir, self.source))
+        self.assertEqual([], list(self.dir.glob('*.[0-9]*')))
@@ -0,0 +1,155 @@
+import unittest
+import math
+import tempfile
+from pathlib import Path
+from datetime import datetime, timedelta
+from zensols.config import IniConfig, Settings
+from zensols.garmdown import (
+    GarmdownError, ActivityFactory, Persister, QueryCompiler, Track, GeoGrid
+)
+
+
+def track(*points) -> Track:
+    trk = Track()
+    for i, (lat, lon) in enumerate(points):
+        trk.append({'time': i, 'latitude': lat, 'longitude': lon})
+    return trk
+
+
+class TestGeoGrid(unittest.TestCase):
+    def setUp(self):
+        self.grid = GeoGrid(0.5)
+
+    def test_cell(self):
+        grid = self.grid
+        cols = 720
+        self.assertEqual(0, grid.cell(-90, -180))
+        self.assertEqual(1, grid.cell(-90, -179.5))
+        self.assertEqual(cols, grid.cell(-89.5, -180))
+        # positions on the edge of the earth are in the last row and column
+        self.assertEqual(360 * cols - 1, grid.cell(90, 180))
+        with self.assertRaises(GarmdownError):
+            GeoGrid(0)
+
+    def test_track_cells(self):
+        cells, box = self.grid.track_cells(track(
+            (45.1, -122.9), (math.nan, math.nan), (45.7, -122.2),
+            (45.2, -122.8)))
+        self.assertEqual((45.1, -122.9, 45.7, -122.2), box)
+        self.assertEqual(tuple(sorted({self.grid.cell(45.1, -122.9),
+                                       self.grid.cell(45.7, -122.2)})),
+                         cells)
+        self.assertEqual(((), None),
+                         self.grid.track_cells(track((math.nan, 1.))))
+
+    def test_box_ranges(self):
+        grid = self.grid
+        ranges = grid.box_ranges((45.1, -122.9, 46.2, -121.6))
+        self.assertEqual(3, len(ranges))
+        self.assertEqual((grid.cell(45.1, -122.9), grid.cell(45.1, -121.6)),
+                         ranges[0])
+        self.assertEqual((grid.cell(46.2, -122.9), grid.cell(46.2, -121.6)),
+                         ranges[-1])
+        with self.assertRaises(GarmdownError):
+            grid.box_ranges((46, -122, 45, -121))
+
+    def test_near(self):
+        grid = GeoGrid(0.1)
+        cols = 3600
+        # about 111km is a degree of latitude
+        box = grid.near_box(45, -122, 111195)
+        self.assertAlmostEqual(44, box[0], places=3)
+        self.assertAlmostEqual(46, box[2], places=3)
+        self.assertLess(box[1], -123.4)
+        near = grid.near_ranges(45, -122, 111195)
+        outer = dict(map(lambda r: (r[0] // cols, r), grid.box_ranges(box)))
+        self.assertEqual(len(outer), len(near))
+        for lo, hi in near:
+            olo, ohi = outer[lo // cols]
+            self.assertTrue(olo <= lo <= hi <= ohi)
+        # the rows furthest from the position are narrower
+        self.assertLess(near[0][1] - near[0][0], near[10][1] - near[10][0])
+
+    def test_clip(self):
+        grid = self.grid
+        ranges = grid.box_ranges((45, -123, 47, -121))
+        clipped = grid.clip(ranges, (45.6, -122.2, 50, -122.1))
+        self.assertEqual([(grid.cell(45.6, -122.2), grid.cell(45.6, -122.1)),
+                          (grid.cell(46, -122.2), grid.cell(46, -122.1)),
+                          (grid.cell(46.5, -122.2), grid.cell(46.5, -122.1)),
+                          (grid.cell(47, -122.2), grid.cell(47, -122.1))],
+                         clipped)
+        self.assertEqual([], grid.clip(ranges, (48, -123, 49, -121)))
+
+
+class TestTrackIndex(unittest.TestCase):
+    BOX = (45.5051, -122.6805, 45.5060, -122.6795)
+
+    def setUp(self):
+        self._temp = tempfile.TemporaryDirectory()
+        factory = ActivityFactory(Settings(cycling='c', running='r'),
+                                  Settings(c='cycling', r='running'))
+        self.compiler = QueryCompiler(factory)
+        sql = IniConfig('resources/persist.conf').populate(section='sql')
+        self.persister = Persister(
+            factory, Path(self._temp.name) / 'activities.sqlite', 10, sql)
+        self.grid = GeoGrid()
+
+    def tearDown(self):
+        self._temp.cleanup()
+
+    def _index(self, *tracks):
+        indexed = map(lambda t: (t[0], self.grid.track_cells(t[1]), None),
+                      tracks)
+        self.persister.insert_track_cells(self.grid.cell_size, indexed)
+
+    def _find(self, box):
+        return self.persister.find_track_activities(
+            self.grid, self.grid.box_ranges(box), box)
+
+    def test_find(self):
+        # in the same cell as the box but never enters it
+        self._index(('x', track((45.5081, -122.68), (45.5099, -122.68))))
+        self.assertEqual(self.grid.cell(45.5081, -122.68),
+                         self.grid.cell(*self.BOX[:2]))
+        self.assertEqual(set(), self._find(self.BOX))
+        # other activities do not change whether it is found
+        self._index(('y', track((45.5055, -122.68), (45.5070, -122.68))),
+                    ('z', track((45.6, -122.9), (45.7, -122.9))))
+        self.assertEqual({'y'}, self._find(self.BOX))
+        self.assertEqual({'x', 'y'}, self._find((45.5, -122.7, 45.51, -122.6)))
+        self.assertEqual(set(), self._find((44, -120, 44.1, -119.9)))
+
+    def test_replace(self):
+        self._index(('y', track((45.5055, -122.68))))
+        self.assertEqual({'y'}, self._find(self.BOX))
+        # an activity indexed again replaces its cells
+        self._index(('y', track((45.6, -122.9))))
+        self.assertEqual(set(), self._find(self.BOX))
+        # and activities whose files could not be read are not found
+        self.persister.insert_track_cells(
+            self.grid.cell_size, (('y', None, 'bad file'),))
+        self.assertEqual(set(), self._find((45, -123, 46, -122)))
+
+    def test_stream(self):
+        # more activities than SQLite binds parameters before 3.32
+        count = 1200
+        start = datetime(2025, 1, 1, 7)
+        acts = tuple(map(lambda i: self.persister.activity_factory.create({
+            'activityId': 1000 + i, 'activityName': f'act {i}',
+            'activityType': {'typeKey': ('cycling', 'running')[i % 2]},
+            'startTimeLocal': str(start + timedelta(days=i)),
+            'movingDuration': 3600.}), range(count)))
+        self.persister.insert_activities(acts)
+        self._index(*map(lambda a: (a.id, track((45.5055, -122.68))), acts))
+        self._index(('1000', track((45.6, -122.9))))
+        query = self.compiler.compile('type=c', count, 'date')
+        found = tuple(self.persister.stream_activities_by_track(
+            query, self.grid, self.grid.box_ranges(self.BOX), self.BOX))
+        self.assertEqual(count // 2 - 1, len(found))
+        self.assertEqual(('1002', '1004'), (found[0].id, found[1].id))
+        query = self.compiler.compile('', 10, '-date')
+        found = tuple(self.persister.stream_activities_by_track(
+            query, self.grid, self.grid.box_ranges(self.BOX), self.BOX))
+        self.assertEqual(str(1000 + count - 1), found[0].id)
+        self.assertEqual(10, len(found))
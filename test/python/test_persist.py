@@ -0,0 +1,37 @@
+import unittest
+import sqlite3
+import tempfile
+from pathlib import Path
+from zensols.config import IniConfig, Settings
+from zensols.garmdown import ActivityFactory, Persister
+
+
+class TestPersister(unittest.TestCase):
+    def setUp(self):
+        self._temp = tempfile.TemporaryDirectory()
+        factory = ActivityFactory(Settings(cycling='c'),
+                                  Settings(c='cycling'))
+        sql = IniConfig('resources/persist.conf').populate(section='sql')
+        self.persister = Persister(
+            factory, Path(self._temp.name) / 'activities.sqlite', 10, sql)
+
+    def tearDown(self):
+        self._temp.cleanup()
+
+    def test_shared_rollback(self):
+        persister = self.persister
+        # the second activity fails after the first is written
+        indexed = (('a', ((1, 2), (1., 2., 3., 4.)), None), ('b', 1, None))
+        with persister.shared_connection() as conn:
+            with self.assertRaises(TypeError):
+                persister.insert_track_cells(0.005, indexed)
+            self.assertFalse(conn.in_transaction)
+            # other connections can write
+            other = sqlite3.connect(str(persister.db_file), timeout=0)
+            try:
+                other.execute('delete from track_cell')
+                other.commit()
+            finally:
+                other.close()
+            self.assertEqual(0, conn.execute(
+                'select count(*) from track_bounds').fetchone()[0])
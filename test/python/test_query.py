@@ -0,0 +1,93 @@
+import unittest
+import sqlite3
+from datetime import datetime
+from zensols.config import Settings
+from zensols.garmdown import (
+    GarmdownError, ActivityFactory, QueryCompiler, LapQueryCompiler
+)
+
+
+class TestQuery(unittest.TestCase):
+    STARTS = (datetime(2024, 12, 31, 23), datetime(2025, 6, 1, 7),
+              datetime(2025, 6, 1, 23, 59), datetime(2025, 6, 2),
+              datetime(2026, 1, 1))
+
+    def setUp(self):
+        factory = ActivityFactory(
+            Settings(road_biking='c', cycling='c', running='r'),
+            Settings(c='cycling', r='running'))
+        self.compiler = QueryCompiler(factory)
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('create table activity (id text, start_time ' +
+                          'timestamp, atype text, move_time_seconds real)')
+        # move times of 1h, 2h, ... with the types alternating
+        self.conn.executemany(
+            'insert into activity values (?, ?, ?, ?)',
+            map(lambda x: (str(x[0]), x[1], 'cr'[x[0] % 2],
+                           (x[0] + 1) * 3600), enumerate(self.STARTS)))
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _select(self, filter: str) -> list:
+        query = self.compiler.compile(filter, order='date')
+        sql = f'select id from activity {query.where} {query.order}'
+        return list(map(lambda r: int(r[0]),
+                        self.conn.execute(sql, query.params)))
+
+    def test_date(self):
+        query = self.compiler.compile('date=2025-06-01')
+        self.assertEqual('where (start_time >= ? and start_time < ?)',
+                         query.where)
+        self.assertEqual(('2025-06-01', '2025-06-02'), query.params)
+        self.assertEqual([1, 2], self._select('date=2025-06-01'))
+        self.assertEqual([0, 3, 4], self._select('date!=2025-06-01'))
+        self.assertEqual([0], self._select('date<2025-06-01'))
+        # the whole day is included
+        self.assertEqual([0, 1, 2], self._select('date<=2025-06-01'))
+        self.assertEqual([3, 4], self._select('date>2025-06-01'))
+        self.assertEqual([1, 2, 3, 4], self._select('date>=2025-06-01'))
+
+    def test_year(self):
+        self.assertEqual([1, 2, 3], self._select('year=2025'))
+        self.assertEqual([0, 1, 2, 3], self._select('year<=2025'))
+        self.assertEqual([4], self._select('year>2025'))
+        self.assertEqual([0, 4], self._select('year!=2025'))
+
+    def test_duration(self):
+        parse = self.compiler._parse_duration
+        self.assertEqual(5400, parse('1h30m'))
+        self.assertEqual(5400, parse('90m'))
+        self.assertEqual(3 * 3600, parse('3h'))
+        self.assertEqual(45, parse('45'))
+        self.assertEqual(45, parse('45s'))
+        for bad in ('', 'h', '1x', '30m1h'):
+            with self.assertRaises(GarmdownError):
+                parse(bad)
+        self.assertEqual([2, 3, 4], self._select('duration>2h'))
+        self.assertEqual([1, 2], self._select('duration>=2h duration<=3h'))
+
+    def test_type(self):
+        self.assertEqual([1, 3], self._select('type=r'))
+        self.assertEqual([0, 2, 4], self._select('type=road_biking'))
+        self.assertEqual([0, 2], self._select('type!=r year<=2025'))
+        with self.assertRaises(GarmdownError):
+            self.compiler.compile('type<c')
+        with self.assertRaises(GarmdownError):
+            self.compiler.compile('type=swimming')
+
+    def test_bad(self):
+        for bad in ('date', 'date=2025-13-01', 'nofield=1', 'power_norm=x'):
+            with self.assertRaises(GarmdownError):
+                self.compiler.compile(bad)
+
+    def test_laps(self):
+        compiler = LapQueryCompiler(self.compiler.activity_factory)
+        query = compiler.compile('type=c year=2025 duration>=19m ' +
+                                 'duration<=21m', order='-power_average')
+        self.assertEqual(('c', '2025-01-01', '2026-01-01', 1140., 1260.),
+                         query.params)
+        self.assertEqual('order by power_average desc', query.order)
+        # activity fields that are not those of laps
+        with self.assertRaises(GarmdownError):
+            compiler.compile('power_norm>0')
@@ -0,0 +1,95 @@
+import unittest
+from zensols.garmdown import GarmdownError, SeriesPyramid
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def lttb(x, y, edges):
+    """Return the indexes kept by LTTB computed one bucket at a time."""
+    bounds = list(edges) + [len(x) - 1]
+    kept = [0]
+    for i in range(len(edges)):
+        lo, hi = bounds[i], bounds[i + 1]
+        if i + 2 < len(bounds):
+            nlo, nhi = hi, bounds[i + 2]
+            cx = sum(x[nlo:nhi]) / (nhi - nlo)
+            cy = sum(y[nlo:nhi]) / (nhi - nlo)
+        else:
+            cx, cy = x[-1], y[-1]
+        ax, ay = x[kept[-1]], y[kept[-1]]
+        areas = list(map(lambda j: abs((ax - cx) * (y[j] - ay) -
+                                       (ax - x[j]) * (cy - ay)),
+                         range(lo, hi)))
+        kept.append(lo + areas.index(max(areas)))
+    return kept + [len(x) - 1]
+
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class TestSeries(unittest.TestCase):
+    def setUp(self):
+        self.pyramid = SeriesPyramid()
+        rand = np.random.RandomState(0)
+        self.time = np.arange(2000, dtype=np.float64)
+        self.values = np.sin(self.time / 50) * 100 + rand.normal(0, 5, 2000)
+
+    def assertDownsampled(self, time, values, points):
+        t, v, lows, highs = self.pyramid.downsample(time, values, points)
+        self.assertEqual((points,) * 4, tuple(map(len, (t, v, lows, highs))))
+        # the first and last points are kept
+        self.assertEqual((time[0], time[-1]), (t[0], t[-1]))
+        self.assertEqual((values[0], values[-1]), (v[0], v[-1]))
+        self.assertTrue((np.diff(t) > 0).all())
+        self.assertTrue((lows <= v).all())
+        self.assertTrue((v <= highs).all())
+        self.assertEqual(values.min(), lows.min())
+        self.assertEqual(values.max(), highs.max())
+        return t, v, lows, highs
+
+    def test_small(self):
+        time, values = self.time[:5], self.values[:5]
+        for points in (5, 6):
+            t, v, lows, highs = self.pyramid.downsample(time, values, points)
+            self.assertIs(time, t)
+            for arr in (v, lows, highs):
+                self.assertIs(values, arr)
+
+    def test_one_over(self):
+        # one point more than kept leaves a single bucket of two points
+        for points in (3, 4, 10, 512):
+            size = points + 1
+            self.assertDownsampled(self.time[:size], self.values[:size],
+                                   points)
+        t, v, lows, highs = self.pyramid.downsample(
+            self.time[:4], np.array([1., 5., 3., 2.]), 3)
+        self.assertEqual([0., 1., 3.], list(t))
+        self.assertEqual([1., 3., 2.], list(lows))
+        self.assertEqual([1., 5., 2.], list(highs))
+
+    def test_lttb(self):
+        for points in (3, 4, 33, 128):
+            size = len(self.time)
+            edges = np.linspace(1, size - 1, points - 1).astype(np.intp)[:-1]
+            self.assertEqual(
+                lttb(list(self.time), list(self.values), edges),
+                list(self.pyramid._lttb(np, self.time, self.values, edges)))
+
+    def test_peak(self):
+        values = self.values.copy()
+        values[777] = 1000
+        values[1234] = -1000
+        t, v, lows, highs = self.assertDownsampled(self.time, values, 32)
+        self.assertIn(777., t)
+        self.assertIn(1234., t)
+        self.assertEqual(1000, v.max())
+        self.assertEqual(-1000, v.min())
+
+    def test_levels(self):
+        self.assertEqual((32, 8, 3),
+                         SeriesPyramid(levels=(8, 3, 32)).levels)
+        with self.assertRaises(GarmdownError):
+            SeriesPyramid(levels=(8, 2))
+        with self.assertRaises(GarmdownError):
+            SeriesPyramid(series=('power', 'watts'))
@@ -0,0 +1,168 @@
+import unittest
+import math
+import struct
+from pathlib import Path
+from datetime import datetime
+from zensols.garmdown import (
+    GarmdownError, TcxReader, FitReader, read_track, read_laps
+)
+
+
+EPOCH = 631065600
+
+
+def fit_define(local: int, num: int, fields, big: bool = False,
+               dev=()) -> bytes:
+    """Return a FIT definition message."""
+    header = 0x40 | local | (0x20 if len(dev) > 0 else 0)
+    out = bytes([header, 0, 1 if big else 0])
+    out += struct.pack('>H' if big else '<H', num) + bytes([len(fields)])
+    out += b''.join(map(bytes, fields))
+    if len(dev) > 0:
+        out += bytes([len(dev)]) + b''.join(map(bytes, dev))
+    return out
+
+
+def fit_file(body: bytes) -> bytes:
+    """Return a FIT file of the messages ``body`` (the reader does not check
+    the CRC, which is left zero).
+
+    """
+    header = struct.pack('<BBHI4sH', 14, 0x20, 2000, len(body), b'.FIT', 0)
+    return header + body + b'\0\0'
+
+
+def fit_activity() -> bytes:
+    """Return a FIT file of three records, the last with a compressed time
+    stamp header, two laps and a cycling session.
+
+    """
+    t0 = 1556712000 - EPOCH
+    semi = 2 ** 31 / 180
+    # time, lat, lon, altitude, distance, heart rate, power, speed
+    record = ((253, 4, 0x86), (0, 4, 0x85), (1, 4, 0x85), (2, 2, 0x84),
+              (5, 4, 0x86), (3, 1, 0x02), (7, 2, 0x84), (6, 2, 0x84))
+    body = fit_define(0, 20, record, dev=((0, 2, 0),))
+    for i, power in enumerate((200, 0xffff)):
+        body += bytes([0]) + struct.pack(
+            '<IiiHIBHH', t0 + i, round((45.52 + i * 1e-4) * semi),
+            round((-122.68 - i * 1e-4) * semi), (30 + 500) * 5,
+            i * 750, 120 + i, power, 7500) + b'\xff\xff'
+    # a big endian definition without the time for a compressed header
+    body += fit_define(1, 20, record[1:], big=True)
+    body += bytes([0x80 | (1 << 5) | ((t0 + 2) & 0x1f)])
+    body += struct.pack('>iiHIBHH', 0x7fffffff, 0x7fffffff, 0xffff, 1500,
+                        110, 0xffff, 0xffff)
+    lap = ((2, 4, 0x86), (8, 4, 0x86), (9, 4, 0x86), (11, 2, 0x84),
+           (15, 1, 0x02), (16, 1, 0x02), (19, 2, 0x84), (23, 1, 0x00))
+    body += fit_define(2, 19, lap)
+    body += bytes([2]) + struct.pack('<IIIHBBHB', t0, 2000, 1500, 1, 121,
+                                     122, 200, 0)
+    body += bytes([2]) + struct.pack('<IIIHBBHB', t0 + 2, 1000, 0, 0, 0xff,
+                                     0xff, 0xffff, 1)
+    body += fit_define(3, 18, ((5, 1, 0x00),))
+    body += bytes([3, 2])
+    return fit_file(body)
+
+
+class TestTcx(unittest.TestCase):
+    def setUp(self):
+        self.path = Path('test-resources/activity.tcx')
+
+    def test_points(self):
+        points = tuple(TcxReader().points(self.path))
+        self.assertEqual(3, len(points))
+        start = datetime.fromisoformat('2019-05-01T12:00:00+00:00')
+        self.assertEqual(start.timestamp(), points[0]['time'])
+        self.assertEqual(start.timestamp() + 2, points[2]['time'])
+        self.assertEqual({'time': start.timestamp(), 'latitude': 45.52,
+                          'longitude': -122.68, 'altitude': 30.,
+                          'distance': 0., 'heart_rate': 120., 'cadence': 85.,
+                          'speed': 7.5, 'power': 200.}, points[0])
+        self.assertNotIn('power', points[1])
+        # the lap distance is not that of the trackpoint
+        self.assertEqual({'time', 'distance', 'heart_rate'},
+                         set(points[2].keys()))
+        self.assertEqual(15., points[2]['distance'])
+
+    def test_track(self):
+        track = read_track(self.path)
+        self.assertEqual(3, len(track))
+        self.assertEqual(122., track.heart_rate[1])
+        self.assertTrue(math.isnan(track.power[1]))
+        self.assertTrue(math.isnan(track.latitude[2]))
+
+    def test_laps(self):
+        laps = read_laps(self.path)
+        self.assertEqual(2, len(laps))
+        lap = laps[0]
+        self.assertEqual(datetime(2019, 5, 1, 12), lap.start_time)
+        self.assertEqual((2., 15., 121., 122., 86., 200., 1., 'active'),
+                         (lap.total_seconds, lap.distance,
+                          lap.heart_rate_average, lap.heart_rate_max,
+                          lap.cadence, lap.power_average, lap.calories,
+                          lap.intensity))
+        lap = laps[1]
+        self.assertEqual(datetime(2019, 5, 1, 12, 0, 2), lap.start_time)
+        self.assertEqual('resting', lap.intensity)
+        self.assertIsNone(lap.heart_rate_average)
+        self.assertIsNone(lap.power_average)
+
+    def test_time(self):
+        self.assertEqual(datetime(2019, 5, 1, 12),
+                         TcxReader._utc('2019-05-01T12:00:00.000Z'))
+        self.assertEqual(datetime(2019, 5, 1, 12),
+                         TcxReader._utc('2019-05-01T14:00:00+02:00'))
+
+
+class TestFit(unittest.TestCase):
+    def setUp(self):
+        self.data = fit_activity()
+
+    def test_points(self):
+        points = tuple(FitReader().decode_points(self.data))
+        self.assertEqual(3, len(points))
+        self.assertEqual([1556712000, 1556712001, 1556712002],
+                         list(map(lambda p: p['time'], points)))
+        point = points[0]
+        self.assertAlmostEqual(45.52, point['latitude'], places=6)
+        self.assertAlmostEqual(-122.68, point['longitude'], places=6)
+        cols = 'altitude distance heart_rate power speed'.split()
+        self.assertEqual((30., 0., 120., 200., 7.5),
+                         tuple(map(lambda c: point[c], cols)))
+        self.assertNotIn('power', points[1])
+        self.assertEqual({'time', 'distance', 'heart_rate'},
+                         set(points[2].keys()))
+        self.assertEqual(15., points[2]['distance'])
+
+    def test_compressed_time_rollover(self):
+        # a compressed offset smaller than that of the last time stamp rolls
+        # over to the next 32 seconds
+        t0 = 1556712000 - EPOCH
+        t0 += 0x1f - (t0 & 0x1f)
+        body = fit_define(0, 20, ((253, 4, 0x86), (3, 1, 0x02)))
+        body += bytes([0]) + struct.pack('<IB', t0, 100)
+        body += fit_define(1, 20, ((3, 1, 0x02),))
+        body += bytes([0x80 | (1 << 5) | 1, 101])
+        track = FitReader().decode(fit_file(body))
+        self.assertEqual([t0 + EPOCH, t0 + 2 + EPOCH], list(track.time))
+        self.assertEqual([100., 101.], list(track.heart_rate))
+
+    def test_laps(self):
+        sport, laps = FitReader().decode_summary(self.data)
+        self.assertEqual('cycling', sport)
+        self.assertEqual(2, len(laps))
+        lap = laps[0]
+        self.assertEqual(datetime(2019, 5, 1, 12), lap.start_time)
+        self.assertEqual((2., 15., 121., 122., 200., 1., 'active'),
+                         (lap.total_seconds, lap.distance,
+                          lap.heart_rate_average, lap.heart_rate_max,
+                          lap.power_average, lap.calories, lap.intensity))
+        lap = laps[1]
+        self.assertEqual('resting', lap.intensity)
+        self.assertIsNone(lap.heart_rate_average)
+        self.assertEqual(laps, FitReader().decode_laps(self.data))
+
+    def test_not_fit(self):
+        with self.assertRaises(GarmdownError):
+            FitReader().decode(b'\0' * 16)